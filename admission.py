@@ -0,0 +1,156 @@
+import logging
+import math
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# requests running at once, requests allowed to wait for a slot and how long they wait before
+# being shed with a 503
+MAX_CONCURRENT_REQUESTS = 32
+MAX_QUEUED_REQUESTS = 64
+QUEUE_TIMEOUT = 2.0
+# idle users' buckets are full again anyway, so they're dropped once this many users are tracked
+MAX_TRACKED_USERS = 10000
+
+
+
+class RateLimiter:
+	"""
+	Per-user token buckets: every request takes a token, and a user's bucket refills at rate
+	tokens per second up to burst tokens.
+	"""
+
+	def __init__(self, limits):
+		"""
+		:param limits: Function returning the limits of a user, {"rate": 10, "burst": 20}, or None
+					   for a user without a limit.
+		"""
+		self.limits = limits
+		self.buckets = {}
+		self.lock = threading.Lock()
+		self.metrics = {"allowed": 0, "limited": 0}
+
+
+	def acquire(self, user):
+		"""
+		Takes a token from a user's bucket.
+
+		:param user: The user the request counts against.
+		:return: 0 when the request can run, otherwise the seconds until the bucket has a token.
+		"""
+		limits = self.limits(user)
+		if not limits:
+			return 0
+		rate = float(limits["rate"])
+		burst = float(limits.get("burst", rate))
+		now = time.monotonic()
+		with self.lock:
+			tokens, updated = self.buckets.pop(user, (burst, now))
+			tokens = min(burst, tokens + (now - updated) * rate)
+			if tokens >= 1:
+				tokens -= 1
+				wait = 0
+				self.metrics["allowed"] += 1
+			else:
+				wait = (1 - tokens) / rate if rate > 0 else QUEUE_TIMEOUT
+				self.metrics["limited"] += 1
+			# re-inserted so the dict stays in least recently used order
+			self.buckets[user] = (tokens, now)
+			while len(self.buckets) > MAX_TRACKED_USERS:
+				del self.buckets[next(iter(self.buckets))]
+		return wait
+
+
+	def stats(self):
+		"""
+		:return: Dict of allowed and rate limited requests and tracked users.
+		"""
+		with self.lock:
+			stats = dict(self.metrics)
+			stats["tracked_users"] = len(self.buckets)
+		return stats
+
+
+
+class ConcurrencyLimiter:
+	"""
+	Caps the requests running at once. Requests over the cap wait in a bounded queue for up to
+	queue_timeout seconds, and are shed right away when the queue is full.
+	"""
+
+	def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS, max_queued=MAX_QUEUED_REQUESTS,
+				 queue_timeout=QUEUE_TIMEOUT):
+		"""
+		:param max_concurrent: Number of requests running at once.
+		:param max_queued: Number of requests waiting for a slot.
+		:param queue_timeout: Seconds a request waits for a slot.
+		"""
+		self.max_concurrent = max_concurrent
+		self.max_queued = max_queued
+		self.queue_timeout = queue_timeout
+		self.running = 0
+		self.queued = 0
+		self.condition = threading.Condition()
+		self.metrics = {"admitted": 0, "shed_queue_full": 0, "shed_timeout": 0, "max_queued": 0}
+
+
+	def acquire(self):
+		"""
+		Waits for a slot, release it once the request is done.
+
+		:return: True when the request got a slot, False when it was shed.
+		"""
+		with self.condition:
+			if self.running < self.max_concurrent and not self.queued:
+				self.running += 1
+				self.metrics["admitted"] += 1
+				return True
+			if self.queued >= self.max_queued:
+				self.metrics["shed_queue_full"] += 1
+				return False
+			self.queued += 1
+			self.metrics["max_queued"] = max(self.metrics["max_queued"], self.queued)
+			deadline = time.monotonic() + self.queue_timeout
+			try:
+				while self.running >= self.max_concurrent:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						self.metrics["shed_timeout"] += 1
+						return False
+					self.condition.wait(remaining)
+			finally:
+				self.queued -= 1
+			self.running += 1
+			self.metrics["admitted"] += 1
+			return True
+
+
+	def release(self):
+		"""
+		Frees the slot of a finished request.
+		"""
+		with self.condition:
+			self.running -= 1
+			self.condition.notify()
+
+
+	def retry_after(self):
+		"""
+		:return: Seconds a shed client should wait before retrying, for the Retry-After header.
+		"""
+		return max(1, math.ceil(self.queue_timeout))
+
+
+	def stats(self):
+		"""
+		:return: Dict of admitted and shed requests, and the requests running and queued right now.
+		"""
+		with self.condition:
+			stats = dict(self.metrics)
+			stats["running"] = self.running
+			stats["queued"] = self.queued
+		return stats
@@ -0,0 +1,174 @@
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+import logging
+import random
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# a transaction aborted by datastore for contention is retried this many times in total,
+# waiting a random time up to TRANSACTION_BACKOFF * 2 ** attempt seconds in between
+TRANSACTION_RETRIES = 5
+TRANSACTION_BACKOFF = 0.05
+OPERATIONS = ("increment", "decrement", "append", "remove")
+# datastore lookups take at most 1000 keys
+MAX_LOOKUP_KEYS = 1000
+
+
+def run_in_transaction(function, *args, **kwargs):
+	"""
+	Runs a function that opens its own transaction, and runs it again when datastore aborts the
+	transaction because another write to the same entities committed first.
+
+	:param function: The function to run, it must be safe to run more than once.
+	:return: What the function returns.
+	"""
+	for attempt in range(TRANSACTION_RETRIES):
+		try:
+			return function(*args, **kwargs)
+		except Conflict:
+			if attempt == TRANSACTION_RETRIES - 1:
+				logger.exception("Transaction still contended after %s attempts.", TRANSACTION_RETRIES)
+				raise
+			time.sleep(random.uniform(0, TRANSACTION_BACKOFF * 2 ** attempt))
+
+
+def validate_operations(operations):
+	"""
+	Checks an operations dict of the update payload, {"field": {"op": "increment", "value": 1}}.
+
+	:param operations: The operations dict.
+	:raises ValueError: When an operation is unknown or its value has the wrong type.
+	"""
+	for field, items in operations.items():
+		if not isinstance(items, dict):
+			raise ValueError("Operation of %s needs to be a dictionary with an op" % field)
+		op = items.get("op")
+		if op not in OPERATIONS:
+			raise ValueError("Unsupported op for %s: %s" % (field, op))
+		if op in ("increment", "decrement"):
+			value = items.get("value", 1)
+			if isinstance(value, bool) or not isinstance(value, (int, float)):
+				raise ValueError("%s of %s needs a numeric value" % (op, field))
+		elif "value" not in items:
+			raise ValueError("%s of %s needs a value" % (op, field))
+
+
+def operation_delta(items):
+	"""
+	:param items: An increment or decrement operation.
+	:return: The signed amount the operation adds.
+	"""
+	value = items.get("value", 1)
+	return value if items["op"] == "increment" else -value
+
+
+def apply_operations(entity, operations):
+	"""
+	Applies atomic field operations to an entity read inside a transaction.
+
+	:param entity: The entity (or dict) to change.
+	:param operations: The operations dict, see validate_operations.
+	:return: Dict of the new value of every field changed.
+	"""
+	new_values = {}
+	for field, items in operations.items():
+		op = items["op"]
+		if op in ("increment", "decrement"):
+			entity[field] = (entity.get(field) or 0) + operation_delta(items)
+		else:
+			values = items["value"] if isinstance(items["value"], list) else [items["value"]]
+			current = list(entity.get(field) or [])
+			if op == "append":
+				entity[field] = current + values
+			else:
+				entity[field] = [item for item in current if item not in values]
+		new_values[field] = entity[field]
+	return new_values
+
+
+
+class ShardedCounter:
+	"""
+	Encapsulates counters split over several shard entities. Each increment writes one random
+	shard, so a hot counter takes num_shards times the per-entity write rate, and reads sum the
+	shards with a get_multi.
+	"""
+
+	def __init__(self, datastore_client):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		"""
+		self.datastore_client = datastore_client
+
+
+	@staticmethod
+	def shard_kind(kind_id):
+		"""
+		:return: The kind holding the counter shards of kind_id.
+		"""
+		return kind_id + "__shards"
+
+
+	def shard_keys(self, kind_id, counter_id, field, num_shards):
+		"""
+		:return: The keys of every shard of one counter.
+		"""
+		shard_kind = self.shard_kind(kind_id)
+		return [self.datastore_client.key(shard_kind, "%s:%s:%s" % (counter_id, field, shard))
+				for shard in range(num_shards)]
+
+
+	def increment(self, kind_id, counter_id, field, delta, num_shards):
+		"""
+		Adds delta to a counter by updating one random shard.
+
+		:param kind_id: The kind the counter belongs to.
+		:param counter_id: The id of the counter, i.e. the key_id of the entity it belongs to.
+		:param field: The counted property.
+		:param delta: The amount to add, negative to subtract.
+		:param num_shards: The number of shards of the counter.
+		"""
+		def increment_shard():
+			# a different random shard on every retry spreads contended writes
+			key = random.choice(self.shard_keys(kind_id, counter_id, field, num_shards))
+			with self.datastore_client.transaction():
+				shard = self.datastore_client.get(key)
+				if shard is None:
+					shard = datastore.Entity(key=key)
+					shard.update({"counter_id": counter_id, "field": field, "value": 0})
+				shard["value"] = shard["value"] + delta
+				self.datastore_client.put(shard)
+
+		run_in_transaction(increment_shard)
+
+
+	def reset(self, kind_id, counter_id, field, num_shards):
+		"""
+		Deletes every shard of a counter, inside the caller's transaction when there is one.
+		"""
+		self.datastore_client.delete_multi(self.shard_keys(kind_id, counter_id, field, num_shards))
+
+
+	def totals(self, kind_id, counters, read_options=None):
+		"""
+		Sums the shards of several counters with as few lookups as possible.
+
+		:param kind_id: The kind the counters belong to.
+		:param counters: List of (counter_id, field, num_shards).
+		:param read_options: Optional keyword arguments of the lookups, {"eventual": True} or {"read_time": datetime}.
+		:return: Dict of (counter_id, field) to the sum of its shards (0 without shards).
+		"""
+		totals = {(counter_id, field): 0 for counter_id, field, num_shards in counters}
+		keys = []
+		for counter_id, field, num_shards in counters:
+			keys.extend(self.shard_keys(kind_id, counter_id, field, num_shards))
+		for start in range(0, len(keys), MAX_LOOKUP_KEYS):
+			for shard in self.datastore_client.get_multi(keys[start:start + MAX_LOOKUP_KEYS], **(read_options or {})):
+				counter = (shard["counter_id"], shard["field"])
+				if counter in totals:
+					totals[counter] += shard["value"]
+		return totals
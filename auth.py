@@ -0,0 +1,306 @@
+from flask import request, g
+import base64
+import collections
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# the key file is checked for changes at most every RELOAD_INTERVAL seconds
+RELOAD_INTERVAL = 2
+# verified credentials are trusted for CACHE_TTL seconds without checking the password again
+CACHE_TTL = 300
+# and failed ones for FAILED_CACHE_TTL seconds, so retrying a wrong password doesn't hash it again
+FAILED_CACHE_TTL = 5
+MAX_CACHED_CREDENTIALS = 10000
+# bearer tokens are valid for TOKEN_TTL seconds by default, at most MAX_TOKEN_TTL
+TOKEN_TTL = 900
+MAX_TOKEN_TTL = 24 * 60 * 60
+TOKEN_VERSION = "v1"
+# api_keys.json values in this format are password hashes, any other value is a plain password
+PBKDF2_PREFIX = "pbkdf2_sha256"
+PBKDF2_ITERATIONS = 260000
+
+
+def hash_password(password, iterations=PBKDF2_ITERATIONS):
+	"""
+	Hashes a password for api_keys.json, i.e. python auth.py <password>.
+
+	:return: "pbkdf2_sha256$iterations$salt$hash", with the salt and hash base64 encoded.
+	"""
+	salt = secrets.token_bytes(16)
+	digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+	return "$".join([PBKDF2_PREFIX, str(iterations), base64.b64encode(salt).decode("ascii"),
+					 base64.b64encode(digest).decode("ascii")])
+
+
+def _b64encode(data):
+	return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+	return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+
+class Authenticator:
+	"""
+	Encapsulates API authentication: Basic credentials checked against api_keys.json (reloaded when
+	the file changes, passwords only kept hashed and compared in constant time, verified credentials
+	cached) and short-lived signed bearer tokens verified without any lookup.
+	"""
+
+	def __init__(self, keys_path, token_secret=None, token_ttl=TOKEN_TTL, cache_ttl=CACHE_TTL,
+				 reload_interval=RELOAD_INTERVAL):
+		"""
+		:param keys_path: Path of the key file, a json dict of username to password (or password hash).
+		:param token_secret: Secret that signs bearer tokens, a random one (tokens don't outlive the
+							 process) when None.
+		:param token_ttl: Default lifetime of a bearer token in seconds.
+		:param cache_ttl: Seconds verified credentials are cached.
+		:param reload_interval: Seconds between checks of the key file for changes.
+		"""
+		self.keys_path = keys_path
+		if token_secret is None:
+			logger.warning("No token secret configured, bearer tokens won't survive a restart.")
+			token_secret = secrets.token_bytes(32)
+		self.token_secret = token_secret.encode("utf-8") if isinstance(token_secret, str) else token_secret
+		self.token_ttl = token_ttl
+		self.cache_ttl = cache_ttl
+		self.reload_interval = reload_interval
+		# plain passwords are only kept as an HMAC under this per-process key
+		self.pepper = secrets.token_bytes(32)
+		# unknown usernames are hashed against this salt, the same PBKDF2 work as a hashed password
+		self.dummy_salt = secrets.token_bytes(16)
+		self.credentials = {}
+		self.key_versions = {}
+		self.file_version = None
+		# incremented on every load, cached credentials are only valid for the generation they were verified in
+		self.generation = 0
+		self.checked_at = 0.0
+		self.cache = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.metrics = {"verified": 0, "cache_hits": 0, "failed": 0, "tokens_issued": 0, "token_verified": 0,
+						"reloads": 0}
+		self._load()
+
+
+	def _load(self):
+		stat = os.stat(self.keys_path)
+		with open(self.keys_path, encoding="utf8") as json_data:
+			users = json.load(json_data)
+		credentials = {}
+		key_versions = {}
+		for username, secret in users.items():
+			# changes whenever the user's password does, so it revokes the user's tokens, and stays the
+			# same across restarts
+			key_versions[username] = hmac.new(self.token_secret, str(secret).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+			if isinstance(secret, str) and secret.startswith(PBKDF2_PREFIX + "$"):
+				prefix, iterations, salt, digest = secret.split("$")
+				credentials[username] = ("pbkdf2", int(iterations), base64.b64decode(salt), base64.b64decode(digest))
+			else:
+				credentials[username] = ("hmac", self._hmac(str(secret)))
+		with self.lock:
+			self.credentials = credentials
+			self.key_versions = key_versions
+			self.file_version = (stat.st_mtime_ns, stat.st_size)
+			# removed users and changed passwords must not stay valid through the cache
+			self.generation += 1
+			self.cache.clear()
+			self.metrics["reloads"] += 1
+		logger.info("Loaded %s API users from %s.", len(credentials), self.keys_path)
+
+
+	def reload_if_changed(self):
+		"""
+		Reloads the key file when it changed since it was loaded, checking at most every
+		reload_interval seconds. A file that can't be read or parsed keeps the current keys.
+		"""
+		now = time.monotonic()
+		with self.lock:
+			if now - self.checked_at < self.reload_interval:
+				return
+			self.checked_at = now
+			file_version = self.file_version
+		try:
+			stat = os.stat(self.keys_path)
+			if (stat.st_mtime_ns, stat.st_size) != file_version:
+				self._load()
+		except (OSError, ValueError):
+			logger.exception("Couldn't reload %s, keeping the current keys.", self.keys_path)
+
+
+	def _hmac(self, text):
+		return hmac.new(self.pepper, text.encode("utf-8"), hashlib.sha256).digest()
+
+
+	def check_password(self, username, password):
+		"""
+		:return: True when the password is the user's, compared in constant time.
+		"""
+		self.reload_if_changed()
+		cache_key = self._hmac(username + "\0" + password)
+		now = time.monotonic()
+		with self.lock:
+			cached = self.cache.get(cache_key)
+			if cached is not None and cached[0] > now and cached[1] == self.generation:
+				self.metrics["cache_hits" if cached[2] else "failed"] += 1
+				return cached[2]
+			credential = self.credentials.get(username)
+			generation = self.generation
+		if credential is None:
+			# the same work as for a user with a hashed password, so response times don't tell which usernames exist
+			hmac.compare_digest(hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), self.dummy_salt, PBKDF2_ITERATIONS),
+								self.pepper)
+			valid = False
+		elif credential[0] == "pbkdf2":
+			algorithm, iterations, salt, digest = credential
+			valid = hmac.compare_digest(hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations), digest)
+		else:
+			valid = hmac.compare_digest(self._hmac(password), credential[1])
+		with self.lock:
+			self.metrics["verified" if valid else "failed"] += 1
+			# not cached when the keys were reloaded during the check, it was against the old credential
+			if generation == self.generation:
+				self.cache[cache_key] = (now + (self.cache_ttl if valid else FAILED_CACHE_TTL), generation, valid)
+				self.cache.move_to_end(cache_key)
+				while len(self.cache) > MAX_CACHED_CREDENTIALS:
+					self.cache.popitem(last=False)
+		return valid
+
+
+	def issue_token(self, username, ttl=None):
+		"""
+		Issues a signed bearer token for a user.
+
+		:param username: The user, already authenticated.
+		:param ttl: Lifetime in seconds, the default token_ttl when None, at most MAX_TOKEN_TTL.
+		:return: (token, lifetime in seconds).
+		"""
+		ttl = max(1, min(int(ttl or self.token_ttl), MAX_TOKEN_TTL))
+		payload = {"sub": username, "exp": int(time.time()) + ttl, "kv": self.key_versions.get(username)}
+		body = TOKEN_VERSION + "." + _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+		signature = hmac.new(self.token_secret, body.encode("ascii"), hashlib.sha256).digest()
+		with self.lock:
+			self.metrics["tokens_issued"] += 1
+		return body + "." + _b64encode(signature), ttl
+
+
+	def verify_token(self, token):
+		"""
+		:return: The user of a valid, unexpired token, None otherwise.
+		"""
+		try:
+			version, payload, signature = token.split(".")
+			if version != TOKEN_VERSION:
+				return None
+			expected = hmac.new(self.token_secret, (version + "." + payload).encode("ascii"), hashlib.sha256).digest()
+			if not hmac.compare_digest(expected, _b64decode(signature)):
+				return None
+			claims = json.loads(_b64decode(payload))
+		except (ValueError, UnicodeError):
+			return None
+		if not isinstance(claims, dict) or not isinstance(claims.get("exp"), int) or claims["exp"] < time.time():
+			return None
+		self.reload_if_changed()
+		if claims.get("kv") is None or claims.get("kv") != self.key_versions.get(claims.get("sub")):
+			return None
+		with self.lock:
+			self.metrics["token_verified"] += 1
+		return claims["sub"]
+
+
+	def authenticate(self, authorization):
+		"""
+		:param authorization: The Authorization header, "Basic <base64 user:password>" or "Bearer <token>".
+		:return: (username, scheme) of valid credentials, (None, scheme) otherwise.
+		"""
+		scheme, _, value = (authorization or "").strip().partition(" ")
+		scheme = scheme.lower()
+		if scheme == "bearer":
+			return self.verify_token(value.strip()), scheme
+		try:
+			username, password = base64.b64decode(value.strip()).decode("utf-8").split(":", 1)
+		except (ValueError, UnicodeError):
+			return None, scheme
+		return (username if self.check_password(username, password) else None), scheme
+
+
+	def claimed_user(self):
+		"""
+		:return: The user the credentials of the current request claim to be, without checking the password
+				 (bearer tokens are checked, it costs one HMAC), None when it has no credentials.
+		"""
+		authorization = request.headers.get("Authorization")
+		if not authorization:
+			return None
+		scheme, _, value = authorization.strip().partition(" ")
+		if scheme.lower() == "bearer":
+			return self.current_user()
+		try:
+			return base64.b64decode(value.strip()).decode("utf-8").split(":", 1)[0] or None
+		except (ValueError, UnicodeError):
+			return None
+
+
+	def current_user(self):
+		"""
+		:return: The authenticated user of the current request, None when it has no valid
+				 credentials. Checked once per request.
+		"""
+		if "api_auth" not in g:
+			authorization = request.headers.get("Authorization")
+			g.api_auth = self.authenticate(authorization) if authorization else (None, None)
+		return g.api_auth[0]
+
+
+	def current_scheme(self):
+		"""
+		:return: "basic" or "bearer", the scheme the current request authenticated with.
+		"""
+		self.current_user()
+		return g.api_auth[1]
+
+
+	def required(self, function):
+		"""
+		Decorator for a Resource method that answers 401 without an Authorization header and 403
+		when its credentials aren't valid.
+		"""
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not request.headers.get("Authorization"):
+				return {"message": "Missing authorization header"}, 401
+			if self.current_user() is None:
+				return {"message": "Authentication failed"}, 403
+			return function(*args, **kwargs)
+
+		return wrapper
+
+
+	def stats(self):
+		"""
+		:return: Dict of passwords verified / served from the cache / failed, tokens issued and
+				 verified, key file reloads and users loaded.
+		"""
+		with self.lock:
+			stats = dict(self.metrics)
+			stats["users"] = len(self.credentials)
+			stats["cached_credentials"] = len(self.cache)
+		return stats
+
+
+
+if __name__ == "__main__":
+	print(hash_password(sys.argv[1]))
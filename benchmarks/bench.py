@@ -0,0 +1,286 @@
+"""
+Benchmarks the API routes against local stand-ins of Datastore, Cloud Storage and SES (see fakes.py),
+through Flask's test client, so no GCP or AWS account is needed and runs are comparable.
+
+	python benchmarks/bench.py
+	python benchmarks/bench.py --scenarios read_query_1000,create_large --requests 2000 --concurrency 16
+	python benchmarks/bench.py --datastore-latency-ms 8 --ses-latency-ms 40 --output before.json
+	python benchmarks/bench.py --baseline before.json     (exits with 1 when a scenario regressed)
+
+Every scenario reports requests per second and p50 / p95 / p99 latency in milliseconds. With
+DATASTORE_EMULATOR_HOST set and --datastore-emulator, the Datastore emulator is used instead of
+the in-memory fake.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import fakes
+
+
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+KIND_ID = "client000000001"
+# result set sizes of the read_query scenarios and property counts of the create payloads
+RESULT_SET_SIZES = (10, 100, 1000)
+SMALL_PAYLOAD_FIELDS = 5
+LARGE_PAYLOAD_FIELDS = 200
+# size of the file attached by the sendemail_attachment scenario
+ATTACHMENT_BYTES = 1024 * 1024
+# a scenario regressed when its p95 grew, or its requests per second dropped, by more than this
+REGRESSION_TOLERANCE = 0.15
+
+
+def load_app(args):
+	"""
+	Imports main.py with its backend clients replaced by the stand-ins, from a scratch directory
+	holding the api_keys.json / SES credential files main.py reads at import.
+
+	:return: (the main module, the fake datastore client, the fake SES client).
+	"""
+	work_directory = tempfile.mkdtemp(prefix="api-benchmark-")
+	with open(os.path.join(work_directory, "api_keys.json"), "w", encoding="utf8") as keys_file:
+		json.dump({USERNAME: PASSWORD}, keys_file)
+	with open(os.path.join(work_directory, "INSERT AWS SES CREDS FILE"), "w", encoding="utf8") as credentials_file:
+		credentials_file.write("IAM User Name,Smtp Username,Smtp Password\nbenchmark,AKIABENCHMARK,benchmark\n")
+	if args.api_config:
+		with open(args.api_config, encoding="utf8") as source, open(os.path.join(work_directory, "api_config.json"), "w", encoding="utf8") as target:
+			target.write(source.read())
+	os.chdir(work_directory)
+	sys.path.insert(0, REPO_DIRECTORY)
+
+	datastore_latency = fakes.Latency(args.datastore_latency_ms, args.jitter_ms, seed=args.seed)
+	if args.datastore_emulator:
+		from google.auth.credentials import AnonymousCredentials
+		from google.cloud import datastore
+		datastore_client = datastore.Client(project="benchmark", credentials=AnonymousCredentials())
+	else:
+		datastore_client = fakes.FakeDatastoreClient(datastore_latency)
+	storage_client = fakes.FakeStorageClient(fakes.Latency(args.gcs_latency_ms, args.jitter_ms, seed=args.seed + 1))
+	ses_client = fakes.FakeSesClient(fakes.Latency(args.ses_latency_ms, args.jitter_ms, seed=args.seed + 2))
+	with mock.patch("google.oauth2.service_account.Credentials.from_service_account_file", return_value=None), \
+		 mock.patch("google.cloud.datastore.Client", return_value=datastore_client), \
+		 mock.patch("google.cloud.storage.Client", return_value=storage_client), \
+		 mock.patch("boto3.client", return_value=ses_client):
+		import main
+	return main, datastore_client, ses_client
+
+
+
+class Scenario:
+	"""
+	One benchmarked route: the data it needs seeded, and the request it sends.
+	"""
+
+	def __init__(self, name, route, payload, seed=None, form=False):
+		"""
+		:param name: Scenario name used in the report.
+		:param route: The API route.
+		:param payload: Function of the request number returning the request body.
+		:param seed: Function seeding the data the scenario reads, called with the main module.
+		:param form: True to send the body as form data instead of json.
+		"""
+		self.name = name
+		self.route = route
+		self.payload = payload
+		self.seed = seed
+		self.form = form
+
+
+
+def seed_entities(object_type, count):
+	def seed(main):
+		main.create_data_bulk(KIND_ID, [{"key_id": "%s%09d" % (object_type, number),
+										 "data": record(object_type, number, SMALL_PAYLOAD_FIELDS)} for number in range(count)])
+	return seed
+
+
+def seed_attachment(main):
+	bucket = main.storage_client.bucket(KIND_ID)
+	if KIND_ID not in main.storage_client.buckets:
+		main.storage_client.create_bucket(bucket)
+	bucket.blob("invoices/invoice.pdf").upload_from_string(b"%PDF-1.4 " + b"0" * ATTACHMENT_BYTES)
+
+
+def record(object_type, number, fields):
+	data = {"object_type": object_type, "status": "open" if number % 3 else "closed", "priority": number % 5}
+	for field in range(fields):
+		data["field%03d" % field] = "value %s of record %s" % (field, number)
+	return data
+
+
+def scenarios():
+	"""
+	:return: Dict of every scenario by name.
+	"""
+	all_scenarios = [
+		Scenario("read_key", "/api/v1/read", lambda n: {"kind_id": KIND_ID, "key_id": "customer%09d" % (n % 100)},
+				 seed=seed_entities("customer", 100)),
+	]
+	all_scenarios.append(Scenario("read_batch_get_100", "/api/v1/read",
+								  lambda n: {"kind_id": KIND_ID, "key_ids": ["customer%09d" % number for number in range(100)],
+											 "read_consistency": "eventual"},
+								  seed=seed_entities("customer", 100)))
+	for size in RESULT_SET_SIZES:
+		all_scenarios.append(Scenario("read_query_%s" % size, "/api/v1/read",
+									  lambda n, size=size: {"kind_id": KIND_ID, "object_type": "case%s" % size},
+									  seed=seed_entities("case%s" % size, size)))
+	all_scenarios += [
+		Scenario("create_small", "/api/v1/create", lambda n: {"kind_id": KIND_ID, "data": record("note", n, SMALL_PAYLOAD_FIELDS)}),
+		Scenario("create_large", "/api/v1/create", lambda n: {"kind_id": KIND_ID, "data": record("note", n, LARGE_PAYLOAD_FIELDS)}),
+		Scenario("update", "/api/v1/update",
+				 lambda n: {"kind_id": KIND_ID, "key_id": "customer%09d" % (n % 100), "data": {"status": "open", "touched": n}},
+				 seed=seed_entities("customer", 100)),
+		Scenario("sendemail", "/api/v1/sendemail",
+				 lambda n: {"sender": "noreply@example.com", "recipients": ["customer%s@example.com" % n], "subject": "Benchmark",
+							"body_html": "<p>Benchmark %s</p>" % n, "body_text": "Benchmark %s" % n}),
+		Scenario("sendemail_attachment", "/api/v1/sendemail",
+				 lambda n: {"sender": "noreply@example.com", "recipients": ["customer%s@example.com" % n], "subject": "Invoice",
+							"body_html": "<p>Invoice %s</p>" % n, "body_text": "Invoice %s" % n, "kind_id": KIND_ID,
+							"attachments": [{"object_folder_name": "invoices", "file_name": "invoice.pdf"}]},
+				 seed=seed_attachment),
+		Scenario("signed_url", "/api/v1/getsignedurl",
+				 lambda n: {"kind_id": KIND_ID, "object_folder_name": "invoices", "file_name": "invoice%s.pdf" % n}, form=True),
+	]
+	return {scenario.name: scenario for scenario in all_scenarios}
+
+
+def percentile(sorted_values, fraction):
+	"""
+	:return: The nearest-rank percentile of already sorted values.
+	"""
+	if not sorted_values:
+		return 0.0
+	index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+	return sorted_values[index]
+
+
+def run_scenario(app, scenario, requests, concurrency, warmup):
+	"""
+	Sends requests to a scenario's route from concurrency threads, after warmup untimed requests.
+
+	:return: Dict of the scenario results: requests, errors, rps and p50 / p95 / p99 / max in ms.
+	"""
+	headers = {"Authorization": "Basic " + base64.b64encode(("%s:%s" % (USERNAME, PASSWORD)).encode("utf-8")).decode("ascii")}
+	counter_lock = threading.Lock()
+	latencies = []
+	errors = []
+
+	def send(client, number):
+		body = scenario.payload(number)
+		if scenario.form:
+			return client.post(scenario.route, data=body, headers=headers)
+		return client.post(scenario.route, json=body, headers=headers)
+
+	with app.test_client() as client:
+		for number in range(warmup):
+			send(client, number)
+
+	def worker():
+		with app.test_client() as client:
+			while True:
+				with counter_lock:
+					number = next(counter, None)
+				if number is None:
+					return
+				start_time = time.perf_counter()
+				response = send(client, number + warmup)
+				elapsed = time.perf_counter() - start_time
+				with counter_lock:
+					latencies.append(elapsed * 1000)
+					if response.status_code >= 400:
+						errors.append(response.status_code)
+
+	counter = iter(range(requests))
+	threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+	start_time = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	wall_time = time.perf_counter() - start_time
+	latencies.sort()
+	return {
+		"requests": requests,
+		"errors": len(errors),
+		"rps": round(requests / wall_time, 1),
+		"p50_ms": round(percentile(latencies, 0.50), 2),
+		"p95_ms": round(percentile(latencies, 0.95), 2),
+		"p99_ms": round(percentile(latencies, 0.99), 2),
+		"max_ms": round(latencies[-1], 2) if latencies else 0.0,
+	}
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+	"""
+	:return: List of regression messages, one per scenario slower than in the baseline.
+	"""
+	regressions = []
+	for name, result in results.items():
+		before = baseline.get("results", {}).get(name)
+		if before is None:
+			continue
+		if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+			regressions.append("%s: p95 %.2fms -> %.2fms" % (name, before["p95_ms"], result["p95_ms"]))
+		if result["rps"] < before["rps"] * (1 - tolerance):
+			regressions.append("%s: %.1f -> %.1f requests per second" % (name, before["rps"], result["rps"]))
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmarks the API routes against local backend stand-ins.")
+	available = scenarios()
+	parser.add_argument("--scenarios", default=",".join(available), help="comma separated, one of: " + ", ".join(available))
+	parser.add_argument("--requests", type=int, default=500, help="timed requests per scenario")
+	parser.add_argument("--warmup", type=int, default=50, help="untimed requests sent first")
+	parser.add_argument("--concurrency", type=int, default=8, help="threads sending requests")
+	parser.add_argument("--datastore-latency-ms", type=float, default=5.0)
+	parser.add_argument("--gcs-latency-ms", type=float, default=20.0)
+	parser.add_argument("--ses-latency-ms", type=float, default=30.0)
+	parser.add_argument("--jitter-ms", type=float, default=0.0, help="up to this much extra latency per backend call")
+	parser.add_argument("--seed", type=int, default=1, help="seed of the latency jitter")
+	parser.add_argument("--datastore-emulator", action="store_true", help="use the emulator at DATASTORE_EMULATOR_HOST")
+	parser.add_argument("--api-config", help="api_config.json to run with")
+	parser.add_argument("--output", help="write the results to this json file")
+	parser.add_argument("--baseline", help="results json of an earlier run to compare with")
+	args = parser.parse_args(argv)
+	output = os.path.abspath(args.output) if args.output else None
+	baseline = None
+	if args.baseline:
+		with open(args.baseline, encoding="utf8") as baseline_file:
+			baseline = json.load(baseline_file)
+	args.api_config = os.path.abspath(args.api_config) if args.api_config else None
+
+	main_module, datastore_client, ses_client = load_app(args)
+	results = {}
+	print("%-16s %8s %7s %9s %9s %9s %9s" % ("scenario", "rps", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+	for name in args.scenarios.split(","):
+		scenario = available[name.strip()]
+		if scenario.seed is not None:
+			scenario.seed(main_module)
+		result = run_scenario(main_module.app, scenario, args.requests, args.concurrency, args.warmup)
+		results[scenario.name] = result
+		print("%-16s %8.1f %7d %9.2f %9.2f %9.2f %9.2f" % (scenario.name, result["rps"], result["errors"], result["p50_ms"],
+														   result["p95_ms"], result["p99_ms"], result["max_ms"]))
+	report = {"settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}, "results": results}
+	if output:
+		with open(output, "w", encoding="utf8") as output_file:
+			json.dump(report, output_file, indent=2)
+	if baseline is not None:
+		regressions = compare(results, baseline)
+		for regression in regressions:
+			print("REGRESSION " + regression)
+		return 1 if regressions else 0
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,510 @@
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter, Or
+from google.api_core.exceptions import Conflict, NotFound
+import collections
+import copy
+import io
+import itertools
+import random
+import threading
+import time
+import uuid
+
+
+
+# the in-memory stand-ins for Datastore, Cloud Storage and SES the benchmarks run the API against,
+# each call waits an injected latency so results resemble a real backend without any network
+
+
+class Latency:
+	"""
+	Injected backend latency: every call waits mean_ms plus up to jitter_ms, drawn from a seeded
+	random generator so runs are comparable.
+	"""
+
+	def __init__(self, mean_ms=0.0, jitter_ms=0.0, seed=0):
+		"""
+		:param mean_ms: Milliseconds every call waits.
+		:param jitter_ms: Up to this many more milliseconds, uniformly distributed.
+		:param seed: Seed of the jitter.
+		"""
+		self.mean_ms = mean_ms
+		self.jitter_ms = jitter_ms
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.calls = 0
+
+
+	def wait(self):
+		with self.lock:
+			self.calls += 1
+			jitter = self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+		if self.mean_ms or jitter:
+			time.sleep((self.mean_ms + jitter) / 1000)
+
+
+
+class FakeDatastoreClient:
+	"""
+	In-memory stand-in for datastore.Client covering what main.py uses: keys, lookups, writes,
+	id allocation, queries (property / key / AND / OR filters, order, limit), aggregation
+	queries and transactions (serialized, committed as they go).
+	"""
+
+	def __init__(self, latency, project="benchmark"):
+		self.latency = latency
+		self.project = project
+		self.namespace = None
+		self.entities = {}
+		self.ids = itertools.count(1 << 20)
+		# held by a transaction for its whole duration, so transactions are serializable
+		self.lock = threading.RLock()
+
+
+	def key(self, *path_args, **kwargs):
+		kwargs.setdefault("project", self.project)
+		return datastore.Key(*path_args, **kwargs)
+
+
+	def _copy(self, entity):
+		if entity is None:
+			return None
+		copied = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+		copied.update(copy.deepcopy(dict(entity)))
+		return copied
+
+
+	def get(self, key, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			return self._copy(self.entities.get(key.flat_path))
+
+
+	def get_multi(self, keys, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			return [self._copy(self.entities[key.flat_path]) for key in keys if key.flat_path in self.entities]
+
+
+	def put(self, entity, timeout=None, **kwargs):
+		self.put_multi([entity])
+
+
+	def put_multi(self, entities, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			for entity in entities:
+				if entity.key.is_partial:
+					entity.key = entity.key.completed_key(next(self.ids))
+				self.entities[entity.key.flat_path] = self._copy(entity)
+
+
+	def delete(self, key, timeout=None, **kwargs):
+		self.delete_multi([key])
+
+
+	def delete_multi(self, keys, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			for key in keys:
+				self.entities.pop(key.flat_path, None)
+
+
+	def allocate_ids(self, incomplete_key, num_ids, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			return [incomplete_key.completed_key(next(self.ids)) for _ in range(num_ids)]
+
+
+	def query(self, kind=None, **kwargs):
+		return FakeQuery(self, kind)
+
+
+	def aggregation_query(self, query, **kwargs):
+		return FakeAggregationQuery(self, query)
+
+
+	def transaction(self, **kwargs):
+		return FakeTransaction(self)
+
+
+
+class FakeTransaction:
+
+	def __init__(self, client):
+		self.client = client
+
+	def begin(self, timeout=None, **kwargs):
+		self.client.latency.wait()
+
+	def commit(self, timeout=None, **kwargs):
+		self.client.latency.wait()
+
+	def rollback(self, timeout=None, **kwargs):
+		self.client.latency.wait()
+
+	def __enter__(self):
+		self.client.lock.acquire()
+		self.begin()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		try:
+			if exc_type is None:
+				self.commit()
+			else:
+				self.rollback()
+		finally:
+			self.client.lock.release()
+
+
+
+def _values(entity, name):
+	if name == "__key__":
+		return [entity.key]
+	value = entity.get(name)
+	# list properties match when any of their values does, like in datastore
+	return value if isinstance(value, list) else [value]
+
+
+def _compare(left, operator, right):
+	try:
+		if operator == "=":
+			return left == right
+		if operator == "!=":
+			return left != right
+		if operator == "<":
+			return left < right
+		if operator == "<=":
+			return left <= right
+		if operator == ">":
+			return left > right
+		if operator == ">=":
+			return left >= right
+		if operator == "IN":
+			return left in right
+		if operator == "NOT_IN":
+			return left not in right
+	except TypeError:
+		return False
+	raise ValueError("Unsupported operator " + str(operator))
+
+
+def _matches(entity, query_filter):
+	if isinstance(query_filter, tuple):
+		name, operator, value = query_filter
+	elif isinstance(query_filter, PropertyFilter):
+		name, operator, value = query_filter.property_name, query_filter.operator, query_filter.value
+	else:
+		results = (_matches(entity, sub_filter) for sub_filter in query_filter.filters)
+		return any(results) if isinstance(query_filter, Or) else all(results)
+	if name not in entity and name != "__key__":
+		return False
+	return any(_compare(item, operator, value) for item in _values(entity, name))
+
+
+
+class FakeQuery:
+
+	def __init__(self, client, kind):
+		self.client = client
+		self.kind = kind
+		self.filters = []
+		self.order = []
+
+	def key_filter(self, key, operator="="):
+		self.filters.append(("__key__", operator, key))
+		return self
+
+	def add_filter(self, property_name=None, operator=None, value=None, filter=None):
+		self.filters.append(filter if filter is not None else (property_name, operator, value))
+		return self
+
+	def keys_only(self):
+		# the whole entities are returned, they have their key too
+		return self
+
+	def _results(self):
+		self.client.latency.wait()
+		with self.client.lock:
+			entities = [entity for path, entity in self.client.entities.items()
+						if path[0] == self.kind and len(path) == 2 and all(_matches(entity, f) for f in self.filters)]
+			entities = [self.client._copy(entity) for entity in entities]
+		for order in reversed(self.order):
+			name = order.lstrip("-")
+			entities = [entity for entity in entities if name in entity]
+			entities.sort(key=lambda entity: (entity[name] is None, entity[name]), reverse=order.startswith("-"))
+		return entities
+
+	def fetch(self, limit=None, timeout=None, start_cursor=None, **kwargs):
+		return FakeIterator(self._results(), limit, start_cursor)
+
+
+
+class FakeIterator:
+	"""
+	Query results with cursor paging: the cursor is the offset into the results, next_page_token is
+	set once the iterator stopped at its limit, None when the results ran out.
+	"""
+
+	def __init__(self, results, limit, start_cursor):
+		offset = int(start_cursor) if start_cursor else 0
+		end = len(results) if limit is None else min(len(results), offset + limit)
+		self.items = iter(results[offset:end])
+		self.end = end
+		self.more = end < len(results)
+		self.next_page_token = None
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		try:
+			return next(self.items)
+		except StopIteration:
+			self.next_page_token = str(self.end).encode("ascii") if self.more else None
+			raise
+
+
+
+AggregationResult = collections.namedtuple("AggregationResult", ["alias", "value"])
+
+
+class FakeAggregationQuery:
+
+	def __init__(self, client, query):
+		self.client = client
+		self.query = query
+		self.aggregations = []
+
+	def count(self, alias=None):
+		self.aggregations.append(("count", None, alias))
+		return self
+
+	def sum(self, property_ref, alias=None):
+		self.aggregations.append(("sum", property_ref, alias))
+		return self
+
+	def avg(self, property_ref, alias=None):
+		self.aggregations.append(("avg", property_ref, alias))
+		return self
+
+	def fetch(self, limit=None, timeout=None, **kwargs):
+		entities = self.query._results()
+		results = []
+		for op, name, alias in self.aggregations:
+			numbers = [entity[name] for entity in entities if isinstance(entity.get(name), (int, float))] if name else []
+			if op == "count":
+				value = len(entities)
+			elif op == "sum":
+				value = sum(numbers)
+			else:
+				value = sum(numbers) / len(numbers) if numbers else None
+			results.append(AggregationResult(alias, value))
+		return iter([results])
+
+
+
+class FakeStorageClient:
+	"""
+	In-memory stand-in for storage.Client: buckets, object listings, streamed object uploads /
+	downloads (blob.open) and locally "signed" URLs.
+	"""
+
+	def __init__(self, latency):
+		self.latency = latency
+		self.buckets = {}
+		self.lock = threading.Lock()
+
+
+	def bucket(self, bucket_name):
+		return FakeBucket(self, bucket_name)
+
+
+	def create_bucket(self, bucket, location=None, timeout=None, **kwargs):
+		self.latency.wait()
+		with self.lock:
+			if bucket.name in self.buckets:
+				raise Conflict("Bucket " + bucket.name + " already exists")
+			self.buckets[bucket.name] = {}
+		return bucket
+
+
+
+class FakeBucket:
+
+	def __init__(self, client, name):
+		self.client = client
+		self.name = name
+		self.cors = []
+
+	def blob(self, blob_name):
+		return FakeBlob(self, blob_name)
+
+	def patch(self, timeout=None, **kwargs):
+		self.client.latency.wait()
+
+	def objects(self):
+		with self.client.lock:
+			if self.name not in self.client.buckets:
+				raise NotFound("Bucket " + self.name + " not found")
+			return self.client.buckets[self.name]
+
+	def list_blobs(self, prefix=None, timeout=None, **kwargs):
+		self.client.latency.wait()
+		return [self.blob(name) for name in sorted(self.objects()) if name.startswith(prefix or "")]
+
+
+
+class FakeBlob:
+
+	def __init__(self, bucket, name):
+		self.bucket = bucket
+		self.name = name
+
+	@property
+	def size(self):
+		data = self.bucket.objects().get(self.name)
+		return len(data) if data is not None else None
+
+	@property
+	def content_type(self):
+		# guessed from the name by the callers
+		return None
+
+	def reload(self, timeout=None, **kwargs):
+		self.bucket.client.latency.wait()
+		if self.name not in self.bucket.objects():
+			raise NotFound("Object " + self.name + " not found")
+
+	def open(self, mode="rb", chunk_size=None, timeout=None, **kwargs):
+		if mode == "rb":
+			self.reload()
+			return FakeBlobReader(self.bucket.objects()[self.name])
+		if mode == "wb":
+			return FakeBlobWriter(self)
+		raise ValueError("Unsupported mode " + mode)
+
+	def upload_from_string(self, data, content_type=None, timeout=None, **kwargs):
+		self.bucket.client.latency.wait()
+		objects = self.bucket.objects()
+		with self.bucket.client.lock:
+			objects[self.name] = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+
+	def generate_signed_url(self, version="v4", expiration=None, method="GET", **kwargs):
+		# signed locally in the real client too, so no latency
+		return "https://storage.example/%s/%s?X-Goog-Signature=%s" % (self.bucket.name, self.name, uuid.uuid4().hex)
+
+
+
+class FakeBlobReader(io.BufferedIOBase):
+	# like the real BlobReader: no peek, so readline falls back to read(1) per byte
+
+	def __init__(self, data):
+		super().__init__()
+		self.data = data
+		self.position = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def read(self, size=-1):
+		end = len(self.data) if size is None or size < 0 else self.position + size
+		result = self.data[self.position:end]
+		self.position += len(result)
+		return result
+
+	def read1(self, size=-1):
+		return self.read(size)
+
+	def seek(self, position, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			position += self.position
+		elif whence == io.SEEK_END:
+			position += len(self.data)
+		self.position = max(0, position)
+		return self.position
+
+	def tell(self):
+		return self.position
+
+
+
+class FakeBlobWriter(io.BytesIO):
+	# the object is stored when the writer is closed, like the upload of the real BlobWriter finishes
+
+	def __init__(self, blob):
+		super().__init__()
+		self.blob = blob
+
+	def close(self):
+		if not self.closed:
+			self.blob.upload_from_string(self.getvalue())
+		super().close()
+
+
+
+class FakeSesClient:
+	"""
+	In-memory stand-in for the boto3 SES client (like moto's SES mock): emails are counted, not sent,
+	and templates are kept in memory.
+	"""
+
+	def __init__(self, latency):
+		self.latency = latency
+		self.templates = {}
+		self.sent = 0
+		self.lock = threading.Lock()
+
+
+	def _response(self, **fields):
+		fields["ResponseMetadata"] = {"HTTPStatusCode": 200, "RequestId": uuid.uuid4().hex}
+		return fields
+
+
+	def _send(self):
+		self.latency.wait()
+		with self.lock:
+			self.sent += 1
+		return self._response(MessageId=uuid.uuid4().hex)
+
+
+	def send_email(self, **kwargs):
+		return self._send()
+
+
+	def send_templated_email(self, **kwargs):
+		return self._send()
+
+
+	def send_raw_email(self, **kwargs):
+		return self._send()
+
+
+	def create_template(self, Template, **kwargs):
+		self.latency.wait()
+		self.templates[Template["TemplateName"]] = Template
+		return self._response()
+
+
+	def update_template(self, Template, **kwargs):
+		return self.create_template(Template)
+
+
+	def get_template(self, TemplateName, **kwargs):
+		self.latency.wait()
+		return self._response(Template=self.templates[TemplateName])
+
+
+	def delete_template(self, TemplateName, **kwargs):
+		self.latency.wait()
+		self.templates.pop(TemplateName, None)
+		return self._response()
+
+
+	def list_templates(self, **kwargs):
+		self.latency.wait()
+		return self._response(TemplatesMetadata=[{"Name": name} for name in self.templates])
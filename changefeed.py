@@ -0,0 +1,175 @@
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter
+from datetime import datetime, timedelta, timezone
+import base64
+import heapq
+import itertools
+import json
+import logging
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# properties stamped on every written entity, and on the tombstones deletes leave behind
+UPDATED_AT = "updated_at"
+VERSION = "version"
+DELETED_AT = "deleted_at"
+# tombstones carry an expire_at this far in the future, a datastore TTL policy on expire_at deletes them
+TOMBSTONE_TTL = timedelta(days=30)
+# changes younger than this aren't returned yet: a write is stamped before it commits, so a slow commit
+# (or a clock a little behind on another instance) could otherwise land behind a token already handed out
+SETTLE_SECONDS = 2
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_microseconds(value):
+	"""
+	:param value: A datetime, naive ones are taken as UTC.
+	:return: Microseconds since the epoch.
+	"""
+	if value.tzinfo is None:
+		value = value.replace(tzinfo=timezone.utc)
+	return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _key_order(key_id):
+	# datastore sorts numeric ids before names
+	return (0, key_id) if isinstance(key_id, int) else (1, str(key_id))
+
+
+def encode_token(position):
+	"""
+	:param position: (microseconds, 0 for an entity / 1 for a tombstone, key order) of the last change returned.
+	:return: The opaque token the client sends back to get the changes after it.
+	"""
+	microseconds, deleted, key_order = position
+	data = json.dumps({"t": microseconds, "d": deleted, "k": list(key_order)}, separators=(",", ":"))
+	return base64.urlsafe_b64encode(data.encode("utf-8")).rstrip(b"=").decode("ascii")
+
+
+def decode_token(token):
+	"""
+	:return: The position encoded in a token, None for no token (every change).
+	:raises ValueError: The token wasn't issued by encode_token.
+	"""
+	if not token:
+		return None
+	try:
+		data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+		key_type, key_id = data["k"]
+		if key_type not in (0, 1) or data["d"] not in (0, 1) or not isinstance(data["t"], int):
+			raise ValueError
+		return (data["t"], data["d"], (key_type, int(key_id) if key_type == 0 else str(key_id)))
+	except (ValueError, TypeError, KeyError, UnicodeError):
+		raise ValueError("Invalid change token " + str(token))
+
+
+
+class ChangeFeed:
+	"""
+	Encapsulates the change feed of a kind: every write stamps updated_at and version on the entity,
+	every delete leaves a tombstone, and the changes after a token are read back in updated_at order
+	from the two (merged) updated_at queries.
+	"""
+
+	def __init__(self, datastore_client, tombstone_ttl=TOMBSTONE_TTL, settle_seconds=SETTLE_SECONDS):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		:param tombstone_ttl: Timedelta tombstones are kept for (by a datastore TTL policy on expire_at).
+		:param settle_seconds: Changes younger than this many seconds are held back.
+		"""
+		self.datastore_client = datastore_client
+		self.tombstone_ttl = tombstone_ttl
+		self.settle_seconds = settle_seconds
+
+
+	@staticmethod
+	def tombstone_kind(kind_id):
+		"""
+		:return: The kind holding the tombstones of kind_id.
+		"""
+		return kind_id + "__tombstones"
+
+
+	@staticmethod
+	def now():
+		return datetime.now(timezone.utc)
+
+
+	def stamp(self, task, old_task=None, now=None):
+		"""
+		Stamps an entity about to be written with the time of the write and its version.
+
+		:param task: The entity (or dict), changed in place.
+		:param old_task: The entity it replaces, None for a new entity (version 1).
+		:param now: The time of the write, the current time when None.
+		:return: The entity.
+		"""
+		old_version = old_task.get(VERSION) if old_task is not None else None
+		task[VERSION] = (old_version if isinstance(old_version, int) else 0) + 1
+		task[UPDATED_AT] = now or self.now()
+		return task
+
+
+	def tombstone(self, kind_id, key_id, now=None):
+		"""
+		Builds the tombstone of a deleted entity, to put in the same transaction as the delete.
+
+		:return: The tombstone entity, keyed like the deleted entity in the tombstone kind.
+		"""
+		now = now or self.now()
+		tombstone = datastore.Entity(key=self.datastore_client.key(self.tombstone_kind(kind_id), key_id),
+									 exclude_from_indexes=("expire_at",))
+		tombstone[DELETED_AT] = now
+		tombstone["expire_at"] = now + self.tombstone_ttl
+		return tombstone
+
+
+	def _stream(self, kind, time_property, position, cutoff, deleted, object_type=None):
+		# the position is >= so changes of the same microsecond past the key of the token aren't lost,
+		# the ones up to it are skipped here
+		query = self.datastore_client.query(kind=kind)
+		if object_type is not None:
+			query.add_filter(filter=PropertyFilter("object_type", "=", object_type))
+		if position is not None:
+			query.add_filter(filter=PropertyFilter(time_property, ">=", EPOCH + timedelta(microseconds=position[0])))
+		query.add_filter(filter=PropertyFilter(time_property, "<", cutoff))
+		query.order = [time_property]
+		for entity in query.fetch():
+			entity_position = (to_microseconds(entity[time_property]), deleted, _key_order(entity.key.id_or_name))
+			if position is not None and entity_position <= position:
+				continue
+			yield entity_position, entity
+
+
+	def changes(self, kind_id, token=None, limit=PAGE_SIZE, object_type=None):
+		"""
+		Reads the changes of a kind after a token, oldest first.
+
+		:param kind_id: The kind.
+		:param token: A token returned by an earlier call, None for every change still known.
+		:param limit: Most changes returned, at most MAX_PAGE_SIZE.
+		:param object_type: Only the entities of this object_type (tombstones are returned for every
+							object_type, a delete doesn't read the entity it deletes).
+		:return: (list of (entity, deleted), next token, True when there are more changes).
+		:raises ValueError: The token is invalid, or older than the tombstones kept.
+		"""
+		position = decode_token(token)
+		if position is not None and position[0] < to_microseconds(self.now() - self.tombstone_ttl):
+			# deletes since then may already be gone with their expired tombstones
+			raise ValueError("Change token is older than the tombstones kept, read everything again")
+		limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+		cutoff = self.now() - timedelta(seconds=self.settle_seconds)
+		streams = heapq.merge(
+			self._stream(kind_id, UPDATED_AT, position, cutoff, 0, object_type),
+			self._stream(self.tombstone_kind(kind_id), DELETED_AT, position, cutoff, 1),
+			key=lambda item: item[0])
+		page = list(itertools.islice(streams, limit + 1))
+		has_more = len(page) > limit
+		page = page[:limit]
+		next_token = encode_token(page[-1][0]) if page else token
+		return [(entity, bool(deleted)) for (microseconds, deleted, key_order), entity in page], next_token, has_more
@@ -0,0 +1,394 @@
+from google.api_core.exceptions import ServerError, TooManyRequests, RetryError
+from botocore.exceptions import BotoCoreError, ClientError
+from werkzeug.exceptions import ServiceUnavailable
+import functools
+import logging
+import math
+import requests
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# a backend's breaker opens after FAILURE_THRESHOLD failed calls in a row, rejects every call for
+# RESET_TIMEOUT seconds, then lets HALF_OPEN_CALLS probe calls through to test for recovery
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+HALF_OPEN_CALLS = 1
+# AWS error codes that mean the service is struggling rather than the request being wrong
+AWS_UNAVAILABLE_CODES = ("Throttling", "ThrottlingException", "ServiceUnavailable", "RequestTimeout")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def google_failure(exception):
+	"""
+	:return: True when a Google Cloud (Datastore / GCS) error means the backend is unhealthy: server
+			 errors, throttling, exhausted retries, timeouts and connection errors.
+	"""
+	return isinstance(exception, (ServerError, TooManyRequests, RetryError, requests.exceptions.ConnectionError,
+								  requests.exceptions.Timeout))
+
+
+def aws_failure(exception):
+	"""
+	:return: True when an AWS (SES) error means the backend is unhealthy: timeouts, connection errors,
+			 throttling and 5xx responses.
+	"""
+	if isinstance(exception, BotoCoreError):
+		return True
+	if isinstance(exception, ClientError):
+		error = exception.response.get("Error", {})
+		status = exception.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+		return error.get("Code") in AWS_UNAVAILABLE_CODES or status >= 500
+	return False
+
+
+
+class CircuitOpenError(ServiceUnavailable):
+	"""
+	Raised instead of calling a backend whose breaker is open, answered with a 503 and Retry-After.
+	"""
+
+	def __init__(self, backend, retry_after):
+		super().__init__(description="%s is unavailable, retry after %s seconds" % (backend, retry_after),
+						 retry_after=retry_after)
+		self.backend = backend
+
+
+
+class CircuitBreaker:
+	"""
+	Encapsulates the health of one backend. Closed, calls go through and failures are counted;
+	open, calls fail fast with CircuitOpenError; half open, a few probe calls go through and the
+	first result closes or re-opens the breaker.
+	"""
+
+	def __init__(self, name, is_failure, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT,
+				 half_open_calls=HALF_OPEN_CALLS, observer=None):
+		"""
+		:param name: The backend name, used in errors and logs.
+		:param is_failure: Function telling if an exception raised by a call counts as a failure,
+						   other exceptions mean the backend answered.
+		:param failure_threshold: Number of failed calls in a row that opens the breaker.
+		:param reset_timeout: Seconds the breaker stays open before probing.
+		:param half_open_calls: Number of probe calls let through at once while half open.
+		:param observer: Called after every call let through with (operation, seconds, error, items),
+						 items being the number of entities a query returned (None for other calls).
+		"""
+		self.name = name
+		self.is_failure = is_failure
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.half_open_calls = half_open_calls
+		self.observer = observer
+		self.state = CLOSED
+		self.failures = 0
+		self.opened_at = 0.0
+		self.probes = 0
+		self.lock = threading.Lock()
+		self.metrics = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+
+	def before_call(self):
+		"""
+		Lets a call through, or raises CircuitOpenError. Every call let through must be followed by
+		record.
+		"""
+		with self.lock:
+			if self.state == OPEN:
+				remaining = self.opened_at + self.reset_timeout - time.monotonic()
+				if remaining > 0:
+					self.metrics["rejected"] += 1
+					raise CircuitOpenError(self.name, max(1, math.ceil(remaining)))
+				logger.info("Circuit breaker of %s is half open, probing.", self.name)
+				self.state = HALF_OPEN
+				self.probes = 0
+			if self.state == HALF_OPEN:
+				if self.probes >= self.half_open_calls:
+					self.metrics["rejected"] += 1
+					raise CircuitOpenError(self.name, 1)
+				self.probes += 1
+			self.metrics["calls"] += 1
+
+
+	def record(self, exception=None):
+		"""
+		Records the outcome of a call let through by before_call.
+
+		:param exception: The exception the call raised, None when it succeeded.
+		"""
+		failed = exception is not None and self.is_failure(exception)
+		with self.lock:
+			if self.state == HALF_OPEN:
+				self.probes = max(0, self.probes - 1)
+			if not failed:
+				if self.state != CLOSED:
+					logger.info("Circuit breaker of %s closed.", self.name)
+				self.state = CLOSED
+				self.failures = 0
+				return
+			self.metrics["failures"] += 1
+			self.failures += 1
+			if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+				if self.state != OPEN:
+					self.metrics["opened"] += 1
+					logger.warning("Circuit breaker of %s opened after %s failures: %s", self.name,
+								   self.failures, exception)
+				self.state = OPEN
+				self.opened_at = time.monotonic()
+
+
+	def call(self, function, *args, **kwargs):
+		"""
+		Calls function through the breaker.
+
+		:return: What the function returns.
+		"""
+		self.before_call()
+		operation = getattr(function, "__name__", "call")
+		start_time = time.perf_counter()
+		try:
+			result = function(*args, **kwargs)
+		except Exception as e:
+			self.record(e)
+			self.observe(operation, time.perf_counter() - start_time, error=e)
+			raise
+		self.record()
+		self.observe(operation, time.perf_counter() - start_time)
+		return result
+
+
+	def observe(self, operation, seconds, error=None, items=None):
+		"""
+		Hands the timing of a call to the observer, if there is one.
+		"""
+		if self.observer is None:
+			return
+		try:
+			self.observer(operation, seconds, error, items)
+		except Exception:
+			logger.exception("Observer of %s failed.", self.name)
+
+
+	def stats(self):
+		"""
+		:return: Dict of the breaker state, failures in a row, and calls / failures / rejected calls /
+				 times opened.
+		"""
+		with self.lock:
+			stats = dict(self.metrics)
+			stats["state"] = self.state
+			stats["consecutive_failures"] = self.failures
+		return stats
+
+
+
+class GuardedClient:
+	"""
+	Wraps a backend client so the listed methods run through a circuit breaker, with a per-call
+	timeout passed as a keyword argument when the client takes one. Everything else is the client's.
+	"""
+
+	def __init__(self, client, breaker, methods, timeout=None):
+		"""
+		:param client: The backend client.
+		:param breaker: The CircuitBreaker of the backend.
+		:param methods: Names of the methods that call the backend.
+		:param timeout: Seconds passed as the timeout argument of every call, None when the client
+						sets its timeouts itself.
+		"""
+		self.client = client
+		self.breaker = breaker
+		self.methods = frozenset(methods)
+		self.timeout = timeout
+
+
+	def __getattr__(self, name):
+		attribute = getattr(self.client, name)
+		if name not in self.methods:
+			return attribute
+
+		@functools.wraps(attribute)
+		def guarded(*args, **kwargs):
+			if self.timeout is not None:
+				kwargs.setdefault("timeout", self.timeout)
+			return self.breaker.call(attribute, *args, **kwargs)
+
+		return guarded
+
+
+
+class GuardedReader:
+	"""
+	Wraps a binary file-like object read from a backend (i.e. a GCS blob reader, which downloads a range
+	on every read) so its reads run through a circuit breaker. Everything else is the reader's.
+	"""
+
+	def __init__(self, reader, breaker):
+		"""
+		:param reader: The file-like object.
+		:param breaker: The CircuitBreaker of the backend.
+		"""
+		self.reader = reader
+		self.breaker = breaker
+
+
+	def __getattr__(self, name):
+		return getattr(self.reader, name)
+
+
+	def read(self, size=-1):
+		return self.breaker.call(self.reader.read, size)
+
+
+
+class GuardedDatastoreClient(GuardedClient):
+	"""
+	GuardedClient for a Datastore client, which also guards the lookups and commits made by queries
+	and transactions.
+	"""
+
+	DATASTORE_METHODS = ("get", "get_multi", "put", "put_multi", "delete", "delete_multi", "allocate_ids",
+						 "reserve_ids_sequential")
+
+	def __init__(self, client, breaker, timeout=None):
+		super().__init__(client, breaker, self.DATASTORE_METHODS, timeout=timeout)
+
+
+	def query(self, **kwargs):
+		return _GuardedQuery(self.client.query(**kwargs), self, "query")
+
+
+	def aggregation_query(self, query, **kwargs):
+		if isinstance(query, _GuardedQuery):
+			query = query.query
+		return _GuardedQuery(self.client.aggregation_query(query, **kwargs), self, "aggregation_query")
+
+
+	def transaction(self, **kwargs):
+		return _GuardedTransaction(self.client.transaction(**kwargs), self)
+
+
+
+class _GuardedQuery:
+	# a query (or aggregation query) whose fetch runs through the breaker, everything else is the query's
+
+	def __init__(self, query, guard, operation):
+		object.__setattr__(self, "query", query)
+		object.__setattr__(self, "guard", guard)
+		object.__setattr__(self, "operation", operation)
+
+	def __getattr__(self, name):
+		return getattr(self.query, name)
+
+	def __setattr__(self, name, value):
+		setattr(self.query, name, value)
+
+	def fetch(self, *args, **kwargs):
+		if self.guard.timeout is not None:
+			kwargs.setdefault("timeout", self.guard.timeout)
+		return _GuardedIterator(self.query.fetch(*args, **kwargs), self.guard.breaker, self.operation)
+
+
+
+class _GuardedIterator:
+	# the iterator of a fetch, pages are fetched lazily so the outcome is recorded when the first page
+	# arrives (or the first fetch fails), and later failures count too. The time spent fetching and the
+	# entities returned are observed once the iterator is exhausted, fails or is dropped
+
+	def __init__(self, iterator, breaker, operation):
+		self.iterator = iterator
+		self.breaker = breaker
+		self.operation = operation
+		self.started = False
+		self.observed = False
+		self.seconds = 0.0
+		self.items = 0
+
+	def __getattr__(self, name):
+		return getattr(self.iterator, name)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if not self.started:
+			self.breaker.before_call()
+		start_time = time.perf_counter()
+		try:
+			item = next(self.iterator)
+		except StopIteration:
+			self.seconds += time.perf_counter() - start_time
+			if not self.started:
+				self.started = True
+				self.breaker.record()
+			self._observe()
+			raise
+		except Exception as e:
+			self.seconds += time.perf_counter() - start_time
+			self.started = True
+			self.breaker.record(e)
+			self._observe(e)
+			raise
+		self.seconds += time.perf_counter() - start_time
+		self.items += 1
+		if not self.started:
+			self.started = True
+			self.breaker.record()
+		return item
+
+	def _observe(self, error=None):
+		if self.started and not self.observed:
+			self.observed = True
+			self.breaker.observe(self.operation, self.seconds, error=error, items=self.items)
+
+	def __del__(self):
+		self._observe()
+
+
+
+class _GuardedTransaction:
+	# a transaction whose begin / commit / rollback run through the breaker with the call timeout
+
+	def __init__(self, transaction, guard):
+		self.transaction = transaction
+		self.breaker = guard.breaker
+		if guard.timeout is not None:
+			# Batch.__enter__ / __exit__ call these without arguments
+			for name in ("begin", "commit", "rollback"):
+				setattr(transaction, name, functools.partial(getattr(transaction, name), timeout=guard.timeout))
+
+	def __getattr__(self, name):
+		return getattr(self.transaction, name)
+
+	def __enter__(self):
+		self.breaker.before_call()
+		start_time = time.perf_counter()
+		try:
+			self.transaction.__enter__()
+		except Exception as e:
+			self.breaker.record(e)
+			self.breaker.observe("begin_transaction", time.perf_counter() - start_time, error=e)
+			raise
+		self.breaker.record()
+		self.breaker.observe("begin_transaction", time.perf_counter() - start_time)
+		return self.transaction
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# never rejected here, the transaction has to be committed or rolled back once begun
+		operation = "commit" if exc_type is None else "rollback"
+		start_time = time.perf_counter()
+		try:
+			result = self.transaction.__exit__(exc_type, exc_value, traceback)
+		except Exception as e:
+			self.breaker.record(e)
+			self.breaker.observe(operation, time.perf_counter() - start_time, error=e)
+			raise
+		self.breaker.observe(operation, time.perf_counter() - start_time)
+		return result
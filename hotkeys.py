@@ -0,0 +1,218 @@
+from array import array
+from collections import deque
+import logging
+import math
+import threading
+import time
+
+from queryshapes import describe_shape
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# every bucket counts in a count-min sketch of SKETCH_DEPTH rows of SKETCH_WIDTH counters (4 bytes each), an
+# item is over-counted by at most about e / SKETCH_WIDTH of the bucket's total, with probability 1 - e^-depth
+SKETCH_WIDTH = 1024
+SKETCH_DEPTH = 4
+# counts are kept in buckets of BUCKET_SECONDS, a window adds up the buckets overlapping it
+BUCKET_SECONDS = 15
+WINDOWS = (60, 300, 900)
+# the items with the highest counts of every bucket, the candidates the top lists are picked from
+HEAVY_HITTERS = 50
+TOP_ITEMS = 20
+CATEGORIES = ("reads", "writes", "contention", "queries")
+
+
+
+class CountMinSketch:
+	"""
+	Fixed size frequency counter: an item's count is the smallest of the counters it hashes to (one per
+	row), which never under-counts and over-counts by the collisions of its least collided row.
+	"""
+
+	def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+		"""
+		:param width: Counters per row.
+		:param depth: Rows.
+		"""
+		self.width = width
+		self.depth = depth
+		self.rows = [array("I", bytes(4 * width)) for _ in range(depth)]
+		self.total = 0
+
+
+	def indexes(self, item):
+		"""
+		:return: The counter of item in every row, derived from its 64 bit hash (row i uses h1 + i * h2).
+		"""
+		# hash() differs between processes, which is fine for counts that never leave the process
+		value = hash(item) & 0xFFFFFFFFFFFFFFFF
+		first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+		return [(first + row * second) % self.width for row in range(self.depth)]
+
+
+	def add(self, indexes, count=1):
+		"""
+		:param indexes: The counters of the item, see indexes.
+		:return: The estimated count of the item after adding count.
+		"""
+		self.total += count
+		estimate = None
+		for row, index in zip(self.rows, indexes):
+			row[index] += count
+			if estimate is None or row[index] < estimate:
+				estimate = row[index]
+		return estimate
+
+
+	def estimate(self, indexes):
+		return min(row[index] for row, index in zip(self.rows, indexes))
+
+
+
+class FrequencyTracker:
+	"""
+	Counts items over sliding windows in a ring of time buckets, each with its own count-min sketch and
+	its heaviest hitters, so the most frequent items of the last minutes come out in bounded memory
+	whatever the number of distinct items.
+	"""
+
+	def __init__(self, windows=WINDOWS, bucket_seconds=BUCKET_SECONDS, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+				 heavy_hitters=HEAVY_HITTERS):
+		"""
+		:param windows: Window lengths in seconds, buckets are kept for the longest one.
+		:param bucket_seconds: Seconds counted in one bucket, windows are rounded to whole buckets.
+		:param width: Counters per sketch row.
+		:param depth: Rows per sketch.
+		:param heavy_hitters: Items with the highest counts kept per bucket.
+		"""
+		self.windows = tuple(windows)
+		self.bucket_seconds = bucket_seconds
+		self.width = width
+		self.depth = depth
+		self.heavy_hitters = heavy_hitters
+		self.buckets = deque(maxlen=int(math.ceil(max(self.windows) / float(bucket_seconds))) + 1)
+		self.lock = threading.Lock()
+
+
+	def _bucket(self, now):
+		start = int(now // self.bucket_seconds) * self.bucket_seconds
+		if not self.buckets or self.buckets[-1][0] != start:
+			# (start, sketch, heavy hitters of the bucket by estimated count, smallest of those counts)
+			self.buckets.append([start, CountMinSketch(self.width, self.depth), {}, 0])
+		return self.buckets[-1]
+
+
+	def add(self, item, count=1, now=None):
+		"""
+		:param item: Any hashable item, i.e. a tuple of strings.
+		:param count: Occurrences to add.
+		"""
+		now = time.time() if now is None else now
+		with self.lock:
+			bucket = self._bucket(now)
+			sketch, hitters = bucket[1], bucket[2]
+			estimate = sketch.add(sketch.indexes(item), count)
+			old_estimate = hitters.get(item)
+			if old_estimate is not None or len(hitters) < self.heavy_hitters:
+				hitters[item] = estimate
+				# counts only grow, the floor moves when the list fills up or its smallest item grew
+				if len(hitters) == self.heavy_hitters and (old_estimate is None or old_estimate == bucket[3]):
+					bucket[3] = min(hitters.values())
+			elif estimate > bucket[3]:
+				# only items counted above the floor evict, so most adds stay a dict lookup
+				del hitters[min(hitters, key=hitters.get)]
+				hitters[item] = estimate
+				bucket[3] = min(hitters.values())
+
+
+	def top(self, window_seconds, limit=TOP_ITEMS, now=None):
+		"""
+		:param window_seconds: The window, counted from the buckets overlapping its last window_seconds.
+		:param limit: Most items returned.
+		:return: (total count in the window, list of (item, estimated count), highest first).
+		"""
+		now = time.time() if now is None else now
+		with self.lock:
+			buckets = [bucket for bucket in self.buckets if bucket[0] > now - window_seconds - self.bucket_seconds]
+			candidates = set()
+			for bucket in buckets:
+				candidates.update(bucket[2])
+			total = sum(bucket[1].total for bucket in buckets)
+			counts = []
+			for item in candidates:
+				# every sketch hashes alike, so the counters of an item are worked out once
+				indexes = buckets[0][1].indexes(item)
+				counts.append((item, sum(bucket[1].estimate(indexes) for bucket in buckets)))
+		counts.sort(key=lambda entry: entry[1], reverse=True)
+		return total, counts[:limit]
+
+
+
+class HotKeyTracker:
+	"""
+	Encapsulates the hot key telemetry of the API: the (kind_id, key_id) pairs read and written most,
+	the keys whose update transactions are retried most (write contention) and the query shapes run most.
+	"""
+
+	def __init__(self, windows=WINDOWS, bucket_seconds=BUCKET_SECONDS, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+				 heavy_hitters=HEAVY_HITTERS):
+		"""
+		:param windows: Window lengths in seconds reported, see FrequencyTracker.
+		:param bucket_seconds: Seconds counted in one bucket.
+		:param width: Counters per sketch row.
+		:param depth: Rows per sketch.
+		:param heavy_hitters: Items with the highest counts kept per bucket.
+		"""
+		self.windows = tuple(windows)
+		self.trackers = {category: FrequencyTracker(windows, bucket_seconds, width, depth, heavy_hitters)
+						 for category in CATEGORIES}
+
+
+	def record_read(self, kind_id, key_id):
+		self.trackers["reads"].add((kind_id, key_id))
+
+
+	def record_write(self, kind_id, key_id):
+		self.trackers["writes"].add((kind_id, key_id))
+
+
+	def record_contention(self, kind_id, key_id, retries):
+		"""
+		:param retries: Times the transaction writing the key was aborted by a concurrent write.
+		"""
+		self.trackers["contention"].add((kind_id, key_id), retries)
+
+
+	def record_query(self, shape):
+		"""
+		:param shape: A shape built by query_shape.
+		"""
+		self.trackers["queries"].add(shape)
+
+
+	def report(self, limit=TOP_ITEMS, windows=None):
+		"""
+		:param limit: Most items per category and window.
+		:param windows: Window lengths in seconds, the configured ones when None.
+		:return: List of one dict per window, {"window_seconds", "reads", "writes", "contention", "queries"},
+				 each category with the total counted in the window and its top items with their estimated
+				 count and share of the total.
+		"""
+		now = time.time()
+		report = []
+		for window in windows or self.windows:
+			entry = {"window_seconds": window}
+			for category, tracker in self.trackers.items():
+				total, counts = tracker.top(window, limit, now=now)
+				items = []
+				for item, count in counts:
+					item_entry = describe_shape(item) if category == "queries" else {"kind_id": item[0], "key_id": item[1]}
+					item_entry["count"] = count
+					item_entry["share"] = round(count / float(total), 4) if total else 0.0
+					items.append(item_entry)
+				entry[category] = {"total": total, "top": items}
+			report.append(entry)
+		return report
@@ -0,0 +1,163 @@
+from flask import request
+import collections
+import copy
+import functools
+import hashlib
+import logging
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# stored responses are replayed for this many seconds, and at most MAX_ENTRIES are kept
+IDEMPOTENCY_TTL = 24 * 60 * 60
+MAX_ENTRIES = 10000
+# a retry of a request that is still running waits this long for it before giving up with 409
+IN_FLIGHT_WAIT = 30
+MAX_KEY_LENGTH = 255
+
+
+
+class IdempotencyStore:
+	"""
+	Remembers the first response sent for every Idempotency-Key header, so retried requests get
+	the stored response instead of running again. Kept in memory, which covers the single
+	App Engine instance in app.yaml.
+	"""
+
+	def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=MAX_ENTRIES, in_flight_wait=IN_FLIGHT_WAIT, identity=None):
+		"""
+		:param ttl: Seconds a stored response is replayed for.
+		:param max_entries: Number of stored responses kept, the oldest are dropped first.
+		:param in_flight_wait: Seconds a duplicate waits for the request it duplicates.
+		:param identity: Function returning the caller of the current request, keys are scoped per
+						 caller, the Authorization header when None.
+		"""
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.in_flight_wait = in_flight_wait
+		self.identity = identity
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+
+	def _purge(self, now):
+		# entries are kept in expiry order, so only the oldest ever needs checking
+		while self.entries:
+			entry = next(iter(self.entries.values()))
+			if len(self.entries) <= self.max_entries and entry["expires"] > now:
+				break
+			self.entries.popitem(last=False)
+
+
+	def begin(self, key, fingerprint):
+		"""
+		Claims a key for a request, or finds the response to replay.
+
+		:param key: The scoped idempotency key.
+		:param fingerprint: Hash of the request body, a key can't be reused for a different body.
+		:return: ("run", None) when the caller should run the request and then call complete or
+				 abandon, ("replay", response) when a response is stored, ("mismatch", None) when
+				 the key was used for a different body or ("busy", None) when the first request is
+				 still running after in_flight_wait.
+		"""
+		deadline = time.monotonic() + self.in_flight_wait
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self._purge(now)
+				entry = self.entries.get(key)
+				if entry is None:
+					self.entries[key] = {"fingerprint": fingerprint, "response": None,
+										 "done": threading.Event(), "expires": now + self.ttl}
+					return "run", None
+				if entry["fingerprint"] != fingerprint:
+					return "mismatch", None
+				if entry["response"] is not None:
+					return "replay", copy.deepcopy(entry["response"])
+				done = entry["done"]
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or not done.wait(remaining):
+				return "busy", None
+
+
+	def complete(self, key, response):
+		"""
+		Stores the response of a claimed key and releases the requests waiting on it.
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return
+			entry["response"] = copy.deepcopy(response)
+			entry["expires"] = time.monotonic() + self.ttl
+			self.entries.move_to_end(key)
+			entry["done"].set()
+
+
+	def abandon(self, key):
+		"""
+		Releases a claimed key without storing a response, so the next retry runs the request again.
+		"""
+		with self.lock:
+			entry = self.entries.pop(key, None)
+		if entry is not None:
+			entry["done"].set()
+
+
+	def idempotent(self, function):
+		"""
+		Decorator for a Resource method: when the request has an Idempotency-Key header, the first
+		response is stored and replayed to retries with the same key from the same caller. Server errors,
+		authentication failures and {"status": "error"} results aren't stored, so they can be retried.
+		"""
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+			if not idempotency_key:
+				return function(*args, **kwargs)
+			if len(idempotency_key) > MAX_KEY_LENGTH:
+				return {"message": "Idempotency-Key is too long"}, 400
+			caller = self.identity() if self.identity is not None else request.headers.get("Authorization", "")
+			scope = hashlib.sha256("\n".join([caller or "", request.path,
+											  idempotency_key]).encode("utf-8")).hexdigest()
+			fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+			state, response = self.begin(scope, fingerprint)
+			if state == "replay":
+				logger.info("Replaying stored response for Idempotency-Key %s.", idempotency_key)
+				data, status, headers = response
+				headers = dict(headers)
+				headers["Idempotent-Replayed"] = "true"
+				return data, status, headers
+			if state == "mismatch":
+				return {"message": "Idempotency-Key was already used for a different request"}, 422
+			if state == "busy":
+				return {"message": "A request with this Idempotency-Key is still in progress"}, 409, {"Retry-After": "1"}
+			try:
+				result = function(*args, **kwargs)
+			except Exception:
+				self.abandon(scope)
+				raise
+			data, status, headers = _split_response(result)
+			if status >= 500 or status in (401, 403) or (isinstance(data, dict) and data.get("status") == "error"):
+				self.abandon(scope)
+			else:
+				self.complete(scope, (data, status, dict(headers or {})))
+			return result
+
+		return wrapper
+
+
+def _split_response(result):
+	# the (data, status, headers) forms a flask-restful method can return
+	if isinstance(result, tuple):
+		if len(result) == 3:
+			return result
+		if len(result) == 2:
+			return result[0], result[1], {}
+		return result[0], 200, {}
+	return result, 200, {}
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import logging
+import threading
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# ids are reserved from datastore BLOCK_SIZE at a time, and a kind's pool is topped up in the
+# background once fewer than LOW_WATER ids are left
+BLOCK_SIZE = 100
+LOW_WATER = 20
+
+
+
+class KeyIdPool:
+	"""
+	Hands out complete keys from blocks of ids reserved with allocate_ids, so auto-keyed creates
+	know their id before the write without a round trip to datastore.
+	"""
+
+	def __init__(self, datastore_client, block_size=BLOCK_SIZE, low_water=LOW_WATER):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		:param block_size: Number of ids reserved per allocate_ids call.
+		:param low_water: Number of ids left in a kind's pool that triggers a background refill.
+		"""
+		self.datastore_client = datastore_client
+		self.block_size = block_size
+		self.low_water = low_water
+		self.pools = collections.defaultdict(collections.deque)
+		self.refilling = set()
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="key-id-pool")
+
+
+	def take(self, kind_id, count=1):
+		"""
+		Takes complete keys of a kind from the pool, reserving more ids right away only when the
+		pool can't cover the request.
+
+		:param kind_id: The kind of the keys.
+		:param count: The number of keys needed.
+		:return: The list of complete keys.
+		"""
+		keys = []
+		with self.lock:
+			pool = self.pools[kind_id]
+			while pool and len(keys) < count:
+				keys.append(pool.popleft())
+		missing = count - len(keys)
+		if missing:
+			# reserve the shortfall plus a block so the next creates are served from the pool
+			allocated = self._allocate(kind_id, missing + self.block_size)
+			keys.extend(allocated[:missing])
+			with self.lock:
+				self.pools[kind_id].extend(allocated[missing:])
+		self._refill_if_low(kind_id)
+		return keys
+
+
+	def _allocate(self, kind_id, count):
+		return self.datastore_client.allocate_ids(self.datastore_client.key(kind_id), count)
+
+
+	def _refill_if_low(self, kind_id):
+		with self.lock:
+			if len(self.pools[kind_id]) >= self.low_water or kind_id in self.refilling:
+				return
+			self.refilling.add(kind_id)
+		self.executor.submit(self._refill, kind_id)
+
+
+	def _refill(self, kind_id):
+		try:
+			allocated = self._allocate(kind_id, self.block_size)
+			with self.lock:
+				self.pools[kind_id].extend(allocated)
+		except Exception:
+			logger.exception("Couldn't reserve ids for %s.", kind_id)
+		finally:
+			with self.lock:
+				self.refilling.discard(kind_id)
@@ -1,17 +1,45 @@
-from flask import Flask, request
+from flask import Flask, request, g, has_request_context
 from flask_restful import Api, Resource
-import base64
+from flask_restful.representations.json import output_json
 from flask_cors import CORS
 from google.oauth2 import service_account
 from google.cloud import datastore, storage
-from google.api_core.exceptions import Conflict
+from google.cloud.datastore.query import PropertyFilter, And, Or
+from google.api_core.exceptions import Conflict, BadRequest, FailedPrecondition, InvalidArgument, NotFound
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import json
-from datetime import timedelta
+import math
+import mimetypes
+import os
+import heapq
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 # importing SES classes from awsses.py file
 from awsses import SesTemplate
 from awsses import SesMailSender
+from queryshapes import QueryShapeRecorder, query_shape, recommended_index, index_yaml
+from searchindex import SearchIndex
+from idempotency import IdempotencyStore
+from schemas import SchemaRegistry
+from writebuffer import WriteCoalescer, WriteBufferFullError
+from keypool import KeyIdPool
+from auth import Authenticator, TOKEN_TTL
+from admission import RateLimiter, ConcurrencyLimiter
+from profiling import RequestProfiler, SlowRequestLog, payload_shape
+from metrics import MetricsRegistry, SIZE_BUCKETS, COUNT_BUCKETS
+from circuitbreaker import CircuitBreaker, CircuitOpenError, GuardedClient, GuardedDatastoreClient, GuardedReader, google_failure, aws_failure
+from atomicops import ShardedCounter, run_in_transaction, validate_operations, apply_operations, operation_delta
+from changefeed import ChangeFeed, UPDATED_AT, VERSION, DELETED_AT, SETTLE_SECONDS, PAGE_SIZE
+from transfers import TransferJobs
+from rollups import Rollups, validate_definitions
+from rawemail import RawEmail, MessageTooLargeError, MAX_ATTACHMENTS, READ_CHUNK_SIZE
+from hotkeys import HotKeyTracker, WINDOWS, BUCKET_SECONDS, SKETCH_WIDTH, SKETCH_DEPTH, TOP_ITEMS
 
 # python 3.11 (API can also work with python 3.7+) 
 
@@ -21,21 +49,134 @@ CORS(app)
 api = Api(app)
 
 
-# api keys for API Authentication (BASIC AUTH)
-with open('api_keys.json', encoding='utf8') as json_data:
-	users = json.load(json_data)
-
-
-def check_auth(username, password):
-	"""Check if a username / password combination is valid."""
-	return users.get(username) == password
+# optional per-kind settings, each section maps a kind_id to its settings and "*" applies to every kind
+# {
+#	"search_fields": {"*": ["name", "email"], "client000000001": ["name", "company"]},
+#	"sharded_counters": {"*": {"cases_open": 20}},
+#	"write_behind": {"client000000001": true},
+#	"schemas": {"*": {"exclude_from_indexes": ["description"], "compressed": ["body_html"]}},
+#	"rate_limits": {"*": {"rate": 10, "burst": 20}, "bulkuser": {"rate": 50, "burst": 100}},
+#	"admission": {"max_concurrent": 32, "max_queued": 64, "queue_timeout": 2},
+#	"backends": {"ses": {"timeout": 10, "failure_threshold": 5, "reset_timeout": 30}},
+#	"auth": {"token_secret": "INSERT A LONG RANDOM SECRET", "token_ttl": 900},
+#	"profiling": {"sample_rate": 0.01, "header": "X-Profile-Request", "directory": "/tmp/profiles", "slow_request_ms": 1000},
+#	"change_feed": {"tombstone_days": 30, "settle_seconds": 2},
+#	"rollups": {"*": {"by_status": {"group_by": ["object_type", "status"], "sum": ["amount"], "shards": 10}}},
+#	"hot_keys": {"windows": [60, 300, 900], "bucket_seconds": 15, "sketch_width": 1024, "sketch_depth": 4}
+# }
+api_config = {}
+if os.path.exists('api_config.json'):
+	with open('api_config.json', encoding='utf8') as json_data:
+		api_config = json.load(json_data)
+
+
+def kind_config(section, kind_id):
+	"""Returns the settings of a kind from a section of api_config.json, or None if it has none."""
+	section_config = api_config.get(section, {})
+	return section_config.get(kind_id, section_config.get("*"))
+
+
+for rollup_definitions in api_config.get("rollups", {}).values():
+	validate_definitions(rollup_definitions)
+
+
+# api keys for API Authentication (BASIC AUTH), api_keys.json is reloaded when it changes and its passwords
+# can be stored hashed (python auth.py <password>), clients can swap their credentials for a short-lived
+# bearer token at /api/v1/token, signed with the api_config.json "auth" token_secret (or API_TOKEN_SECRET)
+auth_config = api_config.get("auth", {})
+authenticator = Authenticator('api_keys.json', token_secret=auth_config.get("token_secret", os.environ.get("API_TOKEN_SECRET")),
+							  token_ttl=auth_config.get("token_ttl", TOKEN_TTL))
+
+
+# latency, error and payload size metrics per route, and the duration of every datastore / GCS / SES
+# call, served in the Prometheus text format at /metrics
+metricsRegistry = MetricsRegistry()
+requestLatency = metricsRegistry.histogram("http_request_duration_seconds", "Time from receiving a request to sending its response.",
+										   ("route", "method", "status"))
+requestBackendTime = metricsRegistry.histogram("http_request_backend_seconds", "Time a request spent waiting on datastore, GCS and SES calls.",
+											   ("route",))
+requestErrors = metricsRegistry.counter("http_request_errors_total", "Responses with a 4xx or 5xx status.", ("route", "status"))
+requestSize = metricsRegistry.histogram("http_request_size_bytes", "Size of request bodies.", ("route",), SIZE_BUCKETS)
+responseSize = metricsRegistry.histogram("http_response_size_bytes", "Size of response bodies.", ("route",), SIZE_BUCKETS)
+serializationTime = metricsRegistry.histogram("http_response_serialization_seconds", "Time spent encoding JSON responses.", ("route",))
+backendLatency = metricsRegistry.histogram("backend_call_duration_seconds", "Duration of datastore, GCS and SES calls.",
+										   ("backend", "operation"))
+backendErrors = metricsRegistry.counter("backend_call_errors_total", "Datastore, GCS and SES calls that raised.",
+										("backend", "operation", "error"))
+queryEntities = metricsRegistry.histogram("datastore_query_entities", "Entities (or aggregation results) returned per datastore query.",
+										  ("operation",), COUNT_BUCKETS)
+
+
+def request_route():
+	"""Returns the route rule of the current request (i.e. /api/v1/read), so metric labels stay bounded."""
+	return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def backend_observer(backend):
+	"""Returns the observer a backend's circuit breaker reports every call to, recording it in the metrics."""
+	def observe(operation, seconds, error, items):
+		backendLatency.observe(seconds, backend=backend, operation=operation)
+		if error is not None:
+			backendErrors.inc(backend=backend, operation=operation, error=type(error).__name__)
+		if items is not None:
+			queryEntities.observe(items, operation=operation)
+		if has_request_context():
+			g.backend_seconds = g.get("backend_seconds", 0.0) + seconds
+			backend_calls = g.get("backend_calls")
+			if backend_calls is not None and len(backend_calls) < MAX_LOGGED_BACKEND_CALLS:
+				backend_calls.append({"backend": backend, "operation": operation, "ms": round(seconds * 1000, 1),
+									  "error": type(error).__name__ if error is not None else None})
+	return observe
+
+
+# opt-in profiling: a sample_rate fraction of requests, and authenticated requests sent with the profile
+# header, are profiled with cProfile into .prof files, and requests slower than slow_request_ms are kept
+# in the slow request log (/api/v1/slowrequests) with their payload shape and backend call timings
+profiling_config = api_config.get("profiling", {})
+requestProfiler = RequestProfiler(sample_rate=profiling_config.get("sample_rate", 0.0),
+								  header=profiling_config.get("header", "X-Profile-Request"),
+								  directory=profiling_config.get("directory", "/tmp/profiles"))
+slowRequestLog = SlowRequestLog(threshold_ms=profiling_config.get("slow_request_ms", 1000))
+MAX_LOGGED_BACKEND_CALLS = 100
+
+
+# per-call deadline (seconds) and circuit breaker of every backend, overridable per backend in
+# api_config.json "backends", a breaker opens after failure_threshold failed calls in a row, fails
+# every call fast for reset_timeout seconds, then lets one probe call through
+BACKEND_DEFAULTS = {
+	"datastore": {"timeout": 20, "failure_threshold": 5, "reset_timeout": 30},
+	"gcs": {"timeout": 30, "failure_threshold": 5, "reset_timeout": 30},
+	"ses": {"timeout": 10, "failure_threshold": 5, "reset_timeout": 30},
+}
+
+
+def backend_config(backend):
+	"""Returns the deadline and breaker settings of a backend, the defaults updated with api_config.json."""
+	config = dict(BACKEND_DEFAULTS[backend])
+	config.update(api_config.get("backends", {}).get(backend, {}))
+	return config
+
+
+def backend_breaker(backend, name, is_failure):
+	config = backend_config(backend)
+	return CircuitBreaker(name, is_failure, failure_threshold=config["failure_threshold"], reset_timeout=config["reset_timeout"],
+						  observer=backend_observer(backend))
+
+
+datastoreBreaker = backend_breaker("datastore", "Datastore", google_failure)
+gcsBreaker = backend_breaker("gcs", "Cloud Storage", google_failure)
+sesBreaker = backend_breaker("ses", "SES", aws_failure)
+DATASTORE_TIMEOUT = backend_config("datastore")["timeout"]
+GCS_TIMEOUT = backend_config("gcs")["timeout"]
+SES_TIMEOUT = backend_config("ses")["timeout"]
 
 
 # Google Cloud Platform Service Account Credentials
 credentials = service_account.Credentials.from_service_account_file(
 		'INSERT GCP SERVICE ACCOUNT CREDS JSON FILE')
 
-datastore_client = datastore.Client(credentials=credentials)
+# every lookup, write, query and transaction goes through the datastore breaker with DATASTORE_TIMEOUT
+datastore_client = GuardedDatastoreClient(datastore.Client(credentials=credentials), datastoreBreaker, timeout=DATASTORE_TIMEOUT)
 
 storage_client = storage.Client(credentials=credentials)
 
@@ -53,12 +194,207 @@ AWS_REGION = "us-west-2"
 ses_client = boto3.client('ses',
 						  region_name=AWS_REGION, 
 						  aws_access_key_id=AWS_ACCESS_KEY_ID, 
-						  aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+						  aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+						  config=Config(connect_timeout=SES_TIMEOUT, read_timeout=SES_TIMEOUT, retries={"max_attempts": 2, "mode": "standard"})
 						  )
+# every SES call (here and in awsses.py) goes through the SES breaker
+ses_client = GuardedClient(ses_client, sesBreaker, ("send_email", "send_raw_email", "send_templated_email", "create_template",
+													"delete_template", "get_template", "update_template", "list_templates"))
 
 sesTemplate = SesTemplate(ses_client)
 sesMailSender = SesMailSender(ses_client)
+# emails with attachments are built in memory (up to 10 MB each, more while boto3 encodes the request),
+# at most this many at once, other requests wait up to SES_TIMEOUT for a slot and are then shed
+MAX_CONCURRENT_RAW_EMAILS = 4
+rawEmailSlots = threading.BoundedSemaphore(MAX_CONCURRENT_RAW_EMAILS)
+
+# exclude_from_indexes and compressed properties of the kinds in api_config.json "schemas", applied on every
+# write and undone on every read
+schemaRegistry = SchemaRegistry(api_config.get("schemas", {}))
+# inverted prefix index for the search fields in api_config.json, kept in sync by create / update / delete
+searchIndex = SearchIndex(datastore_client, decode=schemaRegistry.decode)
+# most entities one search returns
+MAX_SEARCH_LIMIT = 1000
+# counters split over shard entities for the sharded counter fields in api_config.json
+shardedCounter = ShardedCounter(datastore_client)
+# counts and sums per group of the rollups in api_config.json, updated from the old and new properties
+# of every write and read by /api/v1/rollups
+materializedRollups = Rollups(datastore_client, decode=schemaRegistry.decode)
+# updated_at / version stamped on every write and tombstones left by deletes, read by /api/v1/changes
+change_feed_config = api_config.get("change_feed", {})
+changeFeed = ChangeFeed(datastore_client, tombstone_ttl=timedelta(days=change_feed_config.get("tombstone_days", 30)),
+						settle_seconds=change_feed_config.get("settle_seconds", SETTLE_SECONDS))
+# write-behind buffer for the kinds set in api_config.json "write_behind", merges updates to the same key
+# and flushes them with flush_coalesced_writes
+WRITE_BEHIND_CHUNK_SIZE = 100
+# datastore commits take at most this many mutations
+MAX_COMMIT_MUTATIONS = 500
+writeCoalescer = WriteCoalescer(lambda items: flush_coalesced_writes(items))
+writeCoalescer.start()
+# responses stored per Idempotency-Key header so retried creates / email sends are replayed, not run again
+idempotencyStore = IdempotencyStore(identity=authenticator.current_user)
+# per-user token buckets for the users in api_config.json "rate_limits" ("*" for every user), and a cap
+# on the requests running at once, over which requests queue briefly and are then shed
+rateLimiter = RateLimiter(lambda user: kind_config("rate_limits", user))
+concurrencyLimiter = ConcurrencyLimiter(**api_config.get("admission", {}))
+# current state of the breakers, the concurrency limiter and the write-behind buffer, read on every scrape
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+metricsRegistry.gauge("backend_circuit_state", "Circuit breaker state, 0 closed, 1 half open, 2 open.", ("backend",),
+					  lambda: {(backend,): BREAKER_STATES[breaker.stats()["state"]] for backend, breaker in
+							   (("datastore", datastoreBreaker), ("gcs", gcsBreaker), ("ses", sesBreaker))})
+metricsRegistry.gauge("http_requests_in_flight", "Requests running and queued for a slot of the concurrency limiter.", ("state",),
+					  lambda: {(state,): concurrencyLimiter.stats()[state] for state in ("running", "queued")})
+metricsRegistry.gauge("write_buffer_pending_keys", "Keys waiting in the write-behind buffer.", (),
+					  lambda: {(): writeCoalescer.stats()["pending_keys"]})
+# complete keys reserved in blocks with allocate_ids, handed out to auto-keyed creates
+keyIdPool = KeyIdPool(datastore_client)
+# bulk creates are written in put_multi batches of this size (datastore's maximum), several at a time
+BULK_WRITE_CHUNK_SIZE = 500
+BULK_WRITE_WORKERS = 8
+MAX_BULK_CREATE_ITEMS = 5000
+# background export of a kind to NDJSON / CSV objects in its bucket and import of such objects, streamed
+# from / to GCS with their progress and checkpoint in datastore, imports are written with create_data_bulk
+transferJobs = TransferJobs(datastore_client, storage_client,
+							to_dicts=lambda kind_id, entities, read_options: entities_to_dicts(kind_id, entities, read_options=read_options),
+							write_items=lambda kind_id, items: create_data_bulk(kind_id, items), breaker=gcsBreaker, timeout=GCS_TIMEOUT)
+# batch gets (key_ids of /api/v1/read) look up at most this many keys, datastore's maximum per lookup
+MAX_BATCH_GET_KEYS = 1000
+# read_time: any time of the last hour can be read, older ones only when they are whole minutes within the
+# point-in-time recovery window (7 days, PITR needs to be enabled on the database)
+RECENT_READ_TIME = timedelta(hours=1)
+PITR_WINDOW = timedelta(days=7)
+
+
+# IN / OR filters: datastore accepts up to 30 disjunctions in one query, bigger ones are split
+# into parallel sub-queries by fan_out_query (one worker thread per sub-query)
+MAX_NATIVE_DISJUNCTIONS = 30
+MAX_FANOUT_QUERIES = 50
+FANOUT_QUEUE_SIZE = 500
+_FANOUT_DONE = object()
+
+# every query shape read_data runs, with its latency and errors, for the index.yaml advisor
+queryShapeRecorder = QueryShapeRecorder()
+
+# the keys read / written / contended and the query shapes run most over the last minutes, counted in
+# fixed size count-min sketches (api_config.json "hot_keys") and served at /api/v1/hotkeys
+hot_keys_config = api_config.get("hot_keys", {})
+hotKeyTracker = HotKeyTracker(windows=hot_keys_config.get("windows", WINDOWS), bucket_seconds=hot_keys_config.get("bucket_seconds", BUCKET_SECONDS),
+							  width=hot_keys_config.get("sketch_width", SKETCH_WIDTH), depth=hot_keys_config.get("sketch_depth", SKETCH_DEPTH))
+
+# sort_fallback: limits up to this size are sorted with a bounded heap (top-k) instead of a full sort
+TOP_K_HEAP_LIMIT = 1000
+
+
+
+@app.before_request
+def start_request_metrics():
+	"""Starts the request timer, registered first so the time spent in admission control is included."""
+	g.request_start = time.perf_counter()
+	g.backend_seconds = 0.0
+	g.backend_calls = []
+
+
+@app.after_request
+def record_request_metrics(response):
+	"""Records the latency, backend time, error status and payload sizes of the request per route."""
+	route = request_route()
+	if "request_start" in g:
+		requestLatency.observe(time.perf_counter() - g.request_start, route=route, method=request.method, status=response.status_code)
+		requestBackendTime.observe(g.get("backend_seconds", 0.0), route=route)
+	if response.status_code >= 400:
+		requestErrors.inc(route=route, status=response.status_code)
+	requestSize.observe(request.content_length or 0, route=route)
+	if not response.is_streamed:
+		responseSize.observe(response.content_length or 0, route=route)
+	return response
+
+
+@app.after_request
+def finish_request_profile(response):
+	"""Writes the profile of a profiled request, and adds the request to the slow request log if it was slow."""
+	if "request_start" not in g:
+		return response
+	seconds = time.perf_counter() - g.request_start
+	profile = g.pop("profile", None)
+	profile_path = requestProfiler.stop(profile, request_route(), seconds) if profile is not None else None
+	if slowRequestLog.is_slow(seconds):
+		slowRequestLog.record({
+			"time": datetime.utcnow().isoformat() + "Z",
+			"route": request_route(),
+			"method": request.method,
+			"status": response.status_code,
+			"total_ms": round(seconds * 1000, 1),
+			"backend_ms": round(g.get("backend_seconds", 0.0) * 1000, 1),
+			"payload_shape": payload_shape(request.get_json(silent=True)),
+			"backend_calls": g.get("backend_calls", []),
+			"profile": profile_path
+		})
+	return response
+
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+	# requests that failed before after_request still have to stop their profiler
+	profile = g.pop("profile", None)
+	if profile is not None:
+		profile.disable()
+
+
+@api.representation('application/json')
+def output_json_timed(data, code, headers=None):
+	"""flask_restful's JSON representation, timed so serialization shows up apart from the handler."""
+	start_time = time.perf_counter()
+	response = output_json(data, code, headers)
+	serializationTime.observe(time.perf_counter() - start_time, route=request_route())
+	return response
+
+
+@app.route("/metrics")
+@authenticator.required
+def prometheus_metrics():
+	"""Prometheus scrape endpoint (Basic or Bearer auth) with every metric of the process."""
+	return metricsRegistry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def request_user():
+	"""
+	Returns the API user a request counts against: the user its credentials claim, otherwise the client address.
+	The password isn't checked yet, verifying it (PBKDF2 for hashed passwords) only happens once the request is
+	admitted, so a flood of wrong passwords is rate limited and shed like any other request.
+	"""
+	return authenticator.claimed_user() or request.remote_addr
+
 
+@app.before_request
+def admit_request():
+	"""Rate limits every API request per claimed user, then waits for a slot of the concurrency limiter."""
+	if request.method == "OPTIONS":
+		return None
+	wait = rateLimiter.acquire(request_user())
+	if wait:
+		retry_after = str(max(1, math.ceil(wait)))
+		return {"status": "error", "error": "Rate limit exceeded, retry after %s seconds" % retry_after}, 429, {"Retry-After": retry_after}
+	if not concurrencyLimiter.acquire():
+		retry_after = str(concurrencyLimiter.retry_after())
+		return {"status": "error", "error": "Server is busy, retry after %s seconds" % retry_after}, 503, {"Retry-After": retry_after}
+	g.admitted = True
+	return None
+
+
+@app.teardown_request
+def release_request(exception=None):
+	if g.pop("admitted", False):
+		concurrencyLimiter.release()
+
+
+@app.before_request
+def start_request_profile():
+	"""
+	Starts the profiler for sampled requests and authenticated requests sent with the profile header, registered
+	after admit_request so the credentials are only verified for admitted requests.
+	"""
+	requested = bool(request.headers.get(requestProfiler.header)) and authenticator.current_user() is not None
+	g.profile = requestProfiler.start(requested=requested)
 
 
 def create_template(template_name, subject, text_part, html_part):
@@ -210,8 +546,445 @@ def send_email(sender, recipients, subject, body_html, body_text):
 		return {'status': 'error', 'error': e.response['Error']['Message'] }
 
 
+def attachment_object_name(object_folder_name, file_name):
+	"""
+		object name of an attachment in the kind's bucket, with the folder normalized like the upload
+		URLs of GenerateSignedURL, so an uploaded file is attached with the same folder and file names
+	"""
+	object_folder_name = str(object_folder_name).lower().replace(' ', '_').replace('.', '')
+	return f'{object_folder_name}/{file_name}'
+
+
+# one time email send with attachments from the kind's bucket
+def send_email_with_attachments(sender, recipients, subject, body_html, body_text, kind_id, attachments):
+	"""
+		sends an email with files of the kind's bucket attached, as a MIME message built on the server
+		and sent with send_raw_email
+
+		args:
+			kind_id:  name/ID of the kind, its bucket holds the attachments, example: "client000000001"
+			attachments:  list of the files to attach, file_name is the name of the object in the folder,
+						  attachment_name the name shown to the recipient (optional, defaults to file_name)
+							[{"object_folder_name": "invoices", "file_name": "invoice000000001.pdf",
+							  "attachment_name": "Invoice April.pdf"}]
+
+		the size of every object is checked before any is downloaded, and each is streamed from GCS and
+		base64 encoded chunk by chunk into the message, which can't go over the 10 MB SES accepts
+
+		returns the SES response like send_email, or (error, http status) for a missing attachment (404), an
+		email over 10 MB (413) or too many emails with attachments being built at once (503)
+	"""
+	bucket = storage_client.bucket(kind_id)
+	blobs = []
+	for attachment in attachments:
+		blob = bucket.blob(attachment_object_name(attachment["object_folder_name"], attachment["file_name"]))
+		try:
+			gcsBreaker.call(blob.reload, timeout=GCS_TIMEOUT)
+		except NotFound:
+			return {'status': 'error', 'error': 'Attachment not found: ' + blob.name}, 404
+		blobs.append(blob)
+	if not rawEmailSlots.acquire(timeout=SES_TIMEOUT):
+		return {'status': 'error', 'error': 'Too many emails with attachments being sent, retry after 1 second'}, 503, {'Retry-After': '1'}
+	try:
+		message = RawEmail(sender, recipients, subject, body_html, body_text)
+		message.check_size([blob.size for blob in blobs])
+		for attachment, blob in zip(attachments, blobs):
+			file_name = attachment.get("attachment_name") or attachment["file_name"]
+			content_type = blob.content_type or mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+			# the reader downloads the generation reloaded above in READ_CHUNK_SIZE ranges, each through the breaker
+			with blob.open("rb", chunk_size=READ_CHUNK_SIZE, timeout=GCS_TIMEOUT) as reader:
+				message.add_attachment(file_name, content_type, GuardedReader(reader, gcsBreaker), size=blob.size)
+		response = ses_client.send_raw_email(Source=sender, Destinations=recipients, RawMessage={'Data': message.finish()})
+		print("Email with attachments sent! Response:", response)
+		return {'status': 'success', 'response': response }
+	except MessageTooLargeError as e:
+		return {'status': 'error', 'error': str(e)}, 413
+	except ClientError as e:
+		print(e.response['Error']['Message'])
+		return {'status': 'error', 'error': e.response['Error']['Message'] }
+	finally:
+		rawEmailSlots.release()
+
+
+
+def entity_to_dict(entity):
+	"""
+		converts a datastore entity to the dictionary returned by the API, with its key under "key_id"
+	"""
+	d = schemaRegistry.decode(dict(entity))
+	for prop, value in d.items():
+		if isinstance(value, datetime):
+			# i.e. updated_at, json has no datetime type
+			d[prop] = value.isoformat()
+	if entity.key.id == None:
+		d["key_id"] = entity.key.name
+	else:
+		d["key_id"] = entity.key.id
+	return d
+
+
+def read_options(read_consistency=None, read_time=None):
+	"""
+		turns the read_consistency / read_time of a read request into the keyword arguments of datastore
+		lookups and queries
+
+		args:
+			read_consistency:  "strong" (default, datastore's own) or "eventual", lower latency lookups
+							   that can miss writes of the last few seconds
+			read_time:  ISO 8601 time, i.e. "2024-05-01T12:00:00Z", reads the data as it was then (a consistent
+						snapshot, within the last hour, or a whole minute within the 7 day point-in-time recovery window)
+
+		returns {}, {"eventual": True} or {"read_time": datetime}, raises ValueError for invalid values
+	"""
+	if read_consistency not in (None, "strong", "eventual"):
+		raise ValueError("read_consistency needs to be strong or eventual")
+	if read_time == None:
+		return {"eventual": True} if read_consistency == "eventual" else {}
+	if read_consistency == "eventual":
+		raise ValueError("read_time reads a snapshot, it can't be combined with read_consistency eventual")
+	try:
+		snapshot_time = datetime.fromisoformat(str(read_time).replace("Z", "+00:00"))
+	except ValueError:
+		raise ValueError("read_time needs to be an ISO 8601 time, i.e. 2024-05-01T12:00:00Z")
+	if snapshot_time.tzinfo == None:
+		snapshot_time = snapshot_time.replace(tzinfo=timezone.utc)
+	now = datetime.now(timezone.utc)
+	if snapshot_time > now:
+		raise ValueError("read_time can't be in the future")
+	if snapshot_time < now - RECENT_READ_TIME:
+		# datastore rejects these with InvalidArgument
+		if snapshot_time.second or snapshot_time.microsecond:
+			raise ValueError("read_time older than an hour needs to be a whole minute, i.e. 2024-05-01T12:00:00Z")
+		if snapshot_time < now - PITR_WINDOW:
+			raise ValueError("read_time can't be older than the 7 day point-in-time recovery window")
+	return {"read_time": snapshot_time}
+
+
+def entities_to_dicts(kind_id, entities, read_options=None):
+	"""
+		converts entities of a kind with entity_to_dict and adds up the shards of the kind's sharded
+		counters (api_config.json "sharded_counters") into the counter fields, with one get_multi
+		(read with the same read_options as the entities)
+	"""
+	data_list = [entity_to_dict(entity) for entity in entities]
+	sharded_fields = kind_config("sharded_counters", kind_id) or {}
+	if sharded_fields and data_list:
+		counters = [(d["key_id"], field, num_shards) for d in data_list for field, num_shards in sharded_fields.items()]
+		totals = shardedCounter.totals(kind_id, counters, read_options=read_options)
+		for d in data_list:
+			for field in sharded_fields:
+				total = totals[(d["key_id"], field)]
+				if total or field in d:
+					d[field] = (d.get(field) or 0) + total
+	return data_list
+
+
+def build_query(kind_id, key_id=None, object_type=None, filters=None):
+	"""
+		builds the datastore query shared by read_data and aggregate_data, takes the same
+		key_id / object_type / filters arguments as read_data (see read_data for examples)
+	"""
+	query = datastore_client.query(kind=kind_id)
+	if key_id != None:
+		first_key = datastore_client.key(kind_id, key_id)
+		query.key_filter(first_key, "=")
+	elif object_type != None:
+		query.add_filter(filter=PropertyFilter("object_type", "=", object_type))
+	if filters != None:  # filters is python dict with values being nested dicts so must iterate over filters.values()
+		for items in filters.values():   # and use items["filter_field"] to retrieve values inside nested dicts
+			query.add_filter(filter=build_filter(items))
+	return query
+
+
+def build_filter(items):
+	"""
+		turns one entry of the filters dict into a datastore filter, "or" / "and" entries hold their own
+		nested filters dict and "in" / "not_in" entries hold a list of values
+	"""
+	filter_op = str(items["filter_op"])
+	if filter_op.lower() == "or":
+		return Or([build_filter(sub_items) for sub_items in items["filters"].values()])
+	if filter_op.lower() == "and":
+		return And([build_filter(sub_items) for sub_items in items["filters"].values()])
+	if filter_op.lower() in ("in", "not_in"):
+		filter_op = filter_op.upper()
+	filter_field = items["filter_field"]
+	filter_value = items["filter_value"]
+	print(filter_field)
+	print(filter_op)
+	print(filter_value)
+	return PropertyFilter(filter_field, filter_op, filter_value)
+
+
+def apply_sort(query, sort):
+	"""
+		sets the order of the query from the sort dict used by read_data (only 1 sort allowed)
+	"""
+	if sort != None:
+		sort_direction = sort["sort_direction"]
+		sort_value = sort["sort_value"]
+		if sort_direction == "desc":
+				sort_string = "-" + str(sort_value)
+				query.order = [sort_string]
+		else:
+			query.order = [sort_value]
 
-def read_data(kind_id, key_id=None, object_type=None, filters=None, sort=None):
+
+def sort_key(entity, sort_value):
+	"""
+		sort key for ordering entities on the server, follows datastore's ordering of value types
+		(null < numbers < dates < booleans < bytes < strings) so mixed types never fail to compare
+	"""
+	value = entity.get(sort_value)
+	if value is None:
+		return (0, 0)
+	if isinstance(value, bool):
+		return (3, value)
+	if isinstance(value, (int, float)):
+		return (1, value)
+	if isinstance(value, datetime):
+		return (2, value)
+	if isinstance(value, bytes):
+		return (4, value)
+	if isinstance(value, str):
+		return (5, value)
+	return (6, str(value))
+
+
+def sort_in_memory(entities, sort, limit=None):
+	"""
+		sorts entities on the server using the sort dict used by read_data, with a small limit only a
+		bounded heap of the top limit entities is kept while the results stream in
+	"""
+	sort_value = sort["sort_value"]
+	descending = sort["sort_direction"] == "desc"
+	if limit != None and limit <= TOP_K_HEAP_LIMIT:
+		if descending:
+			return heapq.nlargest(limit, entities, key=lambda entity: sort_key(entity, sort_value))
+		return heapq.nsmallest(limit, entities, key=lambda entity: sort_key(entity, sort_value))
+	results = sorted(entities, key=lambda entity: sort_key(entity, sort_value), reverse=descending)
+	return results[:limit] if limit != None else results
+
+
+def query_fields(key_id=None, object_type=None, filters=None):
+	"""
+		list of (field, op) filtered on by a query, "in" counts as an equality and for "or" only the
+		first branch is used (every branch needs the same kind of index)
+	"""
+	fields = []
+	if key_id != None:
+		fields.append(("__key__", "="))
+	elif object_type != None:
+		fields.append(("object_type", "="))
+	for items in (filters or {}).values():
+		fields.extend(_first_option_fields(items))
+	return fields
+
+
+def _first_option_fields(items):
+	filter_op = str(items["filter_op"]).lower()
+	if filter_op == "or":
+		first_items = next(iter(items["filters"].values()))
+		return _first_option_fields(first_items)
+	if filter_op == "and":
+		fields = []
+		for sub_items in items["filters"].values():
+			fields.extend(_first_option_fields(sub_items))
+		return fields
+	if filter_op == "in":
+		return [(items["filter_field"], "=")]
+	return [(items["filter_field"], str(items["filter_op"]).upper())]
+
+
+def _filter_options(items):
+	# the AND-ed lists of plain filters that one entry of the filters dict expands to
+	filter_op = str(items["filter_op"]).lower()
+	if filter_op == "in":
+		return [[{"filter_field": items["filter_field"], "filter_op": "=", "filter_value": value}]
+				for value in items["filter_value"]]
+	if filter_op == "or":
+		options = []
+		for sub_items in items["filters"].values():
+			options.extend(_filter_options(sub_items))
+		return options
+	if filter_op == "and":
+		options = [[]]
+		for sub_items in items["filters"].values():
+			options = [option + sub_option for option in options for sub_option in _filter_options(sub_items)]
+		return options
+	return [[items]]
+
+
+def count_fanout_queries(filters):
+	"""
+		number of sub-queries the filters dict expands to when every "in" / "or" is split up,
+		1 means the filters have no disjunction
+	"""
+	total = 1
+	for items in filters.values():
+		total *= _count_options(items)
+	return total
+
+
+def _count_options(items):
+	filter_op = str(items["filter_op"]).lower()
+	if filter_op == "in":
+		return len(items["filter_value"])
+	if filter_op == "or":
+		return sum(_count_options(sub_items) for sub_items in items["filters"].values())
+	if filter_op == "and":
+		total = 1
+		for sub_items in items["filters"].values():
+			total *= _count_options(sub_items)
+		return total
+	return 1
+
+
+def expand_filters(filters):
+	"""
+		expands a filters dict containing "in" / "or" entries into a list of filters dicts with only
+		AND-ed plain filters, one per sub-query
+	"""
+	branches = [[]]
+	for items in filters.values():
+		branches = [branch + option for branch in branches for option in _filter_options(items)]
+	return [{"filter" + str(index): items for index, items in enumerate(branch)} for branch in branches]
+
+
+def _queue_put(results_queue, item, stop):
+	# blocks while the merge side is behind, gives up once the merge side has stopped reading
+	while not stop.is_set():
+		try:
+			results_queue.put(item, timeout=0.1)
+			return True
+		except queue.Full:
+			continue
+	return False
+
+
+def _queue_drain(results_queue):
+	while True:
+		item = results_queue.get()
+		if item is _FANOUT_DONE:
+			return
+		if isinstance(item, Exception):
+			raise item
+		yield item
+
+
+def fan_out_query(kind_id, key_id=None, object_type=None, filters=None, sort=None, read_options=None):
+	"""
+		runs a query with "in" / "or" filters as one datastore query per combination of values, all in
+		parallel, and yields the merged results de-duplicated by key. each sub-query is ordered by the
+		sort field so the streams are merge-sorted as they arrive instead of collected and sorted.
+		takes the same arguments as read_data
+	"""
+	branches = expand_filters(filters)
+	if len(branches) > MAX_FANOUT_QUERIES:
+		raise ValueError("Filters expand to " + str(len(branches)) + " sub-queries, the maximum is " + str(MAX_FANOUT_QUERIES))
+	stop = threading.Event()
+	result_queues = [queue.Queue(maxsize=FANOUT_QUEUE_SIZE) for branch in branches]
+
+	def run_branch(branch_filters, results_queue):
+		try:
+			query = build_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=branch_filters)
+			apply_sort(query, sort)
+			for entity in query.fetch(**(read_options or {})):
+				if not _queue_put(results_queue, entity, stop):
+					return
+		except Exception as e:
+			_queue_put(results_queue, e, stop)
+		_queue_put(results_queue, _FANOUT_DONE, stop)
+
+	# every sub-query needs its own worker, the merge waits on the head of every stream
+	executor = ThreadPoolExecutor(max_workers=len(branches))
+	try:
+		for branch_filters, results_queue in zip(branches, result_queues):
+			executor.submit(run_branch, branch_filters, results_queue)
+		streams = [_queue_drain(results_queue) for results_queue in result_queues]
+		if sort != None:
+			merged = heapq.merge(*streams, key=lambda entity: sort_key(entity, sort["sort_value"]),
+								 reverse=sort["sort_direction"] == "desc")
+		else:
+			merged = itertools.chain(*streams)
+		seen_keys = set()
+		for entity in merged:
+			if entity.key.flat_path in seen_keys:
+				continue
+			seen_keys.add(entity.key.flat_path)
+			yield entity
+	finally:
+		stop.set()
+		executor.shutdown(wait=False)
+
+
+def aggregate_data(kind_id, aggregations, key_id=None, object_type=None, filters=None, read_options=None):
+	"""
+		runs a server side aggregation query (count / sum / avg) so the entities never leave datastore,
+		takes the same key_id / object_type / filters / read_options arguments as read_data
+
+		aggregations example:  json format dictionary of key value pairs with aggregations inside nested dict,
+								the outer key is the name the result is returned under (max 5 per query)
+								{
+									"open_cases": {"aggregation_op": "count"},
+									"total_amount": {"aggregation_op": "sum",
+													 "aggregation_field": "amount"},
+									"average_nps": {"aggregation_op": "avg",
+													"aggregation_field": "nps_score"},
+								}
+		returns:  dictionary of aggregation name to value, i.e. {"open_cases": 42, "total_amount": 1200, ...}
+	"""
+	query = build_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters)
+	aggregation_query = datastore_client.aggregation_query(query)
+	for alias, items in aggregations.items():
+		aggregation_op = items["aggregation_op"]
+		if aggregation_op == "count":
+			aggregation_query.count(alias=alias)
+		elif aggregation_op == "sum":
+			aggregation_query.sum(items["aggregation_field"], alias=alias)
+		elif aggregation_op == "avg":
+			aggregation_query.avg(items["aggregation_field"], alias=alias)
+		else:
+			raise ValueError("Unsupported aggregation_op: " + str(aggregation_op))
+	shape = query_shape(kind_id, query_fields(key_id=key_id, object_type=object_type, filters=filters))
+	start_time = time.perf_counter()
+	aggregation_results = {}
+	try:
+		for result in aggregation_query.fetch(**(read_options or {})):
+			for aggregation in result:
+				aggregation_results[aggregation.alias] = aggregation.value
+	except Exception as e:
+		queryShapeRecorder.record(shape, time.perf_counter() - start_time, error=e, index_missing=isinstance(e, FailedPrecondition))
+		raise
+	queryShapeRecorder.record(shape, time.perf_counter() - start_time)
+	return aggregation_results
+
+
+def run_query(kind_id, key_id=None, object_type=None, filters=None, sort=None, limit=None, read_options=None):
+	"""
+		runs the query for read_data and returns the list of entities, "in" / "or" filters run natively
+		and fall back to fan_out_query when datastore can't take them in one query
+	"""
+	query = build_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters)
+	apply_sort(query, sort)
+	fanout_queries = count_fanout_queries(filters) if filters != None else 1
+	if fanout_queries > MAX_NATIVE_DISJUNCTIONS:
+		# more IN values / OR branches than datastore accepts in one query, split it up ourselves
+		return list(itertools.islice(fan_out_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters, sort=sort,
+																	read_options=read_options), limit))
+	try:
+		return list(query.fetch(limit=limit, **(read_options or {})))
+	except FailedPrecondition:
+		raise
+	except BadRequest as e:
+		if fanout_queries <= 1:
+			raise
+		print("Datastore rejected the IN / OR query, fanning out " + str(fanout_queries) + " sub-queries: " + str(e))
+		return list(itertools.islice(fan_out_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters, sort=sort,
+																	read_options=read_options), limit))
+
+
+def read_data(kind_id, key_id=None, object_type=None, filters=None, sort=None, limit=None, sort_fallback=False, read_options=None):
 	"""
 			request: needs to be json format dictionary of key value pairs 
 						and either key_id or object_type must be populated
@@ -236,58 +1009,96 @@ def read_data(kind_id, key_id=None, object_type=None, filters=None, sort=None):
 									"filter1": {"filter_field": "priority", 
 												"filter_op": "=",
 												"filter_value": "High"},
-									"filter2": {"filter_field": "created_date", 
+									"filter2": {"filter_field": "created_date",
 												"filter_op": ">=",
 												"filter_value": "2023-04-01"},
 								}
+			filters with "in" / "or":  "in" takes a list of values, "or" takes its own nested filters dict
+								{
+									"filter1": {"filter_field": "priority",
+												"filter_op": "in",
+												"filter_value": ["High", "Urgent"]},
+									"filter2": {"filter_op": "or",
+												"filters": {
+													"a": {"filter_field": "status", "filter_op": "=", "filter_value": "open"},
+													"b": {"filter_field": "escalated", "filter_op": "=", "filter_value": True},
+												}},
+								}
+							these run natively in datastore when possible, otherwise the query is split into one
+							sub-query per combination, run in parallel and merged on the sort field (see fan_out_query)
 			sort example:  json format dictionary of key value pairs
 							only 1 sort allowed due to bug in datastore
 									{
 										"sort_direction": "asc",
 										"sort_value": "due_date"
 									},
+			limit example:  10, max number of entities returned
+			sort_fallback example:  true, if datastore has no composite index for the filters + sort
+							the query is run without the sort and sorted on the server instead (the index
+							that would serve it is printed to the logs), with a small limit only the top
+							limit entities are kept in memory
+			read_options example:  {"eventual": True} or {"read_time": datetime}, see read_options
 	"""
-	query = datastore_client.query(kind=kind_id)
+	shape = query_shape(kind_id, query_fields(key_id=key_id, object_type=object_type, filters=filters), sort)
+	hotKeyTracker.record_query(shape)
 	if key_id != None:
-		query = datastore_client.query(kind=kind_id)
-		first_key = datastore_client.key(kind_id, key_id)
-		query.key_filter(first_key, "=")
-	elif object_type != None:
-		query = datastore_client.query(kind=kind_id)
-		query.add_filter("object_type", "=", object_type)
-	if filters != None:  # filters is python dict with values being nested dicts so must iterate over filters.values() 
-		for items in filters.values():   # and use items["filter_field"] to retrieve values inside nested dicts
-			filter_field = items["filter_field"]
-			filter_op = items["filter_op"]
-			filter_value = items["filter_value"]
-			print(filter_field)
-			print(filter_op)
-			print(filter_value)
-			query.add_filter(filter_field, filter_op, filter_value)
-	if sort != None:
-		sort_direction = sort["sort_direction"]
-		sort_value = sort["sort_value"]
-		if sort_direction == "desc":
-				sort_string = "-" + str(sort_value)
-				query.order = [sort_string]
-		else:
-			query.order = [sort_value]
-	results = list(query.fetch())
+		hotKeyTracker.record_read(kind_id, key_id)
+	start_time = time.perf_counter()
+	try:
+		results = run_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters, sort=sort, limit=limit,
+							read_options=read_options)
+	except FailedPrecondition as e:
+		# datastore has no composite index for this filter + sort combination
+		if sort == None or not sort_fallback:
+			queryShapeRecorder.record(shape, time.perf_counter() - start_time, error=e, index_missing=True)
+			raise
+		index = recommended_index(shape)
+		print("Missing composite index, sorting on the server instead. Index that would serve this query:")
+		print(index_yaml([index]) if index != None else str(e))
+		try:
+			if filters != None and count_fanout_queries(filters) > MAX_NATIVE_DISJUNCTIONS:
+				unsorted_results = fan_out_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters,
+												 read_options=read_options)
+			else:
+				unsorted_results = build_query(kind_id=kind_id, key_id=key_id, object_type=object_type, filters=filters).fetch(**(read_options or {}))
+			results = sort_in_memory(unsorted_results, sort, limit=limit)
+		except Exception as fallback_error:
+			queryShapeRecorder.record(shape, time.perf_counter() - start_time, error=fallback_error, index_missing=True)
+			raise
+		queryShapeRecorder.record(shape, time.perf_counter() - start_time, index_missing=True)
+	except Exception as e:
+		queryShapeRecorder.record(shape, time.perf_counter() - start_time, error=e)
+		raise
+	else:
+		queryShapeRecorder.record(shape, time.perf_counter() - start_time)
 	if not results:
 		return "No result is returned"
 	else:
-		data_list = []
-		for index in range(len(results)):
-			d = dict(results[index])
-			if results[index].key.id == None:
-				d["key_id"] = results[index].key.name
-			else:
-				d["key_id"] = results[index].key.id
-			data_list.append(d)
+		data_list = entities_to_dicts(kind_id, results, read_options=read_options)
 		return data_list
 
 
-def update_data(kind_id, key_id, data):
+def get_data(kind_id, key_ids, read_options=None):
+	"""
+		looks up several entities of a kind by key with one get_multi (batch get), cheaper than a query
+
+		args:
+			kind_id:  name/ID of the kind, example: "client000000001"
+			key_ids:  list of key_ids, example: ["customer000000001", "customer000000002"]
+			read_options:  see read_data
+
+		returns (list of entities as dictionaries in the order of key_ids, list of the key_ids not found)
+	"""
+	for key_id in key_ids:
+		hotKeyTracker.record_read(kind_id, key_id)
+	keys = [datastore_client.key(kind_id, key_id) for key_id in key_ids]
+	entities = datastore_client.get_multi(keys, **(read_options or {}))
+	found = {entity.key.id_or_name: entity for entity in entities}
+	data_list = entities_to_dicts(kind_id, [found[key_id] for key_id in key_ids if key_id in found], read_options=read_options)
+	return data_list, [key_id for key_id in key_ids if key_id not in found]
+
+
+def update_data(kind_id, key_id, data, operations=None):
 	"""
 		args:
 			kind_id:  name/ID of the kind 'ClientID', example: "client000000001", (client000000001, client000000002, etc. it would be the ID's of customers)
@@ -295,15 +1106,148 @@ def update_data(kind_id, key_id, data):
 			   			example:  update customer then key_id = "customer000000001" 
 									or update case then key_id = "case000000001" 
 			data:  needs to be json format dictionary of values, the data would be the key value pairs of fields "customers", "nps", "surveys", etc.
+			operations:  json format dictionary of atomic operations applied on the server (optional)
+							{
+								"cases_open": {"op": "increment", "value": 1},   (value defaults to 1)
+								"cases_closed": {"op": "decrement", "value": 2},
+								"tags": {"op": "append", "value": "vip"},   (value can be a list)
+								"watchers": {"op": "remove", "value": ["user1", "user2"]},
+							}
+						increments / decrements of the kind's sharded counters (api_config.json "sharded_counters")
+						go to a random shard instead of the entity and are summed on read
+
+		the transaction is retried when datastore aborts it because of a concurrent update (counted as write
+		contention of the key in /api/v1/hotkeys), the entity gets a new updated_at and version (sharded
+		counter increments don't touch the entity, so they don't), returns the new values of the fields
+		changed by operations (sharded counters excluded)
+		raises NotFound when the entity doesn't exist, before any sharded counter is incremented
 	"""
-	with datastore_client.transaction():
-		complete_key = datastore_client.key(kind_id, key_id)
-		task = datastore_client.get(complete_key)
-		for prop in task:
-			task[prop] = task[prop]
-		for items in data:
-			task[items] = data[items]
-		datastore_client.put(task)
+	operations = operations or {}
+	sharded_fields = kind_config("sharded_counters", kind_id) or {}
+	shard_operations = {field: items for field, items in operations.items()
+						if field in sharded_fields and items["op"] in ("increment", "decrement")}
+	entity_operations = {field: items for field, items in operations.items() if field not in shard_operations}
+	search_fields = kind_config("search_fields", kind_id)
+	rollup_definitions = kind_config("rollups", kind_id)
+	hotKeyTracker.record_write(kind_id, key_id)
+	attempts = []
+
+	def update_in_transaction():
+		attempts.append(1)
+		with datastore_client.transaction():
+			complete_key = datastore_client.key(kind_id, key_id)
+			task = datastore_client.get(complete_key)
+			if task == None:
+				raise NotFound("Entity " + str(key_id) + " of " + str(kind_id) + " doesn't exist")
+			schemaRegistry.decode(task)
+			old_task = dict(task)
+			for prop in task:
+				task[prop] = task[prop]
+			for items in data:
+				task[items] = data[items]
+			new_values = apply_operations(task, entity_operations)
+			changeFeed.stamp(task, old_task)
+			new_task = dict(task)
+			datastore_client.put(schemaRegistry.prepare(kind_id, task))
+			for field in data:
+				if field in sharded_fields:
+					# setting a sharded counter directly replaces whatever the shards added up to
+					shardedCounter.reset(kind_id, key_id, field, sharded_fields[field])
+			if search_fields:
+				searchIndex.update(kind_id, key_id, old_task, new_task, search_fields)
+			return new_values, old_task, new_task
+
+	new_values = {}
+	if data or entity_operations:
+		try:
+			new_values, old_task, new_task = run_in_transaction(update_in_transaction)
+		except Conflict:
+			hotKeyTracker.record_contention(kind_id, key_id, len(attempts))
+			raise
+		if len(attempts) > 1:
+			hotKeyTracker.record_contention(kind_id, key_id, len(attempts) - 1)
+		if rollup_definitions:
+			materializedRollups.apply(kind_id, rollup_definitions, [(old_task, new_task)])
+	elif shard_operations and datastore_client.get(datastore_client.key(kind_id, key_id)) == None:
+		# the shards of an entity that doesn't exist would never be read or deleted
+		raise NotFound("Entity " + str(key_id) + " of " + str(kind_id) + " doesn't exist")
+	for field, items in shard_operations.items():
+		shardedCounter.increment(kind_id, key_id, field, operation_delta(items), sharded_fields[field])
+	return new_values
+
+
+def flush_coalesced_writes(items):
+	"""
+		writes a batch of updates merged by the write-behind buffer, one transaction (get_multi + put_multi)
+		per chunk of keys of a kind so concurrent non-buffered updates aren't overwritten, sharded counters
+		set directly are reset in the same transaction like update_data does
+
+		args:
+			items:  list of (kind_id, key_id, data), one per key
+
+		returns the items of the chunks that couldn't be written, for the buffer to retry (the chunks
+		written aren't written again), the search index and rollups of the written chunks are updated
+		afterwards and a failure there is logged, not retried
+	"""
+	batches = {}
+	for kind_id, key_id, data in items:
+		batches.setdefault(kind_id, []).append((key_id, data))
+	failed = []
+	for kind_id, updates in batches.items():
+		search_fields = kind_config("search_fields", kind_id)
+		rollup_definitions = kind_config("rollups", kind_id)
+		sharded_fields = kind_config("sharded_counters", kind_id) or {}
+		# chunks of WRITE_BEHIND_CHUNK_SIZE keys, or fewer when the sharded counter resets would take the
+		# transaction past the mutations datastore accepts in one commit
+		chunks = [[]]
+		mutations = 0
+		for key_id, data in updates:
+			key_mutations = 1 + sum(sharded_fields[field] for field in data if field in sharded_fields)
+			if chunks[-1] and (len(chunks[-1]) >= WRITE_BEHIND_CHUNK_SIZE or mutations + key_mutations > MAX_COMMIT_MUTATIONS):
+				chunks.append([])
+				mutations = 0
+			chunks[-1].append((key_id, data))
+			mutations += key_mutations
+		for chunk in chunks:
+
+			def write_chunk():
+				with datastore_client.transaction():
+					keys = [datastore_client.key(kind_id, key_id) for key_id, data in chunk]
+					tasks = {task.key.id_or_name: task for task in datastore_client.get_multi(keys)}
+					changes = []
+					for key_id, data in chunk:
+						task = tasks.get(key_id)
+						if task == None:
+							print("Write-behind update skipped, entity no longer exists: " + str(kind_id) + " " + str(key_id))
+							continue
+						schemaRegistry.decode(task)
+						old_task = dict(task)
+						task.update(data)
+						changeFeed.stamp(task, old_task)
+						changes.append((key_id, old_task, dict(task)))
+						schemaRegistry.prepare(kind_id, task)
+						for field in data:
+							if field in sharded_fields:
+								# setting a sharded counter directly replaces whatever the shards added up to
+								shardedCounter.reset(kind_id, key_id, field, sharded_fields[field])
+					datastore_client.put_multi([tasks[key_id] for key_id, old_task, new_task in changes])
+					return changes
+
+			try:
+				changes = run_in_transaction(write_chunk)
+			except Exception as e:
+				print("Write-behind chunk of " + str(kind_id) + " failed, it will be retried: " + str(e))
+				failed.extend((kind_id, key_id, data) for key_id, data in chunk)
+				continue
+			if search_fields:
+				try:
+					searchIndex.update_many(kind_id, changes, search_fields)
+				except Exception as e:
+					# retrying would find the entities already written and leave the index as it is
+					print("Couldn't update the search index after a write-behind flush of " + str(kind_id) + ": " + str(e))
+			if rollup_definitions:
+				materializedRollups.apply(kind_id, rollup_definitions, [(old_task, new_task) for key_id, old_task, new_task in changes])
+	return failed
 
 
 def create_data(kind_id, data, key_id=None):
@@ -315,35 +1259,244 @@ def create_data(kind_id, data, key_id=None):
 							  		or update cta then key_id = "cta000000001"
 									or update case then key_id = "case000000001" 
 			data:  needs to be json format dictionary of values, the data would be the key value pairs of fields "customers", "nps", "surveys", etc.
+
+		the entity is stamped with updated_at and version 1, also when it replaces an existing entity
+		returns the key_id of the created entity (the generated id when key_id is not provided)
 	"""
+	search_fields = kind_config("search_fields", kind_id)
+	rollup_definitions = kind_config("rollups", kind_id)
 	if key_id == None:
-		# if key_id is None, then it will auto generate a key_id
-		complete_key = datastore_client.key(kind_id)
-		task = datastore.Entity(key=complete_key)
-		task.update(data)
-		datastore_client.put(task)
+		# if key_id is None, then it will auto generate a key_id from the pool of reserved ids
+		complete_key = keyIdPool.take(kind_id)[0]
 	else:
 		complete_key = datastore_client.key(kind_id, key_id)
-		task = datastore.Entity(key=complete_key)
-		# CREATING OBJECT (even though the function is called update, it is creating an object)
-		task.update(data)
+	task = datastore.Entity(key=complete_key)
+	# CREATING OBJECT (even though the function is called update, it is creating an object)
+	task.update(data)
+	changeFeed.stamp(task)
+	new_task = dict(task)
+	schemaRegistry.prepare(kind_id, task)
+	old_task = None
+	if search_fields or rollup_definitions:
+		# the replaced entity is read in the same transaction, to take it out of the index / rollups
+		with datastore_client.transaction():
+			old_task = datastore_client.get(complete_key) if key_id != None else None
+			if old_task != None:
+				schemaRegistry.decode(old_task)
+			datastore_client.put(task)
+			if search_fields:
+				searchIndex.update(kind_id, complete_key.id_or_name, old_task, data, search_fields)
+	else:
 		datastore_client.put(task)
+	if rollup_definitions:
+		materializedRollups.apply(kind_id, rollup_definitions, [(old_task, new_task)])
+	if key_id != None:
+		# an existing entity is replaced, so are its sharded counters
+		sharded_fields = kind_config("sharded_counters", kind_id) or {}
+		for field, num_shards in sharded_fields.items():
+			shardedCounter.reset(kind_id, key_id, field, num_shards)
+	return complete_key.id_or_name
+
+
+def create_data_bulk(kind_id, items):
+	"""
+		creates many entities of a kind with parallel put_multi batches, every auto-keyed entity gets its
+		key from the pool of reserved ids up front so the batches don't depend on each other
+
+		args:
+			kind_id:  name/ID of the kind, example: "client000000001"
+			items:  list of {"key_id": "" (optional), "data": {}} with the same meaning as create_data
+
+		returns the list of key_ids created, in the order of items
+		raises ValueError when an item isn't a dictionary with a data dictionary, before anything is written
+	"""
+	for position, item in enumerate(items):
+		if not isinstance(item, dict) or not isinstance(item.get("data"), dict):
+			raise ValueError("Item " + str(position) + " needs to be a dictionary with a data dictionary")
+	missing_keys = sum(1 for item in items if item.get("key_id") == None)
+	pooled_keys = iter(keyIdPool.take(kind_id, missing_keys)) if missing_keys else iter([])
+	tasks = []
+	for item in items:
+		if item.get("key_id") == None:
+			complete_key = next(pooled_keys)
+		else:
+			complete_key = datastore_client.key(kind_id, item["key_id"])
+		task = datastore.Entity(key=complete_key)
+		task.update(item["data"])
+		tasks.append(task)
+	write_entities(kind_id, tasks)
+	return [task.key.id_or_name for task in tasks]
+
+
+def write_entities(kind_id, tasks):
+	"""
+		writes complete entities of a kind in parallel put_multi batches of BULK_WRITE_CHUNK_SIZE, keeping the
+		search index, sharded counters and rollups of the replaced entities in line like create_data does,
+		the search tokens of every batch are merged and written once all batches are written (one retried
+		transaction per batch of token entities, see SearchIndex.update_many)
+
+		tasks are the unstamped entities, every batch is stamped for the change feed right before it's
+		committed, so a batch committed late doesn't land behind change tokens already handed out
+	"""
+	search_fields = kind_config("search_fields", kind_id)
+	sharded_fields = kind_config("sharded_counters", kind_id) or {}
+	rollup_definitions = kind_config("rollups", kind_id)
+
+	def stamp_chunk(chunk, old_tasks):
+		# fresh copies every attempt, prepared values (compressed) can't be prepared again on a retry
+		now = changeFeed.now()
+		entities = []
+		for task in chunk:
+			entity = datastore.Entity(key=task.key)
+			entity.update(task)
+			changeFeed.stamp(entity, old_tasks.get(task.key.id_or_name), now=now)
+			entities.append(entity)
+		new_tasks = [dict(entity) for entity in entities]
+		for entity in entities:
+			schemaRegistry.prepare(kind_id, entity)
+		return entities, new_tasks
+
+	def write_chunk(chunk):
+
+		def write_in_transaction():
+			# the replaced entities are read in the same transaction, so a concurrent update between the
+			# read and the write can't leave the index / rollups diffed against stale properties
+			with datastore_client.transaction():
+				old_tasks = {task.key.id_or_name: schemaRegistry.decode(task) for task in datastore_client.get_multi([task.key for task in chunk])}
+				entities, new_tasks = stamp_chunk(chunk, old_tasks)
+				datastore_client.put_multi(entities)
+				return old_tasks, new_tasks
+
+		if search_fields or sharded_fields or rollup_definitions:
+			old_tasks, new_tasks = run_in_transaction(write_in_transaction)
+		else:
+			old_tasks = {}
+			entities, new_tasks = stamp_chunk(chunk, old_tasks)
+			datastore_client.put_multi(entities)
+		for task in chunk:
+			key_id = task.key.id_or_name
+			if key_id in old_tasks:
+				# an existing entity is replaced, so are its sharded counters
+				for field, num_shards in sharded_fields.items():
+					shardedCounter.reset(kind_id, key_id, field, num_shards)
+		if rollup_definitions:
+			materializedRollups.apply(kind_id, rollup_definitions, [(old_tasks.get(task.key.id_or_name), new_task)
+														for task, new_task in zip(chunk, new_tasks)])
+		return [(task.key.id_or_name, old_tasks.get(task.key.id_or_name), new_task) for task, new_task in zip(chunk, new_tasks)]
+
+	chunks = [tasks[start:start + BULK_WRITE_CHUNK_SIZE] for start in range(0, len(tasks), BULK_WRITE_CHUNK_SIZE)]
+	if len(chunks) == 1:
+		changes = write_chunk(chunks[0])
+	else:
+		with ThreadPoolExecutor(max_workers=BULK_WRITE_WORKERS) as executor:
+			changes = [change for chunk_changes in executor.map(write_chunk, chunks) for change in chunk_changes]
+	if search_fields:
+		# serially after the batches, so they don't overwrite each other's changes to shared tokens
+		searchIndex.update_many(kind_id, changes, search_fields)
 
 
 def delete_data(kind_id, key_id, entity_property=None):
+	search_fields = kind_config("search_fields", kind_id)
+	rollup_definitions = kind_config("rollups", kind_id)
+	# (old, new) properties of the entity, for the rollups
+	changes = []
 	if entity_property != None:
 		with datastore_client.transaction():
 			key = datastore_client.key(kind_id, key_id)
-			task = datastore_client.get(key)
+			task = schemaRegistry.decode(datastore_client.get(key))
 			if entity_property in task:
+				old_task = dict(task)
 				del task[entity_property]
-				datastore_client.put(task)
+				changeFeed.stamp(task, old_task)
+				new_task = dict(task)
+				datastore_client.put(schemaRegistry.prepare(kind_id, task))
+				if search_fields:
+					searchIndex.update(kind_id, key_id, old_task, new_task, search_fields)
+				changes.append((old_task, new_task))
+	elif search_fields or rollup_definitions:
+		with datastore_client.transaction():
+			key = datastore_client.key(kind_id, key_id)
+			old_task = datastore_client.get(key)
+			datastore_client.delete(key)
+			datastore_client.put(changeFeed.tombstone(kind_id, key_id))
+			if old_task != None:
+				schemaRegistry.decode(old_task)
+				if search_fields:
+					searchIndex.update(kind_id, key_id, old_task, None, search_fields)
+				changes.append((old_task, None))
 	else:
-		key = datastore_client.key(kind_id, key_id)
-		datastore_client.delete(key)
+		# the tombstone commits with the delete, so the change feed can't miss it
+		with datastore_client.transaction():
+			key = datastore_client.key(kind_id, key_id)
+			datastore_client.delete(key)
+			datastore_client.put(changeFeed.tombstone(kind_id, key_id))
+	sharded_fields = kind_config("sharded_counters", kind_id) or {}
+	for field, num_shards in sharded_fields.items():
+		if entity_property == None or entity_property == field:
+			shardedCounter.reset(kind_id, key_id, field, num_shards)
+	if rollup_definitions and changes:
+		materializedRollups.apply(kind_id, rollup_definitions, changes)
+
+
+def changes_data(kind_id, token=None, limit=PAGE_SIZE, object_type=None):
+	"""
+		returns the changes of a kind after a token, oldest first, for clients syncing only the delta
+
+		args:
+			kind_id:  name/ID of the kind, example: "client000000001"
+			token:  next_token returned by the previous call, None for the first sync
+			limit:  max number of changes returned
+			object_type:  only changes to entities of this object_type (deletes are returned for every object_type)
+
+		returns (list of changes, next_token, has_more), a change is
+			{"key_id": "", "deleted": false, "updated_at": "", "version": 1, "data": {}}  or
+			{"key_id": "", "deleted": true, "updated_at": ""}
+	"""
+	page, next_token, has_more = changeFeed.changes(kind_id, token=token, limit=limit, object_type=object_type)
+	updated = entities_to_dicts(kind_id, [entity for entity, deleted in page if not deleted])
+	updated = iter(updated)
+	changes = []
+	for entity, deleted in page:
+		if deleted:
+			changes.append({"key_id": entity.key.id_or_name, "deleted": True, "updated_at": entity[DELETED_AT].isoformat()})
+		else:
+			data = next(updated)
+			changes.append({"key_id": data["key_id"], "deleted": False, "updated_at": data.get(UPDATED_AT),
+							"version": data.get(VERSION), "data": data})
+	return changes, next_token, has_more
+
+
+def search_data(kind_id, query, fields=None, object_type=None, limit=None, match="prefix"):
+	"""
+		answers prefix / term searches from the search index kept for the kind's search fields
+		(api_config.json "search_fields"), see SearchIndex.search
+
+		args:
+			kind_id:  name/ID of the kind, example: "client000000001"
+			query:  search text, example: "acme cor" finds entities with words starting with "acme" and "cor"
+			fields:  list of search fields to search (optional, defaults to every search field of the kind)
+			object_type:  only return entities of this object_type, example: "customer" (optional)
+			limit:  max number of entities returned (optional)
+			match:  "prefix" (default) or "term" to only match whole words
+	"""
+	search_fields = kind_config("search_fields", kind_id) or []
+	if fields != None:
+		unknown_fields = [field for field in fields if field not in search_fields]
+		if unknown_fields:
+			raise ValueError("Not a search field of " + str(kind_id) + ": " + ", ".join(unknown_fields))
+		search_fields = fields
+	if not search_fields:
+		raise ValueError("No search fields are configured for " + str(kind_id))
+	results = searchIndex.search(kind_id, query, search_fields, limit=None if object_type != None else limit, match=match)
+	if object_type != None:
+		results = [entity for entity in results if entity.get("object_type") == object_type]
+		if limit != None:
+			results = results[:limit]
+	return entities_to_dicts(kind_id, results)
 
 
 class ReadData(Resource):
+	@authenticator.required
 	def post(self):
 		"""
 			{
@@ -352,8 +1505,28 @@ class ReadData(Resource):
 			object_type: "", (optional)
 			filters: {}, (optional)
 			sort: {} (optional)
+			limit: int (optional)
+			sort_fallback: bool (optional)
+			aggregations: {} (optional)
+			key_ids: array (optional)
+			read_consistency: "" (optional)
+			read_time: "" (optional)
 			}
 
+			if key_ids is provided (at most 1000), the entities are looked up by key with one batch get instead of
+			a query and returned in the order of key_ids, with the key_ids that weren't found under "missing_key_ids"
+
+			read_consistency example:  "eventual", lower latency reads that may not include the writes of the last
+							few seconds (default "strong")
+			read_time example:  "2024-05-01T12:00:00Z", reads the data as it was at that time, a consistent snapshot
+							(within the last hour, or the point-in-time recovery window if enabled)
+
+			if aggregations is provided, the query is run as a datastore aggregation query (count / sum / avg)
+			and only the aggregated values are returned (sort is ignored), see aggregate_data for examples
+						{
+							"aggregations": {"open_cases": {"aggregation_op": "count"}}
+						}
+
 			filters example:  json format dictionary of key value pairs with filters inside nested dict
 						{
 							"filter1": {"filter_field": "priority", 
@@ -369,61 +1542,404 @@ class ReadData(Resource):
 										"sort_direction": "asc",
 										"sort_value": "due_date"
 									},
+			limit example:  10, max number of entities returned
+			sort_fallback example:  true, sort on the server when datastore has no composite index for the filters + sort
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			query_data = request.get_json()
-			kind_id = query_data["kind_id"]
-			if "key_id" in query_data.keys():
-				key_id_criteria = query_data["key_id"]
-				if ("filters" not in query_data.keys()) and ("sort" not in query_data.keys()):
-					retrieved_data = read_data(kind_id=kind_id, key_id=key_id_criteria)
-				elif ("filters" in query_data.keys()) and ("sort" not in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					retrieved_data = read_data(kind_id=kind_id, key_id=key_id_criteria, filters=filters_criteria)
-				elif ("filters" not in query_data.keys()) and ("sort" in query_data.keys()):
-					sort_criteria = query_data["sort"]
-					retrieved_data = read_data(kind_id=kind_id, key_id=key_id_criteria, sort=sort_criteria)
-				elif ("filters" in query_data.keys()) and ("sort" in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					sort_criteria = query_data["sort"]
-					retrieved_data = read_data(kind_id=kind_id, key_id=key_id_criteria, filters=filters_criteria, sort=sort_criteria)
-			elif "object_type" in query_data.keys():
-				object_type_criteria = query_data["object_type"]
-				if ("filters" not in query_data.keys()) and ("sort" not in query_data.keys()):
-					retrieved_data = read_data(kind_id=kind_id, object_type=object_type_criteria)
-				elif ("filters" in query_data.keys()) and ("sort" not in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					retrieved_data = read_data(kind_id=kind_id, object_type=object_type_criteria, filters=filters_criteria)
-				elif ("filters" not in query_data.keys()) and ("sort" in query_data.keys()):
-					sort_criteria = query_data["sort"]
-					retrieved_data = read_data(kind_id=kind_id, object_type=object_type_criteria, sort=sort_criteria)
-				elif ("filters" in query_data.keys()) and ("sort" in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					sort_criteria = query_data["sort"]
-					retrieved_data = read_data(kind_id=kind_id, object_type=object_type_criteria, filters=filters_criteria, sort=sort_criteria)
-			else:
-				if ("filters" in query_data.keys()) and ("sort" not in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					retrieved_data = read_data(kind_id=kind_id, filters=filters_criteria)
-				elif ("filters" in query_data.keys()) and ("sort" in query_data.keys()):
-					filters_criteria = query_data["filters"]
-					sort_criteria = query_data["sort"]
-					retrieved_data = read_data(kind_id=kind_id, filters=filters_criteria, sort=sort_criteria)
+		query_data = request.get_json()
+		kind_id = query_data["kind_id"]
+		try:
+			options = read_options(query_data.get("read_consistency"), query_data.get("read_time"))
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		if "key_ids" in query_data.keys():
+			key_ids = query_data["key_ids"]
+			if not isinstance(key_ids, list) or not key_ids or len(key_ids) > MAX_BATCH_GET_KEYS:
+				return {"status": "error", "error": "key_ids needs to be a list of 1 to " + str(MAX_BATCH_GET_KEYS) + " key_ids"}, 400
+			try:
+				retrieved_data, missing_key_ids = get_data(kind_id=kind_id, key_ids=key_ids, read_options=options)
+			except InvalidArgument as e:
+				# i.e. a read_time datastore can't serve
+				return {"status": "error", "error": str(e)}, 400
+			return {
+				"retrieved_data": retrieved_data if retrieved_data else "No result is returned",
+				"missing_key_ids": missing_key_ids
+			}
+		if "aggregations" in query_data.keys():
+			try:
+				aggregation_results = aggregate_data(kind_id=kind_id, aggregations=query_data["aggregations"],
+									  key_id=query_data.get("key_id"), object_type=query_data.get("object_type"),
+									  filters=query_data.get("filters"), read_options=options)
+			except (KeyError, ValueError) as e:
+				return {"status": "error", "error": "Invalid aggregations: " + str(e)}, 400
+			except InvalidArgument as e:
+				return {"status": "error", "error": str(e)}, 400
 			return {
-				"retrieved_data": retrieved_data 
+				"aggregation_results": aggregation_results
 			}
+		if ("filters" in query_data.keys()) and (count_fanout_queries(query_data["filters"]) > MAX_FANOUT_QUERIES):
+			return {"status": "error", "error": "Too many in / or combinations, the maximum is " + str(MAX_FANOUT_QUERIES)}, 400
+		if ("key_id" not in query_data.keys()) and ("object_type" not in query_data.keys()) and ("filters" not in query_data.keys()):
+			return {"status": "error", "error": "key_id, object_type or filters is required"}, 400
+		limit = query_data.get("limit")
+		if limit != None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+			return {"status": "error", "error": "limit needs to be a positive integer"}, 400
+		# key_id takes precedence over object_type when both are provided
+		try:
+			retrieved_data = read_data(kind_id=kind_id, key_id=query_data.get("key_id"),
+							  object_type=query_data.get("object_type") if "key_id" not in query_data.keys() else None,
+							  filters=query_data.get("filters"), sort=query_data.get("sort"),
+							  limit=limit, sort_fallback=query_data.get("sort_fallback", False),
+							  read_options=options)
+		except InvalidArgument as e:
+			return {"status": "error", "error": str(e)}, 400
+		return {
+			"retrieved_data": retrieved_data 
+		}
+
+
+class SearchData(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+
+			{
+				kind_id: "", (required)
+				query: "", (required)
+				fields: array, (optional) (defaults to every search field of the kind in api_config.json)
+				object_type: "", (optional)
+				limit: int, (optional) (1 to 1000)
+				match: "" (optional) ("prefix" (default) or "term")
+			}
+
+			query example:  "acme cor" returns the entities with a word starting with "acme" and a word starting with "cor"
+							in their search fields, every word needs at least 2 characters
+		"""
+		search_request = request.get_json()
+		kind_id = search_request["kind_id"]
+		limit = search_request.get("limit")
+		if limit != None and (not isinstance(limit, int) or isinstance(limit, bool) or not 1 <= limit <= MAX_SEARCH_LIMIT):
+			return {"status": "error", "error": "limit needs to be an integer from 1 to " + str(MAX_SEARCH_LIMIT)}, 400
+		try:
+			retrieved_data = search_data(kind_id=kind_id, query=search_request["query"], fields=search_request.get("fields"),
+							  object_type=search_request.get("object_type"), limit=limit,
+							  match=search_request.get("match", "prefix"))
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		if not retrieved_data:
+			retrieved_data = "No result is returned"
+		return {
+			"retrieved_data": retrieved_data
+		}
+
+
+class Changes(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+
+			{
+				kind_id: "", (required)
+				token: "", (optional) (next_token of the previous call, leave it out on the first sync)
+				object_type: "", (optional)
+				limit: int (optional) (default 100, at most 1000)
+			}
+
+			returns the entities created / updated and the key_ids deleted after the token, oldest first, with
+			next_token to send on the next call (also when has_more is false, to pick up later changes).
+			changes show up a couple of seconds after they're written, deletes are kept as tombstones for
+			30 days (api_config.json "change_feed" tombstone_days), clients that haven't synced for longer
+			need to read everything again
+		"""
+		changes_request = request.get_json()
+		kind_id = changes_request["kind_id"]
+		try:
+			changes, next_token, has_more = changes_data(kind_id=kind_id, token=changes_request.get("token"),
+														  limit=changes_request.get("limit", PAGE_SIZE),
+														  object_type=changes_request.get("object_type"))
+		except (TypeError, ValueError) as e:
+			return {"status": "error", "error": str(e)}, 400
+		return {
+			"changes": changes,
+			"next_token": next_token,
+			"has_more": has_more
+		}
+
+
+class ReadRollups(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+
+			{
+				kind_id: "", (required)
+				rollup: "", (optional) (name of one rollup in api_config.json "rollups", defaults to every rollup of the kind)
+				group: {}, (optional) (only the groups with these group_by values, i.e. {"object_type": "case"})
+				rebuild: bool (optional) (recompute the rollup from every entity of the kind in the background)
+			}
+
+			returns the rollups of the kind, kept up to date by every create / update / delete, read with one query:
+						{
+							"rollups": {"by_status": [{"group": {"object_type": "case", "status": "open"}, "count": 12,
+													   "sums": {"amount": 1200}}, ...]}
+						}
+			rebuild a rollup after adding it to a kind that already has entities: the request returns right
+			away (202) with the state of the rebuild, which reads the whole kind in the background (writes made
+			while it runs can be missed), later reads of that rollup return the state as "rebuild"
+		"""
+		rollup_request = request.get_json()
+		kind_id = rollup_request["kind_id"]
+		name = rollup_request.get("rollup")
+		rollup_definitions = kind_config("rollups", kind_id) or {}
+		if not rollup_definitions or (name != None and name not in rollup_definitions):
+			return {"status": "error", "error": "No rollup " + str(name or "") + " is configured for " + str(kind_id)}, 400
+		if rollup_request.get("rebuild", False):
+			if name == None:
+				return {"status": "error", "error": "rebuild needs a rollup"}, 400
+			return {"status": "accepted", "rebuild": materializedRollups.start_rebuild(kind_id, rollup_definitions, name)}, 202
+		results = materializedRollups.read(kind_id, rollup_definitions, name=name)
+		group = rollup_request.get("group")
+		if group:
+			results = {rollup: [item for item in groups if all(item["group"].get(field) == value for field, value in group.items())]
+					   for rollup, groups in results.items()}
+		response = {"rollups": results}
+		if name != None:
+			response["rebuild"] = materializedRollups.rebuild_status(kind_id, name)
+		return response
+
+
+class ExportData(Resource):
+
+	@authenticator.required
+	@idempotencyStore.idempotent
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first job back instead of starting another
+
+			{
+				kind_id: "", (required)
+				format: "", (optional) ("ndjson" (default) or "csv")
+				object_type: "", (optional)
+				fields: array, (optional) (csv columns after key_id, defaults to the properties of the first entities read)
+				bucketName: "", (optional) (defaults to the kind's bucket, named kind_id)
+				folderName: "", (optional) (defaults to "exports")
+				read_consistency: "", (optional) ("eventual" for lower latency reads, see /api/v1/read)
+				read_time: "", (optional) (export the data as it was at that time, see /api/v1/read)
+				snapshot: bool (optional) (export the data as it was when the job started, in every page, the
+						   export then needs to finish within the hour or the point-in-time recovery window)
+			}
+
+			starts a background job writing the entities to <folderName>/<kind_id>-<job_id>-00000.<format>, one object
+			per 100000 entities, and returns it (202), follow it with /api/v1/transfer. ndjson keeps the JSON types
+			of the values, csv cells hold json for everything but plain strings; datetimes (i.e. updated_at) are
+			written as ISO 8601 strings and import back as strings
+		"""
+		export_request = request.get_json()
+		kind_id = export_request["kind_id"]
+		try:
+			options = read_options(export_request.get("read_consistency"), export_request.get("read_time"))
+			job = transferJobs.start_export(kind_id, file_format=export_request.get("format", "ndjson"),
+											bucket_name=export_request.get("bucketName"),
+											folder=export_request.get("folderName", "exports"),
+											object_type=export_request.get("object_type"), fields=export_request.get("fields"),
+											read_options=options, snapshot=export_request.get("snapshot", False))
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		return job, 202
+
+
+class ImportData(Resource):
+
+	@authenticator.required
+	@idempotencyStore.idempotent
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first job back instead of starting another
+
+			{
+				kind_id: "", (required)
+				fileName: "", (required) (folder path + file name of the object, i.e. "imports/customers.ndjson")
+				format: "", (optional) ("ndjson" or "csv", defaults to the file extension)
+				bucketName: "" (optional) (defaults to the kind's bucket, named kind_id)
+			}
+
+			starts a background job creating an entity per line (ndjson) or row (csv, the first row names the columns),
+			like /api/v1/createbulk: a "key_id" field / column is the key, records without one get a generated key.
+			csv values are imported as strings, empty cells are left out. invalid records are skipped and reported
+			with their byte offset. returns the job (202), follow it with /api/v1/transfer
+		"""
+		import_request = request.get_json()
+		kind_id = import_request["kind_id"]
+		file_name = import_request.get("fileName")
+		if not file_name:
+			return {"status": "error", "error": "fileName is required"}, 400
+		try:
+			job = transferJobs.start_import(kind_id, file_name, file_format=import_request.get("format"),
+											bucket_name=import_request.get("bucketName"))
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		return job, 202
+
+
+class TransferJob(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+
+			{
+				kind_id: "", (required)
+				job_id: "", (required)
+				resume: bool (optional)
+			}
+
+			returns an export / import job: status (queued, running, interrupted, failed or done), entities exported or
+			records imported, bytes, the objects written, skipped records and their errors. with resume, a failed or
+			interrupted job (i.e. its instance shut down) continues from its last checkpoint
+		"""
+		job_request = request.get_json()
+		kind_id = job_request["kind_id"]
+		job_id = job_request["job_id"]
+		if job_request.get("resume", False):
+			try:
+				job = transferJobs.resume(kind_id, job_id)
+			except ValueError as e:
+				return {"status": "error", "error": str(e)}, 409
 		else:
-			return {"message": "Authentication failed"}, 403
+			job = transferJobs.status(kind_id, job_id)
+		if job == None:
+			return {"status": "error", "error": "No job " + str(job_id) + " for " + str(kind_id)}, 404
+		return job
+
+
+class IssueToken(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			request: Basic auth credentials, returns a signed bearer token for the user to send as
+			"Authorization: Bearer <token>" until it expires, verified without checking the password again
+
+			{
+				expires_in: int (optional, seconds, default 900, at most 86400)
+			}
+		"""
+		if authenticator.current_scheme() != "basic":
+			return {"status": "error", "error": "Tokens are only issued for Basic auth credentials"}, 400
+		token_request = request.get_json(silent=True) or {}
+		try:
+			token, expires_in = authenticator.issue_token(authenticator.current_user(), ttl=token_request.get("expires_in"))
+		except (TypeError, ValueError):
+			return {"status": "error", "error": "expires_in needs to be a number of seconds"}, 400
+		return {
+			"access_token": token,
+			"token_type": "Bearer",
+			"expires_in": expires_in
+		}
+
+
+class WriteBufferStats(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns the write-behind buffer metrics: updates submitted, flushes, keys written, flush errors,
+			flush latency (last / max / average ms) and keys still pending
+		"""
+		return writeCoalescer.stats()
+
+
+class AdmissionStats(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns the admission control metrics: requests allowed and rate limited per user bucket, requests
+			admitted, shed because the queue was full or timed out, and requests running and queued right now
+		"""
+		return {"rate_limits": rateLimiter.stats(), "concurrency": concurrencyLimiter.stats()}
+
+
+class BackendHealth(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns the circuit breaker of every backend (datastore, gcs, ses): its state (closed, open or
+			half_open), failures in a row, and calls / failures / rejected calls / times opened
+		"""
+		return {"datastore": datastoreBreaker.stats(), "gcs": gcsBreaker.stats(), "ses": sesBreaker.stats()}
+
+
+class SlowRequests(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns the newest requests slower than the slow_request_ms of api_config.json "profiling" (1000 by
+			default), newest first: route, status, total and backend time, the payload shape (keys and value
+			types only, no values), every backend call with its time, and the profile file if it was profiled
+		"""
+		return {
+			"threshold_ms": slowRequestLog.threshold_ms,
+			"slow_requests": slowRequestLog.recent()
+		}
+
+
+class QueryShapes(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns every query shape the read endpoint has run since the instance started (kind, filter fields
+			and operators, sort) with its count, latency and errors, plus a recommended index.yaml generated
+			from the observed traffic. shapes flagged "slow" or "rejected" (missing index / frequent errors)
+			are commented in the index.yaml
+
+			{
+				flagged_only: bool (optional)
+			}
+
+			save index_yaml as index.yaml and run:  gcloud datastore indexes create index.yaml
+		"""
+		shapes_request = request.get_json(silent=True) or {}
+		shapes = queryShapeRecorder.report()
+		if shapes_request.get("flagged_only", False):
+			shapes = [shape for shape in shapes if shape["flags"]]
+		return {
+			"shapes": shapes,
+			"index_yaml": queryShapeRecorder.advise()
+		}
+
+
+class HotKeys(Resource):
+	@authenticator.required
+	def post(self):
+		"""
+			returns the hot spots of the load over sliding windows (the last 1, 5 and 15 minutes by default,
+			api_config.json "hot_keys"): the kind_id / key_id pairs read and written most, the keys whose update
+			transactions were retried most because of concurrent updates (write contention), and the query
+			shapes read most, each with its estimated count and share of the window's total. counts are
+			estimates from count-min sketches, they can be a little high but are never low
+
+			{
+				limit: 20, (optional) top items per list
+				windows: [60, 300] (optional) window lengths in seconds, up to the longest configured one
+			}
+		"""
+		hotkeys_request = request.get_json(silent=True) or {}
+		limit = hotkeys_request.get("limit", TOP_ITEMS)
+		windows = hotkeys_request.get("windows")
+		if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+			return {"status": "error", "error": "limit needs to be a positive integer"}, 400
+		if windows is not None and (not isinstance(windows, list) or not windows
+									or not all(isinstance(window, int) and not isinstance(window, bool) and 0 < window <= max(hotKeyTracker.windows)
+											   for window in windows)):
+			return {"status": "error", "error": "windows needs to be a list of seconds up to " + str(max(hotKeyTracker.windows))}, 400
+		return {"windows": hotKeyTracker.report(limit=limit, windows=windows)}
 
 
 class UpdateData(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -431,40 +1947,67 @@ class UpdateData(Resource):
 			{
 				kind_id: "", (required)
 				key_id: "", (required)
-				data: {}  (required)
+				data: {}  (required unless operations is provided)
+				operations: {}  (optional)
 			}
 
 			kind_id example: "client000000001"
 			key_id example:  if updating customer then key_id = "customer000000001"
 			data example:  json format dictionary of key value pairs, examples above
+			operations example:  atomic operations run on the server, safe under concurrent updates (see update_data)
+							{
+								"cases_open": {"op": "increment", "value": 1},
+								"tags": {"op": "append", "value": "vip"}
+							}
+
+			for kinds set in api_config.json "write_behind", updates without operations are buffered, merged with
+			other updates to the same key_id and written within half a second, the response is then "accepted" (202)
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			update_request = request.get_json()
-			kind_id = update_request["kind_id"]
-			key_id = update_request["key_id"]
-			updated_values = update_request["data"]
-			update_data(kind_id=kind_id, key_id=key_id, data=updated_values)
+		update_request = request.get_json()
+		kind_id = update_request["kind_id"]
+		key_id = update_request["key_id"]
+		updated_values = update_request.get("data", {})
+		operations = update_request.get("operations", {})
+		if not updated_values and not operations:
+			return {"status": "error", "error": "data or operations is required"}, 400
+		try:
+			validate_operations(operations)
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		if kind_config("write_behind", kind_id) and not operations:
+			# merged with other updates to the same key and written within the flush window
+			hotKeyTracker.record_write(kind_id, key_id)
+			try:
+				writeCoalescer.submit(kind_id, key_id, updated_values)
+			except WriteBufferFullError as e:
+				return {"status": "error", "error": str(e) + ", retry after 1 second"}, 503, {"Retry-After": "1"}
 			return {
-				"status": "success",
+				"status": "accepted",
 				"updated_kind_id": kind_id,
 				"updated_key_id": key_id,
 				"updated_data": updated_values
-			}
-		else:
-			return {"message": "Authentication failed"}, 403
+			}, 202
+		try:
+			operation_results = update_data(kind_id=kind_id, key_id=key_id, data=updated_values, operations=operations)
+		except NotFound as e:
+			return {"status": "error", "error": str(e)}, 404
+		return {
+			"status": "success",
+			"updated_kind_id": kind_id,
+			"updated_key_id": key_id,
+			"updated_data": updated_values,
+			"updated_operations": operation_results
+		}
 
 
 class CreateData(Resource):
 	
+	@authenticator.required
+	@idempotencyStore.idempotent
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first response back instead of creating the entity again
 
 			{
 				kind_id: "" (required)
@@ -476,34 +2019,64 @@ class CreateData(Resource):
 			key_id example:  if updating customer then key_id = "customer000000001"
 			data example:  json format dictionary of key value pairs, examples above
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			create_request = request.get_json()
-			kind_id = create_request["kind_id"]
-			# check if key_id is provided, if not then it will auto generate a key_id
-			if "key_id" not in create_request.keys():
-				key_id = None
-			else:
-				key_id = create_request["key_id"]
-			created_values = create_request["data"]
-			create_data(kind_id=kind_id, key_id=key_id, data=created_values)
-			return {
-				"status": "success",
-				"created_kind_id": kind_id,
-				"created_key_id": key_id,
-				"created_data": created_values
-			}
+		create_request = request.get_json()
+		kind_id = create_request["kind_id"]
+		# check if key_id is provided, if not then it will auto generate a key_id
+		if "key_id" not in create_request.keys():
+			key_id = None
 		else:
-			return {"message": "Authentication failed"}, 403
+			key_id = create_request["key_id"]
+		created_values = create_request["data"]
+		key_id = create_data(kind_id=kind_id, key_id=key_id, data=created_values)
+		return {
+			"status": "success",
+			"created_kind_id": kind_id,
+			"created_key_id": key_id,
+			"created_data": created_values
+		}
+
+
+class CreateDataBulk(Resource):
+
+	@authenticator.required
+	@idempotencyStore.idempotent
+	def post(self):
+		"""
+			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first response back instead of creating the entities again
+
+			{
+				kind_id: "" (required)
+				items: array (required) (max 5000 items)
+			}
+
+			items example:  array of {"key_id": "" (optional), "data": {}}, same as /api/v1/create
+							[
+								{"data": {"object_type": "case", "priority": "High"}},
+								{"key_id": "case000000002", "data": {"object_type": "case", "priority": "Low"}}
+							]
+		"""
+		create_request = request.get_json()
+		kind_id = create_request["kind_id"]
+		items = create_request["items"]
+		if not isinstance(items, list):
+			return {"status": "error", "error": "items needs to be a list"}, 400
+		if len(items) > MAX_BULK_CREATE_ITEMS:
+			return {"status": "error", "error": "Too many items, the maximum is " + str(MAX_BULK_CREATE_ITEMS)}, 400
+		try:
+			created_key_ids = create_data_bulk(kind_id=kind_id, items=items)
+		except ValueError as e:
+			return {"status": "error", "error": str(e)}, 400
+		return {
+			"status": "success",
+			"created_kind_id": kind_id,
+			"created_key_ids": created_key_ids
+		}
 
 
 class DeleteData(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -518,41 +2091,35 @@ class DeleteData(Resource):
 			key_id example:  if updating customer then key_id = "customer000000001"
 			entity_property example:  string, example: "cases_open"
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			delete_request = request.get_json()
-			kind_id = delete_request["kind_id"]
-			key_id = delete_request["key_id"]
-			if ("entity_property" in delete_request.keys()):
-				entity_property = delete_request["entity_property"]
-				delete_data(kind_id=kind_id, key_id=key_id, entity_property=entity_property)
-				return {
-					"status": "success",
-					"deleted_kind_id": kind_id,
-					"deleted_key_id": key_id,
-					"deleted_entity_property": entity_property
-				}
-			else:
-				delete_data(kind_id=kind_id, key_id=key_id)
-				return {
-					"status": "success",
-					"deleted_kind_id": kind_id,
-					"deleted_key_id": key_id,
-				}
+		delete_request = request.get_json()
+		kind_id = delete_request["kind_id"]
+		key_id = delete_request["key_id"]
+		if ("entity_property" in delete_request.keys()):
+			entity_property = delete_request["entity_property"]
+			delete_data(kind_id=kind_id, key_id=key_id, entity_property=entity_property)
+			return {
+				"status": "success",
+				"deleted_kind_id": kind_id,
+				"deleted_key_id": key_id,
+				"deleted_entity_property": entity_property
+			}
 		else:
-			return {"message": "Authentication failed"}, 403
+			delete_data(kind_id=kind_id, key_id=key_id)
+			return {
+				"status": "success",
+				"deleted_kind_id": kind_id,
+				"deleted_key_id": key_id,
+			}
 
 
 class SendEmailData(Resource):
 	
+	@authenticator.required
+	@idempotencyStore.idempotent
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first response back instead of sending the email again
 
 			{
 				sender: "", (required)
@@ -560,29 +2127,42 @@ class SendEmailData(Resource):
 				subject: ""  (required)
 				body_html: "" (required)
 				body_text: "" (required)
+				kind_id: "" (required with attachments)
+				attachments: array (optional)
 			}
+
+			attachments example:  files already uploaded to the kind's bucket (i.e. with /api/v1/getsignedurl), at most 10,
+							10 MB for the whole email, see send_email_with_attachments
+							[
+								{"object_folder_name": "invoices", "file_name": "invoice000000001.pdf",
+								 "attachment_name": "Invoice April.pdf"}
+							]
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			email_request = request.get_json()
-			sender, recipients, subject, body_html, body_text = email_request["sender"], email_request["recipients"], email_request["subject"], email_request["body_html"], email_request["body_text"]
-			# extract all the values from recipients and add it to a list
-			recipients_list = []
-			for recipient in recipients:
-				recipients_list.append(recipient)
-			results = send_email(sender=sender, recipients=recipients_list, subject=subject, body_html=body_html, body_text=body_text)
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		email_request = request.get_json()
+		sender, recipients, subject, body_html, body_text = email_request["sender"], email_request["recipients"], email_request["subject"], email_request["body_html"], email_request["body_text"]
+		# extract all the values from recipients and add it to a list
+		recipients_list = []
+		for recipient in recipients:
+			recipients_list.append(recipient)
+		attachments = email_request.get("attachments")
+		if attachments:
+			kind_id = email_request.get("kind_id")
+			if not kind_id:
+				return {"status": "error", "error": "kind_id is required with attachments"}, 400
+			if not isinstance(attachments, list) or len(attachments) > MAX_ATTACHMENTS:
+				return {"status": "error", "error": "attachments needs to be a list of at most %s files" % MAX_ATTACHMENTS}, 400
+			for attachment in attachments:
+				if not isinstance(attachment, dict) or not attachment.get("object_folder_name") or not attachment.get("file_name"):
+					return {"status": "error", "error": "every attachment needs an object_folder_name and a file_name"}, 400
+			return send_email_with_attachments(sender=sender, recipients=recipients_list, subject=subject, body_html=body_html,
+											   body_text=body_text, kind_id=kind_id, attachments=attachments)
+		results = send_email(sender=sender, recipients=recipients_list, subject=subject, body_html=body_html, body_text=body_text)
+		return results
 
 
 class CreateTemplate(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -594,23 +2174,15 @@ class CreateTemplate(Resource):
 				text_part: "" (required)
 			}
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			template_request = request.get_json()
-			templateName, subject, html_part, text_part = template_request["template_name"], template_request["subject"], template_request["html_part"], template_request["text_part"]
-			results = create_template(template_name=templateName, subject=subject, html_part=html_part, text_part=text_part)
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		template_request = request.get_json()
+		templateName, subject, html_part, text_part = template_request["template_name"], template_request["subject"], template_request["html_part"], template_request["text_part"]
+		results = create_template(template_name=templateName, subject=subject, html_part=html_part, text_part=text_part)
+		return results
 	
 
 class DeleteTemplate(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -619,23 +2191,15 @@ class DeleteTemplate(Resource):
 				template_name: "", (required) (kind_id + '_' + templateName)
 			}
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			template_request = request.get_json()
-			templateName = template_request["template_name"]
-			results = delete_template(template_name=templateName)
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		template_request = request.get_json()
+		templateName = template_request["template_name"]
+		results = delete_template(template_name=templateName)
+		return results
 	
 
 class GetTemplate(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -644,23 +2208,15 @@ class GetTemplate(Resource):
 				template_name: "", (required) (kind_id + '_' + templateName (spaces in templateName should be replaced with underscores))
 			}
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			template_request = request.get_json() # transforms json request to python dictionary
-			templateName = template_request["template_name"]
-			results = get_template(template_name=templateName)
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		template_request = request.get_json() # transforms json request to python dictionary
+		templateName = template_request["template_name"]
+		results = get_template(template_name=templateName)
+		return results
 	
 
 class UpdateTemplate(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
@@ -672,46 +2228,32 @@ class UpdateTemplate(Resource):
 				text_part: "" (required)
 			}
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			template_request = request.get_json() # transforms json request to python dictionary
-			templateName, subject, html_part, text_part = template_request["template_name"], template_request["subject"], template_request["html_part"], template_request["text_part"]
-			results = update_template(template_name=templateName, subject=subject, html_part=html_part, text_part=text_part)
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		template_request = request.get_json() # transforms json request to python dictionary
+		templateName, subject, html_part, text_part = template_request["template_name"], template_request["subject"], template_request["html_part"], template_request["text_part"]
+		results = update_template(template_name=templateName, subject=subject, html_part=html_part, text_part=text_part)
+		return results
 	
 
 class ListTemplates(Resource):
 	
+	@authenticator.required
 	def post(self):
 		"""
 			no args because it returns all templates under our ses account, each template is formatted with a specific kind_id + '_' + templateName
 		"""
 		# dummy_request = request.get_json() # might need to remoe error
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			results = list_ses_templates()
-			return results
-		else:
-			return {"message": "Authentication failed"}, 403
+		results = list_ses_templates()
+		return results
 	
 
 class SendEmailTemplate(Resource):
 	
+	@authenticator.required
+	@idempotencyStore.idempotent
 	def post(self):
 		"""
 			request: needs to be json format dictionary of key value pairs
+			optional Idempotency-Key header: retries with the same key get the first response back instead of sending the email again
 
 			sender, recipients, template_name, template_data
 			{
@@ -722,153 +2264,119 @@ class SendEmailTemplate(Resource):
 				replytos: array (optional)
 			}
 		"""
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			sendtemplate_request = request.get_json() # transforms json request to python dictionary
-			sender, recipients, template_name, template_data = sendtemplate_request["sender"], sendtemplate_request["recipients"], sendtemplate_request["template_name"], sendtemplate_request["template_data"]
-			if "replytos" in sendtemplate_request.keys():
-				replytos = sendtemplate_request["replytos"]
-				results = send_template_email(sender=sender, recipients=recipients, template_name=template_name, template_data=template_data, replytos=replytos)
-			else:
-				results = send_template_email(sender=sender, recipients=recipients, template_name=template_name, template_data=template_data, replytos=None)
-			return results
+		sendtemplate_request = request.get_json() # transforms json request to python dictionary
+		sender, recipients, template_name, template_data = sendtemplate_request["sender"], sendtemplate_request["recipients"], sendtemplate_request["template_name"], sendtemplate_request["template_data"]
+		if "replytos" in sendtemplate_request.keys():
+			replytos = sendtemplate_request["replytos"]
+			results = send_template_email(sender=sender, recipients=recipients, template_name=template_name, template_data=template_data, replytos=replytos)
 		else:
-			return {"message": "Authentication failed"}, 403
+			results = send_template_email(sender=sender, recipients=recipients, template_name=template_name, template_data=template_data, replytos=None)
+		return results
 	
 
 class CreateGcpBucket(Resource):
+	@authenticator.required
 	def post(self):
 		# Parse bucket name and location from the request
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			data = request.get_json()
-			bucket_name = data.get('bucketName')
-			location = data.get('location', 'US')
-			try:
-				bucket = storage_client.bucket(bucket_name)
-				new_bucket = storage_client.create_bucket(bucket, location=location)
-				# Set CORS configuration
-				cors_configuration = [{
-					"origin": ["http://localhost:3000", "http://localhost:5000", "https://example.com", "INSERT YOUR FRONTEND URL"],
-					"responseHeader": ["Content-Type"],
-					"method": ["PUT", "POST", "GET"],
-					"maxAgeSeconds": 3600
-				}]
-				new_bucket.cors = cors_configuration
-				new_bucket.patch()  # Update the bucket with the new CORS settings
-				return {'message': f'Bucket {bucket_name} created.'}, 200
-			except Conflict:
-				return {'error': 'Bucket already exists'}, 409
-			except Exception as e:
-				return {'error': str(e)}, 500
-		else:
-			return {"message": "Authentication failed"}, 403
+		data = request.get_json()
+		bucket_name = data.get('bucketName')
+		location = data.get('location', 'US')
+		try:
+			bucket = storage_client.bucket(bucket_name)
+			new_bucket = gcsBreaker.call(storage_client.create_bucket, bucket, location=location, timeout=GCS_TIMEOUT)
+			# Set CORS configuration
+			cors_configuration = [{
+				"origin": ["http://localhost:3000", "http://localhost:5000", "https://example.com", "INSERT YOUR FRONTEND URL"],
+				"responseHeader": ["Content-Type"],
+				"method": ["PUT", "POST", "GET"],
+				"maxAgeSeconds": 3600
+			}]
+			new_bucket.cors = cors_configuration
+			gcsBreaker.call(new_bucket.patch, timeout=GCS_TIMEOUT)  # Update the bucket with the new CORS settings
+			return {'message': f'Bucket {bucket_name} created.'}, 200
+		except Conflict:
+			return {'error': 'Bucket already exists'}, 409
+		except CircuitOpenError:
+			raise
+		except Exception as e:
+			return {'error': str(e)}, 500
 
 
 class GenerateSignedURL(Resource):
 	# @cross_origin(origin='http://localhost:3000')
+	@authenticator.required
 	def post(self):
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			object_folder_name = request.form['object_folder_name']
-			object_folder_name = str(object_folder_name).lower().replace(' ', '_').replace('.', '')
-			kind_id = request.form['kind_id']
-			file_name = request.form['file_name']
-
-			if not file_name or not object_folder_name or not kind_id:
-				return {'error': 'Missing file_name or object_folder_name or kind_id or content_type'}, 400
-
-			# Corrected bucket name and object name
-			bucket_name = kind_id  # Assuming kind_id is your bucket name
-			object_name = f'{object_folder_name}/{file_name}'  # Creating a folder-like structure within the bucket
-
-			bucket = storage_client.bucket(bucket_name)
-			blob = bucket.blob(object_name)
-
-			# Generate a signed URL for the file upload
-			url = blob.generate_signed_url(
-				version='v4',
-				expiration=timedelta(minutes=45),  # URL expires in 45 minutes
-				method='PUT',
-			)
+		object_folder_name = request.form['object_folder_name']
+		object_folder_name = str(object_folder_name).lower().replace(' ', '_').replace('.', '')
+		kind_id = request.form['kind_id']
+		file_name = request.form['file_name']
+
+		if not file_name or not object_folder_name or not kind_id:
+			return {'error': 'Missing file_name or object_folder_name or kind_id or content_type'}, 400
+
+		# Corrected bucket name and object name
+		bucket_name = kind_id  # Assuming kind_id is your bucket name
+		object_name = f'{object_folder_name}/{file_name}'  # Creating a folder-like structure within the bucket
+
+		bucket = storage_client.bucket(bucket_name)
+		blob = bucket.blob(object_name)
+
+		# Generate a signed URL for the file upload (signed locally with the service account key, no call
+		# to GCS so it isn't behind the breaker)
+		url = blob.generate_signed_url(
+			version='v4',
+			expiration=timedelta(minutes=45),  # URL expires in 45 minutes
+			method='PUT',
+		)
 
-			print('Generated signed URL: {}'.format(url))
+		print('Generated signed URL: {}'.format(url))
 
-			return {'url': url}, 200
+		return {'url': url}, 200
 
 
 class ListFilesfromGcpBucket(Resource):
+	@authenticator.required
 	def post(self):
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			data = request.get_json()
-			bucket_name = data.get('bucketName')
-			folder_name = data.get('folderName', '')
-			# Ensure the folder name (prefix) ends with a slash
-			if folder_name and not folder_name.endswith('/'):
-				folder_name += '/'
-			bucket = storage_client.bucket(bucket_name)
-			# List blobs with the given folder name as a prefix
-			files = bucket.list_blobs(prefix=folder_name)
-			file_names = [file.name for file in files]
-			return file_names, 200
-		else:
-			return {"message": "Authentication failed"}, 403
+		data = request.get_json()
+		bucket_name = data.get('bucketName')
+		folder_name = data.get('folderName', '')
+		# Ensure the folder name (prefix) ends with a slash
+		if folder_name and not folder_name.endswith('/'):
+			folder_name += '/'
+		bucket = storage_client.bucket(bucket_name)
+		# List blobs with the given folder name as a prefix
+		def list_blobs():
+			return [file.name for file in bucket.list_blobs(prefix=folder_name, timeout=GCS_TIMEOUT)]
+		file_names = gcsBreaker.call(list_blobs)
+		return file_names, 200
 
 
 class DownloadUrlfromGcpBucket(Resource):
 	# @cross_origin(origin='http://localhost:3000')
+	@authenticator.required
 	def post(self):
-		auth = request.headers.get('Authorization')
-		if not auth:
-			return {"message": "Missing authorization header"}, 401
-		encoded_credentials = auth.split(' ')[1]
-		decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-		username, password = decoded_credentials.split(':')
-		if check_auth(username, password):
-			data = request.get_json()
-			file_name = data.get('fileName') # fileName from request is actual folder path + file name (only for download is fileName the folder path + file name)
-			bucket_name = data.get('bucketName')
-			try:
-				bucket = storage_client.bucket(bucket_name)
-				blob = bucket.blob(file_name)
-				# Generate a signed URL for the file download
-				downloadUrl = blob.generate_signed_url(
-					version='v4',
-					expiration=timedelta(minutes=15),  # URL expires in 15 minutes
-					method='GET'
-				)
-				return {'url': downloadUrl}
-			except Exception as e:
-				return {'error': str(e)}, 500
-		else:
-			return {"message": "Authentication failed"}, 403
+		data = request.get_json()
+		file_name = data.get('fileName') # fileName from request is actual folder path + file name (only for download is fileName the folder path + file name)
+		bucket_name = data.get('bucketName')
+		try:
+			bucket = storage_client.bucket(bucket_name)
+			blob = bucket.blob(file_name)
+			# Generate a signed URL for the file download (signed locally, see GenerateSignedURL)
+			downloadUrl = blob.generate_signed_url(
+				version='v4',
+				expiration=timedelta(minutes=15),  # URL expires in 15 minutes
+				method='GET'
+			)
+			return {'url': downloadUrl}
+		except Exception as e:
+			return {'error': str(e)}, 500
 
 
 
 api.add_resource(ReadData, "/api/v1/read")
 api.add_resource(UpdateData, "/api/v1/update")
 api.add_resource(CreateData, "/api/v1/create")
+api.add_resource(CreateDataBulk, "/api/v1/createbulk")
 api.add_resource(DeleteData, "/api/v1/delete")
 api.add_resource(SendEmailData, "/api/v1/sendemail")
 api.add_resource(SendEmailTemplate, "/api/v1/sendemailtemplate")
@@ -881,6 +2389,19 @@ api.add_resource(CreateGcpBucket, "/api/v1/createbucket")
 api.add_resource(GenerateSignedURL, "/api/v1/getsignedurl")
 api.add_resource(DownloadUrlfromGcpBucket, "/api/v1/getdownloadurlfrombucket")
 api.add_resource(ListFilesfromGcpBucket, "/api/v1/listfilesfrombucket")
+api.add_resource(QueryShapes, "/api/v1/queryshapes")
+api.add_resource(SearchData, "/api/v1/search")
+api.add_resource(WriteBufferStats, "/api/v1/writebuffer")
+api.add_resource(AdmissionStats, "/api/v1/admission")
+api.add_resource(BackendHealth, "/api/v1/backends")
+api.add_resource(IssueToken, "/api/v1/token")
+api.add_resource(SlowRequests, "/api/v1/slowrequests")
+api.add_resource(Changes, "/api/v1/changes")
+api.add_resource(ExportData, "/api/v1/export")
+api.add_resource(ImportData, "/api/v1/import")
+api.add_resource(TransferJob, "/api/v1/transfer")
+api.add_resource(ReadRollups, "/api/v1/rollups")
+api.add_resource(HotKeys, "/api/v1/hotkeys")
 
 
 if __name__ == '__main__':
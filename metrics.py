@@ -0,0 +1,171 @@
+import bisect
+import logging
+import math
+import threading
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# histogram buckets of latencies (seconds), payload sizes (bytes) and entities returned per query
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+
+def _format_labels(labelnames, values):
+	if not labelnames:
+		return ""
+	pairs = []
+	for name, value in zip(labelnames, values):
+		value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+		pairs.append('%s="%s"' % (name, value))
+	return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+	if value == math.inf:
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+class Counter:
+	"""
+	A Prometheus counter, one value per combination of label values.
+	"""
+
+	def __init__(self, name, documentation, labelnames=()):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self.values = {}
+		self.lock = threading.Lock()
+
+
+	def inc(self, amount=1, **labels):
+		"""
+		Adds amount to the counter of the label values.
+		"""
+		key = tuple(labels[name] for name in self.labelnames)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+		with self.lock:
+			for key, value in sorted(self.values.items()):
+				lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, key), _format_value(value)))
+		return lines
+
+
+
+class Histogram:
+	"""
+	A Prometheus histogram with fixed buckets, one per combination of label values.
+	"""
+
+	def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(buckets)
+		# label values -> [count per bucket (not cumulative, the last one is +Inf), sum]
+		self.values = {}
+		self.lock = threading.Lock()
+
+
+	def observe(self, value, **labels):
+		"""
+		Records one observation for the label values.
+		"""
+		key = tuple(labels[name] for name in self.labelnames)
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			counts = self.values.get(key)
+			if counts is None:
+				counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+			counts[0][index] += 1
+			counts[1] += value
+
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+		labelnames = self.labelnames + ("le",)
+		with self.lock:
+			for key, (counts, total) in sorted(self.values.items()):
+				cumulative = 0
+				for bound, count in zip(self.buckets + (math.inf,), counts):
+					cumulative += count
+					lines.append("%s_bucket%s %s" % (self.name, _format_labels(labelnames, key + (_format_value(bound),)), cumulative))
+				labels = _format_labels(self.labelnames, key)
+				lines.append("%s_sum%s %s" % (self.name, labels, _format_value(float(total))))
+				lines.append("%s_count%s %s" % (self.name, labels, cumulative))
+		return lines
+
+
+
+class Gauge:
+	"""
+	A Prometheus gauge read from a function when the metrics are rendered.
+	"""
+
+	def __init__(self, name, documentation, labelnames, function):
+		"""
+		:param function: Returns a dict of label values tuple to the current value.
+		"""
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self.function = function
+
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s gauge" % self.name]
+		try:
+			values = self.function()
+		except Exception:
+			logger.exception("Couldn't read gauge %s.", self.name)
+			return lines
+		for key, value in sorted(values.items()):
+			lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, key), _format_value(value)))
+		return lines
+
+
+
+class MetricsRegistry:
+	"""
+	Holds the metrics of the process and renders them in the Prometheus text format.
+	"""
+
+	def __init__(self):
+		self.metrics = []
+
+
+	def counter(self, name, documentation, labelnames=()):
+		return self._register(Counter(name, documentation, labelnames))
+
+
+	def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+		return self._register(Histogram(name, documentation, labelnames, buckets))
+
+
+	def gauge(self, name, documentation, labelnames, function):
+		return self._register(Gauge(name, documentation, labelnames, function))
+
+
+	def _register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+
+	def render(self):
+		"""
+		:return: Every metric in the Prometheus text exposition format (version 0.0.4).
+		"""
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
@@ -0,0 +1,166 @@
+import collections
+import cProfile
+import logging
+import os
+import random
+import re
+import secrets
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# profiles are written to PROFILE_DIRECTORY (App Engine only allows writes under /tmp) and only the newest
+# MAX_PROFILES are kept
+PROFILE_DIRECTORY = "/tmp/profiles"
+PROFILE_HEADER = "X-Profile-Request"
+MAX_PROFILES = 200
+# requests slower than SLOW_REQUEST_MS are kept in the slow request log, the newest MAX_SLOW_REQUESTS of them
+SLOW_REQUEST_MS = 1000
+MAX_SLOW_REQUESTS = 200
+# payload shapes stop at this depth and show at most this many keys per dict
+MAX_SHAPE_DEPTH = 4
+MAX_SHAPE_KEYS = 50
+
+
+def payload_shape(value, depth=0):
+	"""
+	Redacts a json payload down to its shape: dict keys are kept, every other value is replaced by its
+	type, and lists by the shape of their first item and their length.
+
+	:param value: The parsed json payload.
+	:return: The shape, i.e. {"kind_id": "str", "filters": {"filter1": {"filter_value": "list[3] of str"}}}.
+	"""
+	if isinstance(value, dict):
+		if depth >= MAX_SHAPE_DEPTH:
+			return "dict[%s]" % len(value)
+		shape = {str(key): payload_shape(item, depth + 1) for key, item in list(value.items())[:MAX_SHAPE_KEYS]}
+		if len(value) > MAX_SHAPE_KEYS:
+			shape["..."] = "%s more keys" % (len(value) - MAX_SHAPE_KEYS)
+		return shape
+	if isinstance(value, list):
+		if not value:
+			return "list[0]"
+		item_shape = payload_shape(value[0], depth + 1)
+		if isinstance(item_shape, str):
+			return "list[%s] of %s" % (len(value), item_shape)
+		return {"list[%s] of" % len(value): item_shape}
+	if value is None:
+		return "null"
+	return type(value).__name__
+
+
+
+class RequestProfiler:
+	"""
+	Profiles a sampled fraction of requests, and any request sent with the profile header, with
+	cProfile and writes each profile to its own .prof file (readable with pstats or snakeviz).
+	"""
+
+	def __init__(self, sample_rate=0.0, header=PROFILE_HEADER, directory=PROFILE_DIRECTORY, max_profiles=MAX_PROFILES):
+		"""
+		:param sample_rate: Fraction of requests profiled, 0 to only profile requests with the header.
+		:param header: Request header that has its request profiled.
+		:param directory: Directory the profiles are written to.
+		:param max_profiles: Number of profiles kept, the oldest are deleted first.
+		"""
+		self.sample_rate = sample_rate
+		self.header = header
+		self.directory = directory
+		self.max_profiles = max_profiles
+		self.lock = threading.Lock()
+
+
+	def start(self, requested=False):
+		"""
+		Starts profiling the current thread when the request is sampled or asks to be profiled.
+
+		:param requested: True when the request was sent with the profile header.
+		:return: The running profile, None when the request isn't profiled.
+		"""
+		if not requested and not (self.sample_rate and random.random() < self.sample_rate):
+			return None
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			# another profiler is already running in this process (python 3.12+ allows only one)
+			return None
+		return profile
+
+
+	def stop(self, profile, route, seconds):
+		"""
+		Stops a profile and writes it to the profile directory.
+
+		:param profile: The profile returned by start.
+		:param route: The route of the request, part of the file name.
+		:param seconds: The total time of the request, part of the file name.
+		:return: The path of the profile file, None when it couldn't be written.
+		"""
+		profile.disable()
+		file_name = "%s-%s-%sms-%s.prof" % (time.strftime("%Y%m%dT%H%M%S"), re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_"),
+											int(seconds * 1000), secrets.token_hex(3))
+		path = os.path.join(self.directory, file_name)
+		try:
+			with self.lock:
+				os.makedirs(self.directory, exist_ok=True)
+				profile.dump_stats(path)
+				self._prune()
+		except OSError:
+			logger.exception("Couldn't write profile %s.", path)
+			return None
+		logger.info("Wrote profile %s.", path)
+		return path
+
+
+	def _prune(self):
+		profiles = sorted((os.path.join(self.directory, entry) for entry in os.listdir(self.directory) if entry.endswith(".prof")),
+						  key=os.path.getmtime)
+		for path in profiles[:max(0, len(profiles) - self.max_profiles)]:
+			os.remove(path)
+
+
+
+class SlowRequestLog:
+	"""
+	Keeps the newest requests that took longer than a threshold, with their payload shape and the
+	backend calls they made, and logs each of them.
+	"""
+
+	def __init__(self, threshold_ms=SLOW_REQUEST_MS, max_entries=MAX_SLOW_REQUESTS):
+		"""
+		:param threshold_ms: Requests taking longer than this many milliseconds are logged.
+		:param max_entries: Number of slow requests kept.
+		"""
+		self.threshold_ms = threshold_ms
+		self.entries = collections.deque(maxlen=max_entries)
+		self.lock = threading.Lock()
+
+
+	def is_slow(self, seconds):
+		return seconds * 1000 >= self.threshold_ms
+
+
+	def record(self, entry):
+		"""
+		Adds a slow request.
+
+		:param entry: Dict describing the request: route, method, status, total_ms, payload_shape,
+					  backend_calls and profile.
+		"""
+		logger.warning("Slow request %s %s took %.0fms (%.0fms in %s backend calls).", entry["method"], entry["route"],
+					   entry["total_ms"], sum(call["ms"] for call in entry["backend_calls"]), len(entry["backend_calls"]))
+		with self.lock:
+			self.entries.append(entry)
+
+
+	def recent(self):
+		"""
+		:return: The slow requests kept, newest first.
+		"""
+		with self.lock:
+			return list(reversed(self.entries))
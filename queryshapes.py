@@ -0,0 +1,212 @@
+import logging
+import threading
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# a query shape is flagged as slow when its average latency is above this (milliseconds)
+SLOW_QUERY_MS = 1000
+# or as frequently rejected when more than this fraction of its executions failed
+REJECTED_ERROR_RATE = 0.05
+# distinct shapes kept (their fields come from the requests), when full the least executed
+# EVICTED_FRACTION of them make room at once, so a flood of new shapes doesn't scan them on every query
+MAX_SHAPES = 1000
+EVICTED_FRACTION = 0.1
+
+
+def query_shape(kind, fields, sort=None):
+	"""
+	Builds the shape of a query, the part of the query that decides which index serves it.
+
+	:param kind: The datastore kind queried.
+	:param fields: List of (field, op) pairs filtered on, equality filters use "=".
+	:param sort: The sort dict used by read_data ({"sort_direction", "sort_value"}), or None.
+	:return: A hashable shape, (kind, sorted (field, op) pairs, (sort field, direction) or None).
+	"""
+	sort_order = None
+	if sort is not None:
+		sort_order = (sort["sort_value"], "desc" if sort["sort_direction"] == "desc" else "asc")
+	return (kind, tuple(sorted(set(fields))), sort_order)
+
+
+def describe_shape(shape):
+	"""
+	:param shape: A shape built by query_shape.
+	:return: The shape in the format of the read request, {"kind", "filters", "sort"}.
+	"""
+	kind, fields, sort_order = shape
+	return {
+		"kind": kind,
+		"filters": [{"filter_field": field, "filter_op": op} for field, op in fields],
+		"sort": None if sort_order is None else {"sort_value": sort_order[0], "sort_direction": sort_order[1]},
+	}
+
+
+def recommended_index(shape):
+	"""
+	Works out the composite index that serves a query shape: equality filters first, then the
+	inequality filters, then the sort.
+
+	:param shape: A shape built by query_shape.
+	:return: The index as an index.yaml entry ({"kind", "properties"}), or None when the built-in
+			 single property indexes are enough.
+	"""
+	kind, fields, sort_order = shape
+	equality = []
+	inequality = []
+	for field, op in fields:
+		if field == "__key__":
+			continue
+		if op in ("=", "IN"):
+			if field not in equality:
+				equality.append(field)
+		elif field not in inequality:
+			inequality.append(field)
+	properties = [{"name": field} for field in equality if field not in inequality]
+	for field in inequality:
+		properties.append({"name": field})
+	if sort_order is not None:
+		sort_property = {"name": sort_order[0]}
+		if sort_order[1] == "desc":
+			sort_property["direction"] = "desc"
+		# sorting on the inequality property replaces its entry, otherwise the sort comes after it
+		properties = [prop for prop in properties if prop["name"] != sort_order[0]]
+		properties.append(sort_property)
+	if len(properties) <= 1 or (sort_order is None and not inequality):
+		return None
+	return {"kind": kind, "properties": properties}
+
+
+def index_yaml(indexes, comments=None):
+	"""
+	Renders index.yaml entries in the format used by gcloud datastore indexes create.
+
+	:param indexes: List of index.yaml entries, as returned by recommended_index.
+	:param comments: Optional list of comment lines, one per index, written above the entry.
+	:return: The index.yaml file contents.
+	"""
+	lines = ["indexes:", ""]
+	for position, index in enumerate(indexes):
+		if comments is not None and comments[position]:
+			lines.append("# " + comments[position])
+		lines.append("- kind: " + str(index["kind"]))
+		lines.append("  properties:")
+		for prop in index["properties"]:
+			lines.append("  - name: " + str(prop["name"]))
+			if "direction" in prop:
+				lines.append("    direction: " + prop["direction"])
+		lines.append("")
+	return "\n".join(lines)
+
+
+
+class QueryShapeRecorder:
+	"""Records the distinct query shapes executed (up to max_shapes) with their latency and error counts."""
+
+	def __init__(self, slow_query_ms=SLOW_QUERY_MS, rejected_error_rate=REJECTED_ERROR_RATE, max_shapes=MAX_SHAPES):
+		"""
+		:param slow_query_ms: Average latency above which a shape is flagged as slow.
+		:param rejected_error_rate: Fraction of failed executions above which a shape is
+									flagged as frequently rejected.
+		:param max_shapes: Distinct shapes kept, the least executed are evicted past that.
+		"""
+		self.slow_query_ms = slow_query_ms
+		self.rejected_error_rate = rejected_error_rate
+		self.max_shapes = max_shapes
+		self.shapes = {}
+		self.evicted = 0
+		self.lock = threading.Lock()
+
+
+	def record(self, shape, seconds, error=None, index_missing=False):
+		"""
+		Records one execution of a query shape.
+
+		:param shape: A shape built by query_shape.
+		:param seconds: How long the query took.
+		:param error: The exception the query failed with, if it failed.
+		:param index_missing: True when datastore rejected the query for a missing composite
+							  index (even if the read was then served by the sort fallback).
+		"""
+		with self.lock:
+			stats = self.shapes.get(shape)
+			if stats is None:
+				if len(self.shapes) >= self.max_shapes:
+					self._evict()
+				stats = {"count": 0, "errors": 0, "index_missing": 0,
+						 "total_ms": 0.0, "max_ms": 0.0, "last_error": None}
+				self.shapes[shape] = stats
+			milliseconds = seconds * 1000
+			stats["count"] += 1
+			stats["total_ms"] += milliseconds
+			stats["max_ms"] = max(stats["max_ms"], milliseconds)
+			if error is not None:
+				stats["errors"] += 1
+				stats["last_error"] = str(error)
+			if index_missing:
+				stats["index_missing"] += 1
+		if index_missing:
+			logger.warning("Query shape %s has no composite index.", shape)
+
+
+	def _evict(self):
+		# the least executed shapes go, the oldest first among equal counts (sorted() is stable)
+		evicted = max(1, int(self.max_shapes * EVICTED_FRACTION))
+		for shape in sorted(self.shapes, key=lambda shape: self.shapes[shape]["count"])[:evicted]:
+			del self.shapes[shape]
+		self.evicted += evicted
+		logger.warning("Over %s query shapes recorded, evicted the %s least executed.", self.max_shapes, evicted)
+
+
+	def report(self):
+		"""
+		:return: List of every recorded shape with its stats and flags, most executed first.
+		"""
+		with self.lock:
+			snapshot = [(shape, dict(stats)) for shape, stats in self.shapes.items()]
+		report = []
+		for shape, stats in snapshot:
+			avg_ms = stats["total_ms"] / stats["count"]
+			flags = []
+			if avg_ms > self.slow_query_ms:
+				flags.append("slow")
+			if stats["index_missing"] or (stats["errors"] / stats["count"]) > self.rejected_error_rate:
+				flags.append("rejected")
+			entry = describe_shape(shape)
+			entry.update({
+				"count": stats["count"],
+				"errors": stats["errors"],
+				"index_missing": stats["index_missing"],
+				"avg_ms": round(avg_ms, 2),
+				"max_ms": round(stats["max_ms"], 2),
+				"last_error": stats["last_error"],
+				"flags": flags,
+				"recommended_index": recommended_index(shape),
+			})
+			report.append(entry)
+		report.sort(key=lambda entry: entry["count"], reverse=True)
+		return report
+
+
+	def advise(self):
+		"""
+		Generates an index.yaml covering every composite index needed by the observed traffic,
+		with the flagged shapes commented.
+
+		:return: The index.yaml file contents.
+		"""
+		indexes = []
+		comments = []
+		for entry in self.report():
+			index = entry["recommended_index"]
+			if index is None or index in indexes:
+				continue
+			indexes.append(index)
+			comment = "%s queries, %s errors, %s missing index, avg %s ms" % (
+				entry["count"], entry["errors"], entry["index_missing"], entry["avg_ms"])
+			if entry["flags"]:
+				comment += " (" + ", ".join(entry["flags"]) + ")"
+			comments.append(comment)
+		return index_yaml(indexes, comments)
@@ -0,0 +1,144 @@
+from email.message import EmailMessage
+from email.policy import SMTP
+import base64
+import logging
+import uuid
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# SES rejects raw messages over 10 MB, attachments included once base64 encoded
+MAX_MESSAGE_BYTES = 10 * 1024 * 1024
+MAX_ATTACHMENTS = 10
+# base64 turns every 57 bytes into one 76 character line, 78 bytes with its CRLF
+LINE_BYTES = 57
+ENCODED_LINE_BYTES = 78
+# attachments are read this much at a time, a whole number of base64 lines (912 KiB)
+READ_CHUNK_SIZE = LINE_BYTES * 16 * 1024
+# room left for the MIME headers of every attachment part when checking the size up front
+PART_HEADER_BYTES = 1024
+
+
+def encoded_size(size):
+	"""
+	:return: The bytes an attachment of size bytes takes in the message once base64 encoded.
+	"""
+	return -(-size // LINE_BYTES) * ENCODED_LINE_BYTES
+
+
+def _header_block(message):
+	# every header folded and encoded (RFC 2047 / 2231 for non-ascii names) the way SMTP expects
+	return b"".join(SMTP.fold_binary(name, value) for name, value in message.items()) + b"\r\n"
+
+
+
+class MessageTooLargeError(ValueError):
+	"""The message would be over the size SES accepts."""
+
+
+
+class RawEmail:
+	"""
+	Builds a multipart/mixed MIME message, the text and HTML bodies followed by attachments, straight
+	into one buffer: attachments are base64 encoded chunk by chunk as they are read, so the only copy
+	of an attachment held in memory is its encoded form in the message, at most max_bytes in all.
+	"""
+
+	def __init__(self, sender, recipients, subject, body_html, body_text, reply_tos=None, max_bytes=MAX_MESSAGE_BYTES):
+		"""
+		:param sender: The From address.
+		:param recipients: List of To addresses.
+		:param subject: The subject of the email.
+		:param body_html: The HTML version of the body.
+		:param body_text: The plain text version of the body.
+		:param reply_tos: Optional list of Reply-To addresses.
+		:param max_bytes: Largest message built.
+		"""
+		self.max_bytes = max_bytes
+		self.boundary = ("=_" + uuid.uuid4().hex).encode("ascii")
+		headers = EmailMessage(policy=SMTP)
+		headers["From"] = sender
+		headers["To"] = ", ".join(recipients)
+		if reply_tos:
+			headers["Reply-To"] = ", ".join(reply_tos)
+		headers["Subject"] = subject
+		headers["MIME-Version"] = "1.0"
+		headers["Content-Type"] = 'multipart/mixed; boundary="%s"' % self.boundary.decode("ascii")
+		body = EmailMessage(policy=SMTP)
+		body.set_content(body_text, cte="quoted-printable")
+		body.add_alternative(body_html, subtype="html", cte="quoted-printable")
+		del body["MIME-Version"]
+		self.data = bytearray(_header_block(headers))
+		self._boundary()
+		self.data += body.as_bytes()
+		self._check(len(self.data))
+
+
+	def _boundary(self):
+		self.data += b"\r\n--" + self.boundary + b"\r\n"
+
+
+	def _check(self, size):
+		if size + len(self.boundary) + 8 > self.max_bytes:
+			raise MessageTooLargeError("The email is larger than %s bytes with its attachments" % self.max_bytes)
+
+
+	def check_size(self, sizes):
+		"""
+		Checks up front that attachments of these sizes fit in the message, before any is read.
+
+		:param sizes: The size in bytes of every attachment about to be added.
+		:raises MessageTooLargeError: They wouldn't fit.
+		"""
+		self._check(len(self.data) + sum(encoded_size(size) + PART_HEADER_BYTES for size in sizes))
+
+
+	def _encode(self, data):
+		if len(data):
+			self.data += base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+
+	def add_attachment(self, filename, content_type, reader, size=None):
+		"""
+		Appends an attachment, reading it READ_CHUNK_SIZE bytes at a time.
+
+		:param filename: The file name shown to the recipient.
+		:param content_type: The MIME type of the attachment, i.e. "application/pdf".
+		:param reader: A binary file-like object to read the attachment from (i.e. a GCS blob reader).
+		:param size: The size checked up front, reading more than that fails instead of growing the message.
+		:raises MessageTooLargeError: The attachment doesn't fit in the message.
+		"""
+		part = EmailMessage(policy=SMTP)
+		part["Content-Type"] = content_type
+		part.set_param("name", filename)
+		part.add_header("Content-Disposition", "attachment", filename=filename)
+		part["Content-Transfer-Encoding"] = "base64"
+		self._boundary()
+		self.data += _header_block(part)
+		start = len(self.data)
+		pending = b""
+		read = 0
+		while True:
+			chunk = reader.read(READ_CHUNK_SIZE)
+			if not chunk:
+				break
+			read += len(chunk)
+			if size is not None and read > size:
+				raise MessageTooLargeError("Attachment %s grew past the %s bytes it was checked at" % (filename, size))
+			self._check(start + encoded_size(read))
+			# whole lines are encoded now, the few bytes left over go in front of the next chunk
+			data = pending + chunk if pending else chunk
+			usable = len(data) - len(data) % LINE_BYTES
+			self._encode(memoryview(data)[:usable])
+			pending = data[usable:]
+		self._encode(pending)
+
+
+	def finish(self):
+		"""
+		:return: The whole message, to send as the RawMessage Data of send_raw_email.
+		"""
+		self.data += b"\r\n--" + self.boundary + b"--\r\n"
+		return self.data
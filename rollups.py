@@ -0,0 +1,292 @@
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import random
+import threading
+
+from atomicops import run_in_transaction
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# every group of a rollup is split over this many shard entities by default, each write updates a random
+# one, so a busy kind isn't limited by the write rate of a single rollup entity
+ROLLUP_SHARDS = 10
+# writes update the shards of at most this many groups per transaction, datastore commits up to 500 mutations
+APPLY_CHUNK_SIZE = 500
+# rebuilds write the new totals this many entities at a time
+WRITE_CHUNK_SIZE = 500
+# rebuilds run in the background, this many at once per instance
+REBUILD_WORKERS = 1
+
+
+def _number(value):
+	return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def validate_definitions(definitions):
+	"""
+	Checks the rollup definitions of a kind, {"by_status": {"group_by": ["object_type", "status"], "sum": ["amount"]}}.
+
+	:raises ValueError: When a definition has no group_by fields or a field isn't a string.
+	"""
+	for name, definition in definitions.items():
+		group_by = definition.get("group_by")
+		if not isinstance(group_by, list) or not group_by or not all(isinstance(field, str) for field in group_by):
+			raise ValueError("Rollup %s needs a list of group_by fields" % name)
+		sums = definition.get("sum", [])
+		if not isinstance(sums, list) or not all(isinstance(field, str) for field in sums):
+			raise ValueError("sum of rollup %s needs to be a list of fields" % name)
+
+
+
+class Rollups:
+	"""
+	Encapsulates materialized rollups of a kind: per group of group_by values, the number of entities and
+	the sum of some numeric fields, kept in sharded rollup entities updated from the old and new
+	properties of every write, so dashboards read them with one query instead of scanning the kind.
+	"""
+
+	def __init__(self, datastore_client, decode=None):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		:param decode: Optional function turning an entity read from datastore into plain values in place
+					   (i.e. decompressing properties), used by rebuild.
+		"""
+		self.datastore_client = datastore_client
+		self.decode = decode
+		self.executor = ThreadPoolExecutor(max_workers=REBUILD_WORKERS)
+		self.running = set()
+		self.lock = threading.Lock()
+
+
+	@staticmethod
+	def rollup_kind(kind_id):
+		"""
+		:return: The kind holding the rollup shards of kind_id.
+		"""
+		return kind_id + "__rollups"
+
+
+	@staticmethod
+	def rebuild_kind(kind_id):
+		"""
+		:return: The kind holding the state of the rollup rebuilds of kind_id, one entity per rollup.
+		"""
+		return kind_id + "__rollup_rebuilds"
+
+
+	@staticmethod
+	def group(definition, properties):
+		"""
+		:return: The group of an entity in a rollup, the json list of its group_by values.
+		"""
+		return json.dumps([properties.get(field) for field in definition["group_by"]], default=str, sort_keys=True)
+
+
+	def _add(self, totals, name, definition, properties, sign):
+		total = totals.setdefault((name, self.group(definition, properties)), [0, {field: 0 for field in definition.get("sum", [])}])
+		total[0] += sign
+		for field in total[1]:
+			total[1][field] += sign * _number(properties.get(field))
+
+
+	def deltas(self, definitions, changes):
+		"""
+		Diffs old against new properties of written entities.
+
+		:param definitions: The rollup definitions of the kind.
+		:param changes: List of (old properties, new properties), None for no entity (created / deleted).
+		:return: Dict of (rollup name, group) to [count delta, {field: sum delta}], without the groups
+				 that didn't change, i.e. updates that didn't touch a group_by or sum field.
+		"""
+		totals = {}
+		for old_properties, new_properties in changes:
+			for name, definition in definitions.items():
+				if old_properties is not None:
+					self._add(totals, name, definition, old_properties, -1)
+				if new_properties is not None:
+					self._add(totals, name, definition, new_properties, 1)
+		return {group: total for group, total in totals.items() if total[0] or any(total[1].values())}
+
+
+	def _shard_key(self, kind_id, name, group, shard):
+		# the group can be long, so the key holds its hash and the shard holds the group
+		digest = hashlib.sha1(group.encode("utf-8")).hexdigest()[:20]
+		return self.datastore_client.key(self.rollup_kind(kind_id), "%s:%s:%s" % (name, digest, shard))
+
+
+	def apply(self, kind_id, definitions, changes):
+		"""
+		Updates the rollups of a kind after entities of it were written, one random shard per changed group,
+		in transactions of APPLY_CHUNK_SIZE groups. Called once the write committed, so a transaction that
+		fails doesn't fail the write: the rollups it would have updated are rebuilt in the background instead.
+
+		:param kind_id: The kind written.
+		:param definitions: The rollup definitions of the kind.
+		:param changes: List of (old properties, new properties), see deltas.
+		"""
+		deltas = list(self.deltas(definitions, changes).items())
+		stale = set()
+		for start in range(0, len(deltas), APPLY_CHUNK_SIZE):
+			chunk = dict(deltas[start:start + APPLY_CHUNK_SIZE])
+			try:
+				run_in_transaction(self._apply_deltas, kind_id, definitions, chunk)
+			except Exception:
+				logger.exception("Couldn't update the rollups of %s, rebuilding them.", kind_id)
+				stale.update(name for name, group in chunk)
+		for name in sorted(stale):
+			try:
+				self.start_rebuild(kind_id, definitions, name)
+			except Exception:
+				logger.exception("Couldn't start the rebuild of rollup %s of %s, rebuild it to catch up.", name, kind_id)
+
+
+	def _apply_deltas(self, kind_id, definitions, deltas):
+		# a different random shard on every retry spreads contended writes
+		keys = {group: self._shard_key(kind_id, group[0], group[1], random.randrange(definitions[group[0]].get("shards", ROLLUP_SHARDS)))
+				for group in deltas}
+		with self.datastore_client.transaction():
+			shards = {shard.key.name: shard for shard in self.datastore_client.get_multi(list(keys.values()))}
+			for group, (count, sums) in deltas.items():
+				key = keys[group]
+				shard = shards.get(key.name)
+				if shard is None:
+					shard = datastore.Entity(key=key, exclude_from_indexes=("group",))
+					shard.update({"rollup": group[0], "group": group[1], "count": 0})
+				shard["count"] += count
+				for field, value in sums.items():
+					shard["sum_" + field] = shard.get("sum_" + field, 0) + value
+				shards[key.name] = shard
+			self.datastore_client.put_multi(list(shards.values()))
+
+
+	def read(self, kind_id, definitions, name=None):
+		"""
+		Reads the rollups of a kind with one query over their shards.
+
+		:param kind_id: The kind.
+		:param definitions: The rollup definitions of the kind.
+		:param name: Only this rollup, every rollup of the kind when None.
+		:return: Dict of rollup name to its groups, largest count first:
+				 [{"group": {"status": "open"}, "count": 12, "sums": {"amount": 1200}}, ...]
+		"""
+		query = self.datastore_client.query(kind=self.rollup_kind(kind_id))
+		if name is not None:
+			query.add_filter(filter=PropertyFilter("rollup", "=", name))
+		totals = {}
+		for shard in query.fetch():
+			definition = definitions.get(shard["rollup"])
+			if definition is None:
+				# a rollup removed from the configuration
+				continue
+			total = totals.setdefault((shard["rollup"], shard["group"]), [0, {field: 0 for field in definition.get("sum", [])}])
+			total[0] += shard["count"]
+			for field in total[1]:
+				total[1][field] += shard.get("sum_" + field, 0)
+		rollups = {rollup: [] for rollup in definitions if name is None or rollup == name}
+		for (rollup, group), (count, sums) in totals.items():
+			if count:
+				group_values = json.loads(group)
+				rollups[rollup].append({"group": dict(zip(definitions[rollup]["group_by"], group_values)), "count": count, "sums": sums})
+		for groups in rollups.values():
+			groups.sort(key=lambda item: -item["count"])
+		return rollups
+
+
+	def rebuild(self, kind_id, definitions, name):
+		"""
+		Recomputes a rollup from every entity of the kind (streamed, memory grows with the number of groups
+		only) and replaces its shards, i.e. after adding a rollup to a kind that already has entities.
+		The new totals are written to shard 0 of every group before the other old shards are deleted, so
+		a failure part way leaves every group counted (some twice until the rebuild is run again) instead
+		of missing. Writes to the kind while it runs can be missed.
+
+		:return: Dict of the entities read and the groups written.
+		"""
+		definition = definitions[name]
+		totals = {}
+		entities = 0
+		for entity in self.datastore_client.query(kind=kind_id).fetch():
+			self._add(totals, name, definition, self.decode(entity) if self.decode else entity, 1)
+			entities += 1
+		query = self.datastore_client.query(kind=self.rollup_kind(kind_id))
+		query.add_filter(filter=PropertyFilter("rollup", "=", name))
+		query.keys_only()
+		old_keys = [shard.key for shard in query.fetch()]
+		shards = []
+		for (rollup, group), (count, sums) in totals.items():
+			if not count:
+				continue
+			shard = datastore.Entity(key=self._shard_key(kind_id, rollup, group, 0), exclude_from_indexes=("group",))
+			shard.update({"rollup": rollup, "group": group, "count": count})
+			for field, value in sums.items():
+				shard["sum_" + field] = value
+			shards.append(shard)
+		for start in range(0, len(shards), WRITE_CHUNK_SIZE):
+			self.datastore_client.put_multi(shards[start:start + WRITE_CHUNK_SIZE])
+		written = {shard.key.name for shard in shards}
+		old_keys = [key for key in old_keys if key.name not in written]
+		for start in range(0, len(old_keys), WRITE_CHUNK_SIZE):
+			self.datastore_client.delete_multi(old_keys[start:start + WRITE_CHUNK_SIZE])
+		return {"entities": entities, "groups": len(shards)}
+
+
+	def _save_rebuild(self, kind_id, name, **state):
+		key = self.datastore_client.key(self.rebuild_kind(kind_id), name)
+		status = datastore.Entity(key=key, exclude_from_indexes=("error",))
+		status.update(state)
+		self.datastore_client.put(status)
+
+
+	def start_rebuild(self, kind_id, definitions, name):
+		"""
+		Starts rebuilding a rollup in the background, see rebuild, unless this instance is already rebuilding it.
+
+		:return: The rebuild state, see rebuild_status.
+		"""
+		with self.lock:
+			if (kind_id, name) in self.running:
+				return self.rebuild_status(kind_id, name)
+			self.running.add((kind_id, name))
+		try:
+			started_at = datetime.now(timezone.utc)
+			self._save_rebuild(kind_id, name, state="running", started_at=started_at)
+			self.executor.submit(self._run_rebuild, kind_id, definitions, name, started_at)
+		except Exception:
+			with self.lock:
+				self.running.discard((kind_id, name))
+			raise
+		return self.rebuild_status(kind_id, name)
+
+
+	def _run_rebuild(self, kind_id, definitions, name, started_at):
+		try:
+			result = self.rebuild(kind_id, definitions, name)
+			self._save_rebuild(kind_id, name, state="done", started_at=started_at, finished_at=datetime.now(timezone.utc), **result)
+		except Exception as e:
+			logger.exception("Rebuild of rollup %s of %s failed.", name, kind_id)
+			try:
+				self._save_rebuild(kind_id, name, state="failed", started_at=started_at, finished_at=datetime.now(timezone.utc), error=str(e))
+			except Exception:
+				logger.exception("Couldn't save the failed rebuild of rollup %s of %s.", name, kind_id)
+		finally:
+			with self.lock:
+				self.running.discard((kind_id, name))
+
+
+	def rebuild_status(self, kind_id, name):
+		"""
+		:return: The state of the last rebuild of a rollup, {"state": "running" / "done" / "failed", "started_at",
+				 "finished_at", "entities", "groups", "error"}, None when it was never rebuilt.
+		"""
+		status = self.datastore_client.get(self.datastore_client.key(self.rebuild_kind(kind_id), name))
+		if status is None:
+			return None
+		return {field: value.isoformat() if isinstance(value, datetime) else value for field, value in status.items()}
@@ -0,0 +1,111 @@
+from datetime import datetime
+import base64
+import json
+import logging
+import zlib
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# datastore rejects indexed string / bytes values longer than this
+MAX_INDEXED_BYTES = 1500
+# compressed properties shorter than this (once serialized) are stored as they are
+COMPRESS_MIN_BYTES = 512
+COMPRESSION_LEVEL = 6
+# stored compressed values start with this, so they can't be mistaken for any other value
+COMPRESSED_PREFIX = b"zlib:"
+# the values JSON has no type for are serialized as {TAG: text}, so they are decoded back as the same type
+DATETIME_TAG = "$datetime"
+BYTES_TAG = "$bytes"
+
+
+def _encode_value(value):
+	if isinstance(value, datetime):
+		return {DATETIME_TAG: value.isoformat()}
+	if isinstance(value, bytes):
+		return {BYTES_TAG: base64.b64encode(value).decode("ascii")}
+	raise TypeError("%s values can't be compressed" % type(value).__name__)
+
+
+def _decode_value(value):
+	if len(value) == 1:
+		if DATETIME_TAG in value:
+			return datetime.fromisoformat(value[DATETIME_TAG])
+		if BYTES_TAG in value:
+			return base64.b64decode(value[BYTES_TAG])
+	return value
+
+
+
+class SchemaRegistry:
+	"""
+	Encapsulates the per-kind schema settings applied to entities on their way in and out of
+	datastore: properties excluded from indexes and large properties stored zlib-compressed.
+	"""
+
+	def __init__(self, schemas):
+		"""
+		:param schemas: Dict of kind_id ("*" for every kind) to its schema,
+						{"exclude_from_indexes": [properties], "compressed": [properties],
+						 "compress_min_bytes": 512}. Compressed properties are never indexed.
+		"""
+		self.schemas = schemas
+
+
+	def schema(self, kind_id):
+		"""
+		:return: The schema of a kind, an empty schema when it has none.
+		"""
+		return self.schemas.get(kind_id, self.schemas.get("*")) or {}
+
+
+	def prepare(self, kind_id, entity):
+		"""
+		Readies an entity for a write, in place: excludes the schema's properties (and any string
+		or bytes value too long to index) from indexes and compresses the compressed properties.
+
+		:param kind_id: The kind of the entity.
+		:param entity: The entity, with plain (decoded) values.
+		:return: The entity.
+		:raises ValueError: A compressed property holds a value other than JSON, datetimes or bytes.
+		"""
+		schema = self.schema(kind_id)
+		compressed = schema.get("compressed", [])
+		min_bytes = schema.get("compress_min_bytes", COMPRESS_MIN_BYTES)
+		excluded = set(schema.get("exclude_from_indexes", [])) | set(compressed)
+		for prop, value in entity.items():
+			if isinstance(value, str) and len(value) * 4 > MAX_INDEXED_BYTES:
+				# up to 4 bytes per character, only long enough strings need encoding to know
+				value = value.encode("utf-8")
+			if isinstance(value, bytes) and len(value) > MAX_INDEXED_BYTES:
+				excluded.add(prop)
+		for prop in compressed:
+			if prop in entity and entity[prop] is not None:
+				try:
+					serialized = json.dumps(entity[prop], default=_encode_value).encode("utf-8")
+				except TypeError as e:
+					raise ValueError("Property %s is compressed: %s" % (prop, e))
+				if len(serialized) >= min_bytes:
+					entity[prop] = COMPRESSED_PREFIX + zlib.compress(serialized, COMPRESSION_LEVEL)
+		entity.exclude_from_indexes.update(prop for prop in excluded if prop in entity)
+		return entity
+
+
+	@staticmethod
+	def decode(properties):
+		"""
+		Decompresses every compressed value of an entity (or dict of its properties), in place.
+
+		:param properties: The entity or dict as read from datastore.
+		:return: The same entity or dict, with plain values.
+		"""
+		for prop, value in properties.items():
+			if isinstance(value, bytes) and value.startswith(COMPRESSED_PREFIX):
+				try:
+					properties[prop] = json.loads(zlib.decompress(value[len(COMPRESSED_PREFIX):]).decode("utf-8"),
+												  object_hook=_decode_value)
+				except (zlib.error, ValueError):
+					logger.warning("Property %s looks compressed but couldn't be decompressed.", prop)
+		return properties
@@ -0,0 +1,303 @@
+from google.cloud import datastore
+import logging
+import re
+import zlib
+
+from atomicops import run_in_transaction
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# words are indexed by every prefix from MIN_PREFIX_LENGTH up to MAX_PREFIX_LENGTH characters,
+# query words longer than that are looked up by their first MAX_PREFIX_LENGTH characters and checked
+# against the entity afterwards
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 10
+# only the first MAX_WORDS_PER_FIELD distinct words of a field and MAX_TOKENS_PER_ENTITY tokens of an entity
+# are indexed, so a write changes at most 2 * MAX_TOKENS_PER_ENTITY index entities and fits, with the entity
+# itself, in the 500 mutations of one commit (words past the cap of long text fields aren't searchable)
+MAX_WORDS_PER_FIELD = 50
+MAX_TOKENS_PER_ENTITY = 200
+# every token is split over this many entities, an entity's keys go to the shard picked by its key_id, so
+# concurrent writes sharing a hot token (i.e. name:jo) mostly touch different entities
+TOKEN_SHARDS = 8
+# a token stops collecting keys past this size (split evenly over its shards) so every shard stays far below
+# the 1 MiB entity limit, searches skip overflowed tokens and rely on the longer words of the query instead
+MAX_KEYS_PER_TOKEN = 5000
+WORD_REGEX = r"\w+"
+# datastore lookups take at most 1000 keys
+MAX_LOOKUP_KEYS = 1000
+# update_many writes the index entities in transactions of at most this many
+INDEX_BATCH_SIZE = 400
+
+
+def tokenize(value):
+	"""
+	Splits a property value into lower case words.
+
+	:param value: The property value, anything that isn't a string (or list of strings) has no words.
+	:return: The list of words.
+	"""
+	if isinstance(value, list):
+		words = []
+		for item in value:
+			words.extend(tokenize(item))
+		return words
+	if not isinstance(value, str):
+		return []
+	return re.findall(WORD_REGEX, value.lower())
+
+
+
+class SearchIndex:
+	"""Encapsulates the inverted prefix index kept for the search fields of a kind."""
+
+	def __init__(self, datastore_client, min_prefix=MIN_PREFIX_LENGTH, max_prefix=MAX_PREFIX_LENGTH,
+				 max_keys_per_token=MAX_KEYS_PER_TOKEN, decode=None, token_shards=TOKEN_SHARDS,
+				 max_words_per_field=MAX_WORDS_PER_FIELD, max_tokens_per_entity=MAX_TOKENS_PER_ENTITY):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		:param min_prefix: Shortest prefix indexed.
+		:param max_prefix: Longest prefix indexed.
+		:param max_keys_per_token: Number of keys after which a token overflows.
+		:param decode: Optional function turning an entity read from datastore into plain values
+					   in place (i.e. decompressing properties) before it is matched.
+		:param token_shards: Entities every token is split over.
+		:param max_words_per_field: Distinct words indexed per field.
+		:param max_tokens_per_entity: Tokens indexed per entity.
+		"""
+		self.datastore_client = datastore_client
+		self.decode = decode
+		self.min_prefix = min_prefix
+		self.max_prefix = max_prefix
+		self.max_keys_per_token = max_keys_per_token
+		self.token_shards = token_shards
+		self.max_keys_per_shard = max(1, max_keys_per_token // token_shards)
+		self.max_words_per_field = max_words_per_field
+		self.max_tokens_per_entity = max_tokens_per_entity
+
+
+	@staticmethod
+	def index_kind(kind_id):
+		"""
+		:return: The kind holding the index entities of kind_id.
+		"""
+		return kind_id + "__search"
+
+
+	def tokens(self, properties, search_fields):
+		"""
+		Builds the index tokens of an entity, "field:prefix" for every prefix of every word, up to
+		max_words_per_field words per field and max_tokens_per_entity tokens in all.
+
+		:param properties: The entity (or dict of its properties), None for no entity.
+		:param search_fields: The property names that are searchable.
+		:return: The set of tokens.
+		"""
+		tokens = set()
+		if properties is None:
+			return tokens
+		for field in search_fields:
+			# the first distinct words in order, so the same properties always give the same tokens
+			words = list(dict.fromkeys(tokenize(properties.get(field))))[:self.max_words_per_field]
+			for word in words:
+				for length in range(self.min_prefix, min(len(word), self.max_prefix) + 1):
+					tokens.add(field + ":" + word[:length])
+					if len(tokens) >= self.max_tokens_per_entity:
+						return tokens
+		return tokens
+
+
+	def shard_name(self, token, key_id):
+		"""
+		:return: The name of the shard entity of token holding key_id, shard 0 is the token itself (the
+				 name tokens had before they were sharded, so older index entries are still read).
+		"""
+		shard = zlib.crc32(str(key_id).encode("utf-8")) % self.token_shards
+		return token if shard == 0 else "%s#%s" % (token, shard)
+
+
+	def shard_names(self, token):
+		return [token] + ["%s#%s" % (token, shard) for shard in range(1, self.token_shards)]
+
+
+	def deltas(self, changes, search_fields):
+		"""
+		Diffs the tokens of written entities.
+
+		:param changes: List of (key_id, old properties, new properties), None for no entity.
+		:param search_fields: The property names that are searchable.
+		:return: Dict of shard entity name to (set of key_ids to add, set of key_ids to remove).
+		"""
+		deltas = {}
+		for key_id, old_properties, new_properties in changes:
+			old_tokens = self.tokens(old_properties, search_fields)
+			new_tokens = self.tokens(new_properties, search_fields)
+			for token in new_tokens - old_tokens:
+				delta = deltas.setdefault(self.shard_name(token, key_id), (set(), set()))
+				delta[0].add(key_id)
+				delta[1].discard(key_id)
+			for token in old_tokens - new_tokens:
+				delta = deltas.setdefault(self.shard_name(token, key_id), (set(), set()))
+				delta[1].add(key_id)
+				delta[0].discard(key_id)
+		return deltas
+
+
+	def _apply(self, kind_id, deltas):
+		# reads the shard entities of the deltas and writes the changed ones, in the caller's transaction
+		index_kind = self.index_kind(kind_id)
+		names = sorted(deltas)
+		entries = {}
+		for start in range(0, len(names), MAX_LOOKUP_KEYS):
+			keys = [self.datastore_client.key(index_kind, name) for name in names[start:start + MAX_LOOKUP_KEYS]]
+			entries.update({entry.key.name: entry for entry in self.datastore_client.get_multi(keys)})
+		changed = []
+		for name in names:
+			added, removed = deltas[name]
+			entry = entries.get(name)
+			if entry is None:
+				if not added:
+					continue
+				entry = self._new_entry(index_kind, name)
+			keys = [key for key in entry["keys"] if key not in removed]
+			existing = set(keys)
+			new_keys = [key for key in sorted(added, key=str) if key not in existing]
+			overflow = entry.get("overflow", False)
+			room = max(0, self.max_keys_per_shard - len(keys))
+			if len(new_keys) > room:
+				if not overflow:
+					logger.warning("Search token %s of %s overflowed.", name, kind_id)
+				overflow = True
+				new_keys = new_keys[:room]
+			keys += new_keys
+			if name in entries and keys == entry["keys"] and overflow == entry.get("overflow", False):
+				continue
+			entry["keys"] = keys
+			entry["overflow"] = overflow
+			changed.append(entry)
+		if changed:
+			self.datastore_client.put_multi(changed)
+
+
+	def update(self, kind_id, key_id, old_properties, new_properties, search_fields):
+		"""
+		Brings the index entries of one entity in line with its new properties. Runs inside the
+		caller's transaction when there is one, so the index changes commit with the entity (at most
+		2 * max_tokens_per_entity mutations).
+
+		:param kind_id: The kind of the entity.
+		:param key_id: The id or name of the entity.
+		:param old_properties: The entity before the write, None when it didn't exist.
+		:param new_properties: The entity after the write, None when it was deleted.
+		:param search_fields: The property names that are searchable.
+		"""
+		deltas = self.deltas([(key_id, old_properties, new_properties)], search_fields)
+		if deltas:
+			self._apply(kind_id, deltas)
+
+
+	def update_many(self, kind_id, changes, search_fields):
+		"""
+		Brings the index entries of many written entities in line, merging their token changes so every
+		shard entity is read and written once, in retried transactions of INDEX_BATCH_SIZE shard entities.
+		Called after the entities committed (bulk writes), so a concurrent write to a shared token is
+		retried instead of overwritten.
+
+		:param kind_id: The kind of the entities.
+		:param changes: List of (key_id, old properties, new properties), None for no entity.
+		:param search_fields: The property names that are searchable.
+		"""
+		deltas = self.deltas(changes, search_fields)
+		names = sorted(deltas)
+		for start in range(0, len(names), INDEX_BATCH_SIZE):
+			batch = {name: deltas[name] for name in names[start:start + INDEX_BATCH_SIZE]}
+
+			def apply_batch():
+				with self.datastore_client.transaction():
+					self._apply(kind_id, batch)
+
+			run_in_transaction(apply_batch)
+
+
+	def _new_entry(self, index_kind, name):
+		entry = datastore.Entity(key=self.datastore_client.key(index_kind, name), exclude_from_indexes=("keys",))
+		entry["keys"] = []
+		entry["overflow"] = False
+		return entry
+
+
+	def search(self, kind_id, query, search_fields, limit=None, match="prefix"):
+		"""
+		Finds the entities having a word that matches every word of the query, with one get_multi
+		on the shards of the index entities and one get_multi (per 1000 candidates) on the matching entities.
+
+		:param kind_id: The kind to search.
+		:param query: The search text.
+		:param search_fields: The property names searched.
+		:param limit: Maximum number of entities returned.
+		:param match: "prefix" matches words starting with the query words, "term" matches whole words.
+		:return: The list of matching entities, ordered by key.
+		"""
+		words = sorted(set(tokenize(query)))
+		if not words:
+			return []
+		if min(len(word) for word in words) < self.min_prefix:
+			raise ValueError("Every search word needs at least %s characters" % self.min_prefix)
+		index_kind = self.index_kind(kind_id)
+		shard_names = set()
+		for word in words:
+			for field in search_fields:
+				shard_names.update(self.shard_names(field + ":" + word[:self.max_prefix]))
+		shard_names = sorted(shard_names)
+		entries = {}
+		for start in range(0, len(shard_names), MAX_LOOKUP_KEYS):
+			keys = [self.datastore_client.key(index_kind, name) for name in shard_names[start:start + MAX_LOOKUP_KEYS]]
+			entries.update({entry.key.name: entry for entry in self.datastore_client.get_multi(keys)})
+		candidates = None
+		for word in words:
+			word_keys = set()
+			overflowed = False
+			for field in search_fields:
+				for name in self.shard_names(field + ":" + word[:self.max_prefix]):
+					entry = entries.get(name)
+					if entry is None:
+						continue
+					if entry.get("overflow"):
+						overflowed = True
+						break
+					word_keys.update(entry["keys"])
+				if overflowed:
+					break
+			if overflowed:
+				continue
+			candidates = word_keys if candidates is None else candidates & word_keys
+		if candidates is None:
+			raise ValueError("Search is too broad, add a longer word")
+		candidates = sorted(candidates, key=str)
+		results = []
+		for start in range(0, len(candidates), MAX_LOOKUP_KEYS):
+			chunk = [self.datastore_client.key(kind_id, key_id) for key_id in candidates[start:start + MAX_LOOKUP_KEYS]]
+			entities = self.datastore_client.get_multi(chunk)
+			entities.sort(key=lambda entity: str(entity.key.id_or_name))
+			for entity in entities:
+				if self.decode is not None:
+					self.decode(entity)
+				# skips stale entries and checks the parts of the words past the indexed prefix
+				if self._matches(entity, words, search_fields, match):
+					results.append(entity)
+					if limit is not None and len(results) >= limit:
+						return results
+		return results
+
+
+	@staticmethod
+	def _matches(entity, words, search_fields, match):
+		entity_words = set()
+		for field in search_fields:
+			entity_words.update(tokenize(entity.get(field)))
+		if match == "term":
+			return all(word in entity_words for word in words)
+		return all(any(entity_word.startswith(word) for entity_word in entity_words) for word in words)
@@ -0,0 +1,534 @@
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import csv
+import io
+import json
+import logging
+import os
+import uuid
+
+from atomicops import run_in_transaction
+from circuitbreaker import GuardedReader
+
+
+
+logger = logging.getLogger(__name__)
+
+
+FORMATS = ("ndjson", "csv")
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXTENSIONS = {".ndjson": "ndjson", ".jsonl": "ndjson", ".json": "ndjson", ".csv": "csv"}
+# exports read the kind EXPORT_PAGE_SIZE entities at a time and start a new object every PART_ENTITIES
+# entities, a resumed export rewrites the part it was interrupted in
+EXPORT_PAGE_SIZE = 500
+PART_ENTITIES = 100000
+# imports write IMPORT_BATCH_SIZE records at a time (parallel put_multi batches), a resumed import
+# continues after the last batch written
+IMPORT_BATCH_SIZE = 4000
+# bytes buffered per GCS upload / download request, a multiple of 256 KiB
+CHUNK_SIZE = 8 * 1024 * 1024
+# longer lines (an entity is at most 1 MiB) are skipped instead of buffered
+MAX_LINE_BYTES = 1024 * 1024
+MAX_ERRORS_KEPT = 20
+# a running job holds a lease renewed on every checkpoint, a job whose lease ran out was interrupted
+# (i.e. its instance shut down) and can be resumed
+LEASE_SECONDS = 300
+MAX_RUNNING_JOBS = 2
+# properties the server maintains, not imported
+SERVER_FIELDS = ("updated_at", "version")
+# job properties kept out of the indexes (cursors and error lists can outgrow the indexed size limit)
+UNINDEXED_FIELDS = ("cursor", "fields", "columns", "objects", "errors", "error", "prefix", "object_name")
+
+
+class JobLost(Exception):
+	"""Another worker took over the job, after this one's lease ran out."""
+
+
+
+def _reject_constant(name):
+	raise ValueError("%s is not a CSV value" % name)
+
+
+def _parse_cell(cell):
+	# the inverse of _cell: a cell holding JSON is that value, any other cell is the string itself
+	try:
+		return json.loads(cell, parse_constant=_reject_constant)
+	except ValueError:
+		return cell
+
+
+def _cell(value):
+	if value is None:
+		return ""
+	if isinstance(value, str):
+		# strings are written raw unless they'd read back as something else ("0", "true", "", '"a"')
+		if value == "" or _parse_cell(value) is not value:
+			return json.dumps(value, ensure_ascii=False)
+		return value
+	return json.dumps(value, ensure_ascii=False, default=str)
+
+
+
+class TransferJobs:
+	"""
+	Encapsulates the bulk export of a kind to NDJSON / CSV objects in GCS and the bulk import of such an
+	object into a kind, as background jobs with their progress and checkpoint kept in datastore (in the
+	<kind_id>__transfers kind) so they can be followed and resumed. Objects are streamed in chunks, so
+	memory stays bounded whatever their size.
+	"""
+
+	def __init__(self, datastore_client, storage_client, to_dicts, write_items, breaker=None, timeout=None,
+				 max_running=MAX_RUNNING_JOBS, lease_seconds=LEASE_SECONDS, page_size=EXPORT_PAGE_SIZE,
+				 part_entities=PART_ENTITIES, batch_size=IMPORT_BATCH_SIZE):
+		"""
+		:param datastore_client: A Google Cloud Datastore client.
+		:param storage_client: A Google Cloud Storage client.
+		:param to_dicts: Function (kind_id, entities, read_options) returning the entities as exported, list
+						 of dicts with their key under "key_id".
+		:param write_items: Function (kind_id, items) writing a batch of imported {"key_id", "data"} items.
+		:param breaker: Optional circuit breaker the GCS metadata calls go through.
+		:param timeout: Seconds each GCS request may take.
+		:param max_running: Jobs running at once, later ones wait.
+		:param lease_seconds: Seconds without a checkpoint after which a running job counts as interrupted.
+		:param page_size: Entities read per export query.
+		:param part_entities: Entities per exported object.
+		:param batch_size: Records written per import batch.
+		"""
+		self.datastore_client = datastore_client
+		self.storage_client = storage_client
+		self.to_dicts = to_dicts
+		self.write_items = write_items
+		self.breaker = breaker
+		self.timeout = timeout
+		self.lease_seconds = lease_seconds
+		self.page_size = page_size
+		self.part_entities = part_entities
+		self.batch_size = batch_size
+		self.executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix="transfer")
+
+
+	@staticmethod
+	def job_kind(kind_id):
+		"""
+		:return: The kind holding the transfer jobs of kind_id.
+		"""
+		return kind_id + "__transfers"
+
+
+	@staticmethod
+	def now():
+		return datetime.now(timezone.utc)
+
+
+	def _new_job(self, kind_id, job_id, job_type, **properties):
+		job = datastore.Entity(key=self.datastore_client.key(self.job_kind(kind_id), job_id), exclude_from_indexes=UNINDEXED_FIELDS)
+		job.update({"kind_id": kind_id, "type": job_type, "status": "queued", "owner": None, "created_at": self.now(),
+					"updated_at": self.now(), "lease_until": None, "skipped": 0, "errors": [], "error": None})
+		job.update(properties)
+		self.datastore_client.put(job)
+		self.executor.submit(self._run, kind_id, job_id)
+		return self.describe(job)
+
+
+	def start_export(self, kind_id, file_format="ndjson", bucket_name=None, folder="exports", object_type=None, fields=None,
+					 read_options=None, snapshot=False):
+		"""
+		Starts exporting a kind to objects named <folder>/<kind_id>-<job_id>-00000.<format>, ...
+
+		:param kind_id: The kind exported.
+		:param file_format: "ndjson" (one json object per line) or "csv" (one column per field).
+		:param bucket_name: The bucket written to, the kind's own bucket (named kind_id) when None.
+		:param folder: Folder of the objects in the bucket.
+		:param object_type: Only export the entities of this object_type.
+		:param fields: CSV columns (key_id comes first), the properties of the first page when None.
+		:param read_options: Keyword arguments of every read, {"eventual": True} or {"read_time": datetime}.
+		:param snapshot: Read every page as of the start of the job (the minute it starts in), so the export
+						 is one consistent snapshot without a transaction. It then needs to finish within the
+						 hour, or within the point-in-time recovery window if enabled.
+		:return: The job, see describe.
+		:raises ValueError: Unsupported format or fields.
+		"""
+		if file_format not in FORMATS:
+			raise ValueError("Unsupported format %s, use one of %s" % (file_format, ", ".join(FORMATS)))
+		if fields is not None and (not isinstance(fields, list) or not all(isinstance(field, str) for field in fields)):
+			raise ValueError("fields needs to be a list of property names")
+		read_options = dict(read_options or {})
+		if snapshot:
+			if read_options:
+				raise ValueError("snapshot reads at the start of the job, it can't be combined with read options")
+			# older read times have to be whole minutes
+			read_options["read_time"] = self.now().replace(second=0, microsecond=0)
+		job_id = uuid.uuid4().hex
+		prefix = "%s-%s" % (kind_id, job_id)
+		if folder and folder.strip("/"):
+			prefix = folder.strip("/") + "/" + prefix
+		return self._new_job(kind_id, job_id, "export", format=file_format, bucket=bucket_name or kind_id, prefix=prefix,
+							 object_type=object_type, fields=fields, cursor=None, parts=0, entities=0, bytes=0,
+							 part_entities=0, objects=[], eventual=bool(read_options.get("eventual")),
+							 read_time=read_options.get("read_time"))
+
+
+	def start_import(self, kind_id, object_name, file_format=None, bucket_name=None):
+		"""
+		Starts importing an NDJSON / CSV object into a kind, every record is created like /api/v1/create
+		does (a "key_id" field / column is the key, records without one are named <job_id>-<byte offset>
+		of the record in the object, which stays the same when the job is resumed).
+
+		:param kind_id: The kind imported into.
+		:param object_name: The object (folder path + file name) read.
+		:param file_format: "ndjson" or "csv", taken from the file extension when None.
+		:param bucket_name: The bucket read from, the kind's own bucket when None.
+		:return: The job, see describe.
+		:raises ValueError: Unsupported format.
+		"""
+		if file_format is None:
+			file_format = EXTENSIONS.get(os.path.splitext(object_name)[1].lower())
+		if file_format not in FORMATS:
+			raise ValueError("Unsupported format %s, use one of %s" % (file_format, ", ".join(FORMATS)))
+		return self._new_job(kind_id, uuid.uuid4().hex, "import", format=file_format, bucket=bucket_name or kind_id, object_name=object_name,
+							 offset=0, total_bytes=None, columns=None, records=0)
+
+
+	def status(self, kind_id, job_id):
+		"""
+		:return: The job, see describe, None when there's no such job.
+		"""
+		job = self.datastore_client.get(self.datastore_client.key(self.job_kind(kind_id), job_id))
+		return self.describe(job) if job is not None else None
+
+
+	def resume(self, kind_id, job_id):
+		"""
+		Resumes a failed or interrupted job from its last checkpoint (or a queued job whose instance shut
+		down before it ran), only one worker at a time can claim a job. The records written after the
+		checkpoint are written again: imports replace them as every record has a deterministic key,
+		exports rewrite the object they were interrupted in.
+
+		:return: The job, see describe, None when there's no such job.
+		:raises ValueError: The job is done or still running.
+		"""
+		job = self.datastore_client.get(self.datastore_client.key(self.job_kind(kind_id), job_id))
+		if job is None:
+			return None
+		status = self.describe(job)["status"]
+		if status in ("done", "running"):
+			raise ValueError("Job %s is %s, only failed, interrupted or queued jobs can be resumed" % (job_id, status))
+		self.executor.submit(self._run, kind_id, job_id)
+		return self.describe(job)
+
+
+	def describe(self, job):
+		"""
+		:return: Dict of a job: job_id, kind, type, format, status (queued, running, interrupted, failed or
+				 done), progress (entities exported / records imported, bytes, objects), and errors.
+		"""
+		status = job["status"]
+		if status == "running" and (job.get("lease_until") is None or job["lease_until"] < self.now()):
+			status = "interrupted"
+		description = {"job_id": job.key.id_or_name, "kind_id": job["kind_id"], "type": job["type"], "format": job["format"],
+					   "status": status, "bucket": job["bucket"], "skipped": job["skipped"], "errors": list(job.get("errors") or []),
+					   "error": job["error"], "created_at": job["created_at"].isoformat(), "updated_at": job["updated_at"].isoformat()}
+		if job["type"] == "export":
+			description.update({"entities": job["entities"] + job["part_entities"], "bytes": job["bytes"],
+								"objects": list(job.get("objects") or []),
+								"read_consistency": "eventual" if job.get("eventual") else "strong",
+								"read_time": job["read_time"].isoformat() if job.get("read_time") is not None else None})
+		else:
+			description.update({"object_name": job["object_name"], "records": job["records"], "bytes": job["offset"],
+								"total_bytes": job["total_bytes"]})
+			if job["total_bytes"]:
+				description["percent"] = round(100.0 * job["offset"] / job["total_bytes"], 1)
+		return description
+
+
+	def _gcs(self, function, *args, **kwargs):
+		if self.breaker is None:
+			return function(*args, timeout=self.timeout, **kwargs)
+		return self.breaker.call(function, *args, timeout=self.timeout, **kwargs)
+
+
+	def _claim(self, kind_id, job_id, owner):
+		# a job only runs on one worker at a time: it's taken over when queued, failed or its lease ran out
+		with self.datastore_client.transaction():
+			job = self.datastore_client.get(self.datastore_client.key(self.job_kind(kind_id), job_id))
+			if job is None or job["status"] == "done":
+				return None
+			if job["status"] == "running" and job.get("lease_until") is not None and job["lease_until"] > self.now():
+				return None
+			job.exclude_from_indexes.update(UNINDEXED_FIELDS)
+			job.update({"status": "running", "owner": owner, "error": None, "updated_at": self.now(),
+						"lease_until": self.now() + timedelta(seconds=self.lease_seconds)})
+			self.datastore_client.put(job)
+			return job
+
+
+	def _save(self, job, owner, checkpoint=True, **changes):
+		# progress and checkpoints are only written while this worker still holds the job, without
+		# checkpoint only the changes are written and the job keeps its last checkpoint
+		def save():
+			with self.datastore_client.transaction():
+				stored = self.datastore_client.get(job.key)
+				if stored is None or stored.get("owner") != owner:
+					raise JobLost("Job %s was taken over by another worker" % job.key.id_or_name)
+				saved = job if checkpoint else stored
+				saved.update(changes)
+				saved["updated_at"] = self.now()
+				saved["lease_until"] = self.now() + timedelta(seconds=self.lease_seconds)
+				self.datastore_client.put(saved)
+
+		run_in_transaction(save)
+
+
+	def _run(self, kind_id, job_id):
+		owner = uuid.uuid4().hex
+		try:
+			job = run_in_transaction(self._claim, kind_id, job_id, owner)
+		except Exception:
+			logger.exception("Couldn't start transfer job %s of %s.", job_id, kind_id)
+			return
+		if job is None:
+			return
+		logger.info("Running %s job %s of %s.", job["type"], job_id, kind_id)
+		try:
+			if job["type"] == "export":
+				self._export(job, owner)
+			else:
+				self._import(job, owner)
+			self._save(job, owner, status="done")
+		except JobLost:
+			logger.warning("Transfer job %s of %s was taken over, stopping.", job_id, kind_id)
+		except Exception as e:
+			logger.exception("Transfer job %s of %s failed.", job_id, kind_id)
+			try:
+				self._save(job, owner, checkpoint=False, status="failed", error=str(e) or type(e).__name__)
+			except Exception:
+				logger.exception("Couldn't record the failure of transfer job %s of %s.", job_id, kind_id)
+		else:
+			logger.info("Finished %s job %s of %s.", job["type"], job_id, kind_id)
+
+
+	@staticmethod
+	def _read_options(job):
+		if job.get("read_time") is not None:
+			return {"read_time": job["read_time"]}
+		return {"eventual": True} if job.get("eventual") else {}
+
+
+	def _read_page(self, job, cursor):
+		query = self.datastore_client.query(kind=job["kind_id"])
+		if job.get("object_type") is not None:
+			query.add_filter(filter=PropertyFilter("object_type", "=", job["object_type"]))
+		iterator = query.fetch(start_cursor=cursor, limit=self.page_size, **self._read_options(job))
+		page = list(iterator)
+		next_cursor = iterator.next_page_token
+		if isinstance(next_cursor, bytes):
+			next_cursor = next_cursor.decode("ascii")
+		return page, (next_cursor if page else None)
+
+
+	def _encode(self, rows, file_format, columns):
+		if file_format == "ndjson":
+			return "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows).encode("utf-8")
+		output = io.StringIO()
+		writer = csv.writer(output)
+		for row in rows:
+			writer.writerow([_cell(row.get(column)) for column in columns])
+		return output.getvalue().encode("utf-8")
+
+
+	def _export(self, job, owner):
+		kind_id = job["kind_id"]
+		file_format = job["format"]
+		bucket = self.storage_client.bucket(job["bucket"])
+		page, next_cursor = self._read_page(job, job["cursor"])
+		if not page and job["parts"] > 0:
+			# interrupted right after the last part was checkpointed
+			return
+		done = False
+		while not done:
+			rows = self.to_dicts(kind_id, page, self._read_options(job))
+			if file_format == "csv" and not job["fields"]:
+				# the columns of the first page, used for every part
+				names = sorted({name for row in rows for name in row if name != "key_id"})
+				job["fields"] = names
+			columns = ["key_id"] + [field for field in (job["fields"] or []) if field != "key_id"]
+			object_name = "%s-%05d.%s" % (job["prefix"], job["parts"], file_format)
+			count = 0
+			size = 0
+			with bucket.blob(object_name).open("wb", chunk_size=CHUNK_SIZE, content_type=CONTENT_TYPES[file_format],
+											   timeout=self.timeout) as output:
+				if file_format == "csv":
+					header = self._encode([{column: column for column in columns}], file_format, columns)
+					output.write(header)
+					size += len(header)
+				while True:
+					data = self._encode(rows, file_format, columns)
+					output.write(data)
+					size += len(data)
+					count += len(page)
+					if not page or next_cursor is None:
+						done = True
+						break
+					self._save(job, owner, part_entities=count)
+					if count >= self.part_entities:
+						break
+					page, next_cursor = self._read_page(job, next_cursor)
+					rows = self.to_dicts(kind_id, page, self._read_options(job))
+			self._save(job, owner, cursor=next_cursor, parts=job["parts"] + 1, entities=job["entities"] + count,
+					   bytes=job["bytes"] + size, part_entities=0, objects=list(job.get("objects") or []) + [object_name])
+			if not done:
+				page, next_cursor = self._read_page(job, next_cursor)
+				done = not page
+
+
+	def _lines(self, reader, position, job):
+		# yields the decoded lines of the object, position[0] is the byte offset after the last line yielded.
+		# the object is read CHUNK_SIZE bytes at a time and split here: a GCS BlobReader has no peek, so its
+		# readline would fall back to reading one byte at a time
+		first = position[0] == 0
+		buffer = b""
+		# offset of the overlong line being skipped, None when not skipping
+		skipping = None
+		while True:
+			chunk = reader.read(CHUNK_SIZE)
+			buffer = buffer + chunk if buffer else chunk
+			start = 0
+			while True:
+				end = buffer.find(b"\n", start)
+				if end < 0:
+					break
+				line = buffer[start:end + 1]
+				line_start = position[0]
+				position[0] += len(line)
+				start = end + 1
+				if skipping is not None:
+					self._error(job, skipping, "line longer than %s bytes" % MAX_LINE_BYTES)
+					skipping = None
+					continue
+				if len(line) > MAX_LINE_BYTES + 1:
+					self._error(job, line_start, "line longer than %s bytes" % MAX_LINE_BYTES)
+					continue
+				text = self._decode(line, line_start, job, first)
+				first = False
+				if text is not None:
+					yield text
+			buffer = buffer[start:]
+			if not chunk:
+				if buffer:
+					# the last line, without a line break
+					line_start = position[0]
+					position[0] += len(buffer)
+					if skipping is not None:
+						self._error(job, skipping, "line longer than %s bytes" % MAX_LINE_BYTES)
+					elif len(buffer) > MAX_LINE_BYTES:
+						self._error(job, line_start, "line longer than %s bytes" % MAX_LINE_BYTES)
+					else:
+						text = self._decode(buffer, line_start, job, first)
+						if text is not None:
+							yield text
+				return
+			if len(buffer) > MAX_LINE_BYTES:
+				# the rest of an overlong line is dropped as it's read, instead of buffered
+				if skipping is None:
+					skipping = position[0]
+				position[0] += len(buffer)
+				buffer = b""
+
+
+	def _decode(self, line, offset, job, first):
+		try:
+			text = line.decode("utf-8")
+		except UnicodeDecodeError as e:
+			self._error(job, offset, str(e))
+			return None
+		return text.lstrip("\ufeff") if first else text
+
+
+	def _records(self, lines, position, job):
+		# yields (byte offset, record dict) of every valid record, invalid ones are counted as skipped
+		if job["format"] == "ndjson":
+			for line in lines:
+				if not line.strip():
+					continue
+				start = position[0] - len(line.encode("utf-8"))
+				try:
+					record = json.loads(line)
+				except ValueError as e:
+					self._error(job, start, "invalid json: %s" % e)
+					continue
+				if not isinstance(record, dict):
+					self._error(job, start, "not a json object")
+					continue
+				yield start, record
+			return
+		reader = csv.reader(lines)
+		if position[0] == 0 or job["columns"] is None:
+			job["columns"] = next(reader, None)
+			if job["columns"] is None:
+				return
+		columns = job["columns"]
+		while True:
+			start = position[0]
+			try:
+				row = next(reader)
+			except StopIteration:
+				return
+			except csv.Error as e:
+				self._error(job, start, "invalid csv: %s" % e)
+				continue
+			if not row:
+				continue
+			if len(row) != len(columns):
+				self._error(job, start, "%s cells, the header has %s" % (len(row), len(columns)))
+				continue
+			record = {column: _parse_cell(cell) for column, cell in zip(columns, row) if cell != ""}
+			yield start, record
+
+
+	def _error(self, job, offset, message):
+		job["skipped"] += 1
+		errors = list(job.get("errors") or [])
+		if len(errors) < MAX_ERRORS_KEPT:
+			job["errors"] = errors + ["byte %s: %s" % (offset, message)]
+
+
+	def _import(self, job, owner):
+		kind_id = job["kind_id"]
+		blob = self.storage_client.bucket(job["bucket"]).blob(job["object_name"])
+		self._gcs(blob.reload)
+		job["total_bytes"] = blob.size
+		position = [job["offset"]]
+		with blob.open("rb", chunk_size=CHUNK_SIZE, timeout=self.timeout) as reader:
+			if self.breaker is not None:
+				# every read downloads a range, each goes through the breaker
+				reader = GuardedReader(reader, self.breaker)
+			if position[0]:
+				reader.seek(position[0])
+			# key_id to (byte offset, item), a batch can't write the same entity twice so the last record wins
+			batch = {}
+			for start, record in self._records(self._lines(reader, position, job), position, job):
+				key_id = record.pop("key_id", None)
+				for field in SERVER_FIELDS:
+					record.pop(field, None)
+				if not record:
+					self._error(job, start, "no properties")
+					continue
+				if key_id is None or key_id == "":
+					# named after the job and the record's byte offset, so a batch written again after a resume
+					# replaces the entities it created the first time instead of duplicating them
+					key_id = "%s-%d" % (job.key.id_or_name, start)
+				if not (isinstance(key_id, str) or (isinstance(key_id, int) and not isinstance(key_id, bool) and key_id > 0)):
+					self._error(job, start, "key_id %s is not a name or a positive id" % json.dumps(key_id, default=str))
+					continue
+				if key_id in batch:
+					self._error(job, batch[key_id][0], "replaced by the record with the same key_id at byte %s" % start)
+				batch[key_id] = (start, {"key_id": key_id, "data": record})
+				if len(batch) >= self.batch_size:
+					self.write_items(kind_id, [item for offset, item in batch.values()])
+					self._save(job, owner, offset=position[0], records=job["records"] + len(batch))
+					batch = {}
+			if batch:
+				self.write_items(kind_id, [item for offset, item in batch.values()])
+			self._save(job, owner, offset=position[0], records=job["records"] + len(batch))
@@ -0,0 +1,185 @@
+import atexit
+import logging
+import threading
+import time
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# pending updates are flushed every FLUSH_WINDOW seconds, or right away once MAX_PENDING_KEYS
+# different keys are waiting
+FLUSH_WINDOW = 0.5
+MAX_PENDING_KEYS = 500
+# submits of new keys are rejected once this many keys are waiting (i.e. while the backend is down)
+MAX_BUFFERED_KEYS = 5000
+# a key whose write failed is retried on its own, after FLUSH_WINDOW * 2 ** attempts seconds, and dropped
+# (logged with its data) after MAX_FLUSH_ATTEMPTS failed attempts
+MAX_FLUSH_ATTEMPTS = 5
+
+
+
+class WriteBufferFullError(Exception):
+	"""The write-behind buffer holds its maximum number of keys."""
+
+
+
+class WriteCoalescer:
+	"""
+	Write-behind buffer that merges property updates to the same key over a short window and
+	hands them to a flush function in one batch.
+	"""
+
+	def __init__(self, flush_function, window=FLUSH_WINDOW, max_pending_keys=MAX_PENDING_KEYS,
+				 max_buffered_keys=MAX_BUFFERED_KEYS, max_attempts=MAX_FLUSH_ATTEMPTS):
+		"""
+		:param flush_function: Called with a list of (kind_id, key_id, data) to write, one item per key, returns
+							   the items it couldn't write (None when every item was written) or raises
+							   when none was written.
+		:param window: Seconds between flushes.
+		:param max_pending_keys: Number of pending keys that triggers a flush before the window ends.
+		:param max_buffered_keys: Number of pending keys past which updates of new keys are rejected.
+		:param max_attempts: Failed writes of a key after which its update is dropped.
+		"""
+		self.flush_function = flush_function
+		self.window = window
+		self.max_pending_keys = max_pending_keys
+		self.max_buffered_keys = max_buffered_keys
+		self.max_attempts = max_attempts
+		self.pending = {}
+		# (failed attempts, time of the next attempt) of the pending keys whose write failed
+		self.retries = {}
+		self.lock = threading.Lock()
+		# only one flush runs at a time so a key is never written by two flushes out of order
+		self.flush_lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.wake = threading.Event()
+		self.thread = None
+		self.metrics = {"submitted": 0, "rejected": 0, "flushes": 0, "flushed_keys": 0, "flush_errors": 0, "dropped_keys": 0,
+						"last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+
+
+	def start(self):
+		"""
+		Starts the background flush thread and flushes whatever is pending when the process exits.
+		"""
+		if self.thread is not None:
+			return
+		self.thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+
+	def submit(self, kind_id, key_id, data):
+		"""
+		Queues an update, merged over any pending update of the same key (later values win).
+
+		:param kind_id: The kind of the entity.
+		:param key_id: The id or name of the entity.
+		:param data: The properties to set.
+		:raises WriteBufferFullError: max_buffered_keys keys are pending and this key isn't one of them.
+		"""
+		key = (kind_id, key_id)
+		with self.lock:
+			if key not in self.pending and len(self.pending) >= self.max_buffered_keys:
+				self.metrics["rejected"] += 1
+				raise WriteBufferFullError("The write-behind buffer holds %s keys" % self.max_buffered_keys)
+			pending_data = self.pending.setdefault(key, {})
+			pending_data.update(data)
+			self.metrics["submitted"] += 1
+			full = len(self.pending) >= self.max_pending_keys
+		if full:
+			# the flush thread writes the burst now instead of at the end of the window
+			self.wake.set()
+
+
+	def flush(self, everything=False):
+		"""
+		Writes the pending updates: the keys never tried with one call to the flush function, and every key
+		whose write failed before (and is due for a retry) with a call of its own, so one update that keeps
+		failing doesn't hold back the others.
+
+		:param everything: Retry the failed keys now even when they aren't due yet (on exit).
+		"""
+		with self.flush_lock:
+			now = time.monotonic()
+			with self.lock:
+				due = [key for key in self.pending if everything or key not in self.retries or self.retries[key][1] <= now]
+				batch = {key: self.pending.pop(key) for key in due}
+				attempts = {key: self.retries.pop(key)[0] for key in due if key in self.retries}
+			if not batch:
+				return
+			groups = [[key for key in batch if key not in attempts]] + [[key] for key in attempts]
+			for keys in groups:
+				if keys:
+					self._flush_keys(keys, batch, attempts)
+
+
+	def _flush_keys(self, keys, batch, attempts):
+		items = [(kind_id, key_id, batch[(kind_id, key_id)]) for kind_id, key_id in keys]
+		start_time = time.perf_counter()
+		try:
+			failed = self.flush_function(items) or []
+		except Exception:
+			logger.exception("Couldn't flush %s coalesced writes, retrying them.", len(items))
+			failed = items
+		flush_ms = (time.perf_counter() - start_time) * 1000
+		with self.lock:
+			if failed:
+				self.metrics["flush_errors"] += 1
+				for kind_id, key_id, data in failed:
+					self._requeue((kind_id, key_id), data, attempts.get((kind_id, key_id), 0) + 1)
+			self.metrics["flushes"] += 1
+			self.metrics["flushed_keys"] += len(items) - len(failed)
+			self.metrics["last_flush_ms"] = flush_ms
+			self.metrics["max_flush_ms"] = max(self.metrics["max_flush_ms"], flush_ms)
+			self.metrics["total_flush_ms"] += flush_ms
+
+
+	def _requeue(self, key, data, attempts):
+		# called with self.lock held, updates submitted since the batch was taken are newer and win
+		if attempts >= self.max_attempts:
+			self.metrics["dropped_keys"] += 1
+			logger.error("Dropping the write-behind update of %s after %s failed attempts: %s", key, attempts, data)
+			return
+		requeued = dict(data)
+		requeued.update(self.pending.get(key, {}))
+		self.pending[key] = requeued
+		self.retries[key] = (attempts, time.monotonic() + self.window * 2 ** attempts)
+
+
+	def stats(self):
+		"""
+		:return: Dict of buffer metrics: submitted and rejected updates, flushes, keys written, flush errors,
+				 keys dropped, flush latency (last / max / average ms), pending keys and the ones waiting for a retry.
+		"""
+		with self.lock:
+			stats = dict(self.metrics)
+			stats["pending_keys"] = len(self.pending)
+			stats["retrying_keys"] = len(self.retries)
+		stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+		return stats
+
+
+	def close(self):
+		"""
+		Stops the flush thread and writes whatever is still pending.
+		"""
+		self.stopped.set()
+		self.wake.set()
+		if self.thread is not None:
+			self.thread.join(timeout=self.window * 2)
+		self.flush(everything=True)
+
+
+	def _run(self):
+		while True:
+			self.wake.wait(self.window)
+			self.wake.clear()
+			if self.stopped.is_set():
+				return
+			try:
+				self.flush()
+			except Exception:
+				logger.exception("Write-behind flush failed.")